@@ -0,0 +1,112 @@
+"""
+Cross-worker LRU cache of decoded chunk images.
+
+Decoding the 12-view raw_img.png / depth_alpha.jpg of a chunk is the most expensive step of the
+VAE data loader, and every epoch decodes the same chunks again. ChunkDecodeCache keeps the decoded
+uint8 arrays as .npy files in a directory shared by all dataloader workers of a node: /dev/shm for
+a shared-memory cache, or a directory on a local SSD. Entries are keyed by the source path, size
+and mtime, the least recently used ones are evicted once the directory exceeds its byte budget.
+"""
+
+import hashlib
+import os
+from typing import Dict
+
+import imageio.v2 as imageio
+import numpy as np
+
+
+class ChunkDecodeCache:
+    """
+    Decoded-image cache shared through a directory.
+
+    Args:
+        cache_dir: Directory holding the cache entries (e.g. /dev/shm/sar3d_chunks or a local SSD path)
+        max_gb: Byte budget of the directory in GB
+        scan_every_gb: Re-scan the directory for eviction after this process wrote this much (default: 1% of max_gb)
+    """
+    def __init__(self, cache_dir: str, max_gb: float = 32, scan_every_gb: float = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_gb * 1024 ** 3)
+        self.scan_every = int((scan_every_gb if scan_every_gb is not None else max_gb / 100) * 1024 ** 3)
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Per-process counters (every dataloader worker has its own copy)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._written_since_scan = 0
+
+    def _entry_path(self, path: str) -> str:
+        st = os.stat(path)
+        key = hashlib.sha1(f'{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f'{key}.npy')
+
+    def imread(self, path: str) -> np.ndarray:
+        """imageio.imread(path), served from the cache when the decoded image is there"""
+        entry = self._entry_path(path)
+        try:
+            img = np.load(entry)
+            os.utime(entry)     # mark as recently used
+            self.hits += 1
+            return img
+        except (FileNotFoundError, ValueError, EOFError, OSError):
+            # Missing, or a partially evicted / corrupt entry: decode again
+            pass
+
+        self.misses += 1
+        img = imageio.imread(path)
+        self._put(entry, np.ascontiguousarray(img))
+        return img
+
+    def _put(self, entry: str, img: np.ndarray):
+        # Write to a private file and rename, so concurrent workers never read a partial entry
+        tmp_path = f'{entry}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, img)
+            os.replace(tmp_path, entry)
+        except OSError:
+            # Cache device full or gone: keep serving decoded images uncached
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        self._written_since_scan += img.nbytes
+        if self._written_since_scan >= self.scan_every:
+            self._written_since_scan = 0
+            self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the directory is below 90% of the budget"""
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for e in it:
+                if e.name.endswith('.npy'):
+                    try:
+                        st = e.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, e.path))
+
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * 0.9)
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass    # already evicted by another worker
+            total -= size
+
+    def stats(self) -> Dict[str, float]:
+        """Hit/miss counters of this process"""
+        n = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, hit_rate=self.hits / n if n else 0.0)
+
+    def __repr__(self):
+        return f'{type(self).__name__}(cache_dir={self.cache_dir}, max_gb={self.max_bytes / 1024 ** 3:.1f}, {self.stats()})'
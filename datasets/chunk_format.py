@@ -0,0 +1,184 @@
+"""
+Alternative on-disk chunk container: one blob of raw arrays per chunk instead of PNG/JPEG tiles.
+
+A chunk directory normally holds raw_img.png (views tiled horizontally), depth_alpha.jpg (depth over
+alpha, 8 bit), normal.png, c.npy, d_near_far.npy, bbox.npy and the caption / instance text files.
+Decoding the images dominates loading, and the 8-bit JPEG depth goes through the d_near_far inverse.
+convert_chunk packs everything into <chunk>/chunk.lz4, which read_chunk_blob loads with one read
+and one LZ4 decompression (or none, for uncompressed blobs):
+
+    RGB         (N, H, W, 3) uint8
+    depth       (N, H, W) float16, already un-projected with d_near_far, background 0
+    alpha       (N, H, W) uint8
+    normal      (N, H, W, 3) uint8, as stored in normal.png (optional)
+    c, d_near_far, bbox as stored, caption and ins in the header
+
+File layout:
+    8 bytes     magic b'SAR3DCHK'
+    4 bytes     little-endian uint32, length of the JSON header
+    header      JSON: version, compression, arrays {name: [dtype, shape, offset, nbytes]}, caption, ins
+    payload     the arrays back to back, LZ4-frame compressed unless compression is 'none'
+
+Convert a dataset in place (the PNG/JPEG files are kept):
+    python -m datasets.chunk_format --data_dir <dataset> [--compression none] [--workers 16]
+"""
+
+import argparse
+import json
+import os
+import struct
+from functools import partial
+from multiprocessing import Pool
+from typing import Dict, Optional, Tuple
+
+import imageio.v2 as imageio
+import lz4.frame
+import numpy as np
+from tqdm import tqdm
+
+
+MAGIC = b'SAR3DCHK'
+VERSION = 1
+CHUNK_BLOB = 'chunk.lz4'
+CHUNK_FORMATS = ('png', 'lz4')
+
+
+def write_chunk_blob(path: str, arrays: Dict[str, np.ndarray], caption: str, ins: str, compression: str = 'lz4'):
+    """
+    Write arrays and captions to a chunk blob.
+
+    Args:
+        path: Output file, <chunk>/chunk.lz4 by convention
+        arrays: Named arrays, stored with their dtype and shape
+        caption, ins: Caption and instance id of the chunk
+        compression: 'lz4' or 'none'
+    """
+    assert compression in ('lz4', 'none'), f'unknown {compression=}'
+    table, payload, offset = {}, [], 0
+    for name, arr in arrays.items():
+        buf = np.ascontiguousarray(arr).tobytes()
+        table[name] = [arr.dtype.str, list(arr.shape), offset, len(buf)]
+        payload.append(buf)
+        offset += len(buf)
+    payload = b''.join(payload)
+    if compression == 'lz4':
+        payload = lz4.frame.compress(payload)
+
+    header = json.dumps(dict(version=VERSION, compression=compression, arrays=table, caption=caption, ins=ins)).encode('utf-8')
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        f.write(payload)
+    os.replace(tmp_path, path)
+
+
+def read_chunk_blob(path: str) -> Tuple[Dict[str, np.ndarray], Dict]:
+    """Read a chunk blob, returns the named arrays and the header (caption, ins, ...)"""
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a chunk blob (magic={magic!r})')
+        header_len, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+        if header['version'] > VERSION:
+            raise ValueError(f'{path} has version {header["version"]}, this reader supports <= {VERSION}')
+        payload = f.read()
+    if header['compression'] == 'lz4':
+        payload = lz4.frame.decompress(payload)
+
+    # The payload buffer is owned here, so the arrays can be writable views of it
+    payload = bytearray(payload)
+    arrays = {
+        name: np.frombuffer(payload, dtype=np.dtype(dt), count=int(np.prod(shape)), offset=offset).reshape(shape)
+        for name, (dt, shape, offset, _) in header['arrays'].items()
+    }
+    return arrays, header
+
+
+def convert_chunk(chunk_path: str, chunk_size: int = 12, compression: str = 'lz4', overwrite: bool = False) -> Optional[str]:
+    """
+    Convert the PNG/JPEG files of one chunk directory into <chunk_path>/chunk.lz4.
+
+    Args:
+        chunk_path: Chunk directory
+        chunk_size: Number of views tiled in the images
+        compression: 'lz4' or 'none'
+        overwrite: Rewrite an existing blob
+
+    Returns:
+        Path of the blob, None if it existed already
+    """
+    out_path = os.path.join(chunk_path, CHUNK_BLOB)
+    if os.path.exists(out_path) and not overwrite:
+        return None
+
+    raw_img = imageio.imread(os.path.join(chunk_path, 'raw_img.png'))
+    h, bw, ch = raw_img.shape
+    raw_img = raw_img.reshape(h, chunk_size, -1, ch).transpose((1, 0, 2, 3))
+
+    depth_alpha = imageio.imread(os.path.join(chunk_path, 'depth_alpha.jpg'))
+    depth_alpha = depth_alpha.reshape(h * 2, chunk_size, -1).transpose((1, 0, 2))
+    depth, alpha = np.split(depth_alpha, 2, axis=1)
+
+    # Same un-projection as read_chunk, stored as float16 so no further 8-bit quantization happens
+    d_near_far = np.load(os.path.join(chunk_path, 'd_near_far.npy'))
+    d_near = d_near_far[0].reshape(chunk_size, 1, 1)
+    d_far = d_near_far[1].reshape(chunk_size, 1, 1)
+    depth = 1 / ((depth / 255) * (d_far - d_near) + d_near)
+    depth[depth > 2.9] = 0.0
+
+    arrays = dict(
+        raw_img=raw_img,
+        depth=depth.astype(np.float16),
+        alpha=alpha,
+        c=np.load(os.path.join(chunk_path, 'c.npy')),
+        d_near_far=d_near_far,
+        bbox=np.load(os.path.join(chunk_path, 'bbox.npy')),
+    )
+    normal_path = os.path.join(chunk_path, 'normal.png')
+    if os.path.exists(normal_path):
+        arrays['normal'] = imageio.imread(normal_path).reshape(h, chunk_size, -1, 3).transpose((1, 0, 2, 3))
+
+    with open(os.path.join(chunk_path, 'caption_3dtopia.txt'), 'r', encoding="utf-8") as f:
+        caption = f.read()
+    with open(os.path.join(chunk_path, 'ins.txt'), 'r', encoding="utf-8") as f:
+        ins = f.read()
+
+    write_chunk_blob(out_path, arrays, caption, ins, compression=compression)
+    return out_path
+
+
+def _convert_one(chunk_path, **kwargs):
+    try:
+        return convert_chunk(chunk_path, **kwargs), None
+    except Exception as e:
+        return None, f'{chunk_path}: {e}'
+
+
+def convert_dataset(data_dir: str, compression: str = 'lz4', workers: int = 8, overwrite: bool = False):
+    """Convert every chunk listed in <data_dir>/dataset.json"""
+    from datasets.dataset_index import DatasetIndex
+
+    chunk_paths = [os.path.join(data_dir, p) for p in DatasetIndex.load(data_dir).chunk_list('all')]
+    fn = partial(_convert_one, compression=compression, overwrite=overwrite)
+    converted, errors = 0, []
+    with Pool(workers) as pool:
+        for out_path, err in tqdm(pool.imap_unordered(fn, chunk_paths, chunksize=16), total=len(chunk_paths), desc='converting chunks'):
+            converted += out_path is not None
+            if err is not None:
+                errors.append(err)
+    print(f'converted {converted} / {len(chunk_paths)} chunks ({len(errors)} failed)')
+    for err in errors[:20]:
+        print(f'  {err}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert PNG/JPEG chunks into raw (LZ4) chunk blobs')
+    parser.add_argument('--data_dir', type=str, required=True)
+    parser.add_argument('--compression', type=str, default='lz4', choices=['lz4', 'none'])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--overwrite', action='store_true')
+    opts = parser.parse_args()
+    convert_dataset(opts.data_dir, compression=opts.compression, workers=opts.workers, overwrite=opts.overwrite)
@@ -0,0 +1,169 @@
+"""
+Index of the instances listed in <dataset>/dataset.json.
+
+The manifest maps every category to a list of instance paths. It is parsed once, and the
+instances of the training categories are cached next to it in a compact binary file keyed by the
+manifest's path, size, mtime and the categories, so every rank, dataloader worker and dataset
+variant reads the same small file instead of re-parsing the full json per category. Only a stat of
+the manifest is needed to find the cache; its contents are read (and hashed) when the key changes.
+
+Cache layout (.dataset_index_<key>.bin):
+    8 bytes     magic b'SAR3DIDX'
+    4 bytes     little-endian uint32, length of the JSON header
+    header      JSON: version, manifest_key, manifest_hash, categories [[name, count], ...]
+    paths       utf-8 instance paths joined by '\n', category after category
+"""
+
+import hashlib
+import json
+import os
+import struct
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+MAGIC = b'SAR3DIDX'
+VERSION = 2
+MANIFEST = 'dataset.json'
+
+# Categories used for training and evaluation, around 17W instances in total
+CATEGORIES = (
+    'Furnitures',
+    'daily-used',
+    'Animals',
+    'Food',
+    'Plants',
+    'Electronics',
+    'BuildingsOutdoor',
+    'Transportations_tar',
+    'Human-Shape',
+)
+
+# Instances of every category that belong to a split (the last 100 per category are held out for eval)
+SPLITS = {
+    'train': slice(None, -100),
+    'eval': slice(-100, None),
+    'all': slice(None),
+    'debug': slice(0, 10),
+}
+
+# Indexes already loaded in this process, keyed by manifest_key
+_loaded: Dict[str, 'DatasetIndex'] = {}
+
+
+def manifest_key(manifest_path: str, categories: Sequence[str]) -> str:
+    """sha1 of the manifest's absolute path, size, mtime_ns and the selected categories (a stat, no read)"""
+    st = os.stat(manifest_path)
+    h = hashlib.sha1(f'{os.path.abspath(manifest_path)}\n{st.st_size}\n{st.st_mtime_ns}\n'.encode('utf-8'))
+    h.update('\n'.join(categories).encode('utf-8'))
+    return h.hexdigest()
+
+
+def manifest_hash(manifest_path: str, categories: Sequence[str]) -> str:
+    """sha1 of the manifest bytes and the selected categories"""
+    h = hashlib.sha1()
+    with open(manifest_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            h.update(block)
+    h.update('\n'.join(categories).encode('utf-8'))
+    return h.hexdigest()
+
+
+class DatasetIndex:
+    """
+    Instance paths of the selected categories of one dataset.json.
+
+    Args:
+        categories: (name, instance paths) for every category, in order
+        manifest_hash: Hash of the manifest contents the paths were read from
+        manifest_key: manifest_key of the manifest when it was read
+    """
+    def __init__(self, categories: List[Tuple[str, List[str]]], manifest_hash: str, manifest_key: str = ''):
+        self.categories = categories
+        self.manifest_hash = manifest_hash
+        self.manifest_key = manifest_key
+
+    @classmethod
+    def load(cls, file_path: str, categories: Sequence[str] = CATEGORIES, cache_dir: Optional[str] = None) -> 'DatasetIndex':
+        """
+        Index of <file_path>/dataset.json, read from the binary cache when it matches the manifest.
+
+        Args:
+            file_path: Dataset root holding dataset.json
+            categories: Categories to index
+            cache_dir: Where the cache file lives, defaults to file_path (skipped if not writable)
+        """
+        manifest_path = os.path.join(file_path, MANIFEST)
+        key = manifest_key(manifest_path, categories)
+        if key in _loaded:
+            return _loaded[key]
+
+        cache_path = os.path.join(cache_dir or file_path, f'.dataset_index_{key[:16]}.bin')
+        index = cls._read_cache(cache_path, key)
+        if index is None:
+            # The manifest changed (or was never indexed): parse and hash it once, then cache
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+            index = cls([(c, list(manifest[c])) for c in categories], manifest_hash(manifest_path, categories), key)
+            index._write_cache(cache_path)
+
+        _loaded[key] = index
+        return index
+
+    @classmethod
+    def _read_cache(cls, cache_path: str, key: str) -> Optional['DatasetIndex']:
+        if not os.path.isfile(cache_path):
+            return None
+        with open(cache_path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            header_len, = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(header_len).decode('utf-8'))
+            if header['version'] != VERSION or header['manifest_key'] != key:
+                return None
+            paths = f.read().decode('utf-8').split('\n')
+
+        categories, cur = [], 0
+        for name, count in header['categories']:
+            categories.append((name, paths[cur:cur + count]))
+            cur += count
+        return cls(categories, header['manifest_hash'], key)
+
+    def _write_cache(self, cache_path: str):
+        paths = [p for _, entries in self.categories for p in entries]
+        assert all('\n' not in p for p in paths), 'instance paths must not contain newlines'
+        header = json.dumps(dict(
+            version=VERSION, manifest_key=self.manifest_key, manifest_hash=self.manifest_hash,
+            categories=[[name, len(entries)] for name, entries in self.categories],
+        )).encode('utf-8')
+
+        # Every rank may get here at once: write to a private file and rename, a read-only dataset dir just skips the cache
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(MAGIC)
+                f.write(struct.pack('<I', len(header)))
+                f.write(header)
+                f.write('\n'.join(paths).encode('utf-8'))
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f'[DatasetIndex] not caching the index at {cache_path}: {e}')
+
+    def chunk_list(self, split: str = 'all') -> List[str]:
+        """Instance paths of a split (see SPLITS), category after category"""
+        sl = SPLITS[split]
+        return [p for _, entries in self.categories for p in entries[sl]]
+
+    def category_counts(self, split: str = 'all') -> Dict[str, int]:
+        """Number of instances of every category in a split"""
+        sl = SPLITS[split]
+        return {name: len(entries[sl]) for name, entries in self.categories}
+
+    def split_sizes(self) -> Dict[str, int]:
+        """Number of instances in every split"""
+        return {split: sum(self.category_counts(split).values()) for split in SPLITS}
+
+    def __len__(self):
+        return sum(len(entries) for _, entries in self.categories)
+
+    def __repr__(self):
+        return f'{type(self).__name__}(hash={self.manifest_hash[:16]}, instances={len(self)}, splits={self.split_sizes()})'
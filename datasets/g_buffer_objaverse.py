@@ -16,9 +16,14 @@ import torch
 from torch.utils.data import DataLoader, Dataset
 from torchvision import transforms
 from torch.utils.data.distributed import DistributedSampler
+from utils.data_sampler import DistShardedInfiniteBatchSampler
 from pathlib import Path
 import lz4.frame
-from nsr.volumetric_rendering.ray_sampler import RaySampler
+from nsr.volumetric_rendering.ray_sampler import RaySampler, gen_rays_batch, plucker_rays
+from datasets.latent_shards import LatentShardDataset
+from datasets.dataset_index import DatasetIndex
+from datasets.chunk_cache import ChunkDecodeCache
+from datasets.chunk_format import CHUNK_BLOB, CHUNK_FORMATS, read_chunk_blob
 import point_cloud_utils as pcu
 
 import torch.multiprocessing
@@ -119,35 +124,13 @@ class PostProcess:
         self.ray_sampler = RaySampler()
 
     def gen_rays(self, c):
-        intrinsics, c2w = c[16:], c[:16].reshape(4, 4)
         self.h = self.reso_encoder
         self.w = self.reso_encoder
-        yy, xx = torch.meshgrid(
-            torch.arange(self.h, dtype=torch.float32) + 0.5,
-            torch.arange(self.w, dtype=torch.float32) + 0.5,
-            indexing='ij')
-
-        yy = yy / self.h
-        xx = xx / self.w
-
-        cx, cy, fx, fy = intrinsics[2], intrinsics[5], intrinsics[0], intrinsics[4]
-
-        c2w = torch.from_numpy(c2w).float()
-
-        xx = (xx - cx) / fx
-        yy = (yy - cy) / fy
-        zz = torch.ones_like(xx)
-        dirs = torch.stack((xx, yy, zz), dim=-1)  
-        dirs /= torch.norm(dirs, dim=-1, keepdim=True)
-        dirs = dirs.reshape(-1, 3, 1)
-        del xx, yy, zz
-        dirs = (c2w[None, :3, :3] @ dirs)[..., 0]
-
-        origins = c2w[None, :3, 3].expand(self.h * self.w, -1).contiguous()
-        origins = origins.view(self.h, self.w, 3)
-        dirs = dirs.view(self.h, self.w, 3)
-
-        return origins, dirs
+        c = torch.from_numpy(c).float()[None]
+        intrinsics = c[:, 16:]
+        origins, dirs = gen_rays_batch(c[:, :16].reshape(1, 4, 4), intrinsics[:, 0], intrinsics[:, 4],
+                                       intrinsics[:, 2], intrinsics[:, 5], self.reso_encoder)
+        return origins[0], dirs[0]
 
     def _post_process_batch_sample(self, sample):
         caption, ins = sample[-2:]
@@ -260,14 +243,8 @@ class PostProcess:
         return c
 
     def get_plucker_ray(self, c):
-        rays_plucker = []
-        for idx in range(c.shape[0]):
-            rays_o, rays_d = self.gen_rays(c[idx])
-            rays_plucker.append(
-                torch.cat([torch.cross(rays_o, rays_d, dim=-1), rays_d],
-                          dim=-1).permute(2, 0, 1))
-        rays_plucker = torch.stack(rays_plucker, 0)
-        return rays_plucker
+        # all views of the chunk in one batched pass
+        return plucker_rays(torch.from_numpy(c).float(), self.reso_encoder)
 
     def _post_process_sample_batch(self, data_sample):
         alpha = None
@@ -355,6 +332,104 @@ class PostProcess:
         return (img_to_encoder, img, alpha, depth_reso, c,
                 torch.from_numpy(bbox))
 
+    def paired_post_process_chunk_raw(self, sample):
+        """
+        Worker-side part of the GPU post-processing (see post_process_batch_gpu): only the cheap camera and
+        bbox bookkeeping runs here, images and depth stay uint8.
+        """
+        raw_img, depth, c, alpha, bbox, d_near_far, caption, ins = sample
+        assert raw_img.shape[0] == self.chunk_size and raw_img.shape[1] == self.reso_encoder
+        assert not self.gs_cam_format and not self.load_pcd, 'GPU post-processing supports neither gs_cam_format nor load_pcd'
+
+        if self.reso < 256:
+            bbox = (bbox * (self.reso / 256)).astype(np.uint8)
+        else:
+            bbox = bbox.astype(np.uint8)
+
+        if self.frame_0_as_canonical:
+            c_for_encoder = self.normalize_camera(c, for_encoder=True)
+            c_for_render = np.concatenate([
+                self.normalize_camera(c, for_encoder=False, canonical_idx=0),
+                self.normalize_camera(c, for_encoder=False, canonical_idx=self.V),
+            ], axis=-1)
+        else:
+            c_for_encoder, c_for_render = c, c
+
+        raw = {
+            'raw_img': torch.from_numpy(np.ascontiguousarray(raw_img)),
+            'depth': torch.from_numpy(np.ascontiguousarray(depth)),
+            'alpha': torch.from_numpy(np.ascontiguousarray(alpha)),
+            'c_for_encoder': torch.from_numpy(c_for_encoder).float(),
+            'c': torch.from_numpy(c_for_render).float(),
+            'bbox': torch.from_numpy(bbox),
+            'caption': caption,
+            'ins': ins,
+        }
+        if d_near_far is not None:
+            raw['d_near_far'] = torch.from_numpy(d_near_far).float()
+        return raw
+
+    @torch.no_grad()
+    def post_process_batch_gpu(self, batch, device):
+        """
+        Batched GPU version of paired_post_process_chunk + create_dict_nobatch + chunk_collate_fn.
+
+        Args:
+            batch: Collated outputs of paired_post_process_chunk_raw, (B, chunk_size, ...) uint8 images and depth
+                (float16 un-projected depth for converted chunks)
+            device: Device to run on
+
+        Returns:
+            The same dict chunk_collate_fn returns for the CPU path, on device
+        """
+        B, N = batch['raw_img'].shape[:2]
+        to_dev = lambda k: batch[k].to(device, non_blocking=True).flatten(0, 1)
+
+        # Un-project depth from uint8, background as 0 (converted chunks carry un-projected depth)
+        depth = to_dev('depth').float()
+        if 'd_near_far' in batch:
+            d_near_far = batch['d_near_far'].to(device, non_blocking=True)
+            d_near = d_near_far[:, 0].reshape(B * N, 1, 1)
+            d_far = d_near_far[:, 1].reshape(B * N, 1, 1)
+            depth = 1 / ((depth / 255) * (d_far - d_near) + d_near)
+            depth[depth > 2.9] = 0.0
+        depth_reso, _ = resize_depth_mask_Tensor(depth, self.reso)
+
+        alpha = to_dev('alpha').float() / 255.0
+        if alpha.shape[-1] != self.reso:
+            alpha = torch.nn.functional.interpolate(alpha.unsqueeze(1), size=(self.reso, self.reso), mode='bilinear', align_corners=False).squeeze(1)
+
+        raw_img = to_dev('raw_img').permute(0, 3, 1, 2).float() / 255.0
+        img_to_encoder = self.normalize(raw_img)
+        if raw_img.shape[-1] != self.reso:
+            img = torch.nn.functional.interpolate(raw_img, size=(self.reso, self.reso), mode='bilinear', align_corners=False) * 2 - 1
+        else:
+            img = raw_img * 2 - 1
+
+        if self.plucker_embedding:
+            img_to_encoder = torch.cat([img_to_encoder, plucker_rays(to_dev('c_for_encoder'), self.reso_encoder)], 1)
+        if self.append_depth:
+            img_to_encoder = torch.cat([img_to_encoder, depth.unsqueeze(1)], 1)
+
+        # Pair the two halves of every chunk: canonical views keep the frame order, novel views swap the halves
+        def pair(x):
+            x = x.reshape(B, 2, self.V, *x.shape[1:])
+            return x.flatten(0, 2).contiguous(), x.flip(1).flatten(0, 2).contiguous()
+
+        c = batch['c'].to(device, non_blocking=True).reshape(B, 2, self.V, -1)
+        if self.frame_0_as_canonical:
+            cano_c = torch.stack([c[:, 0, :, :25], c[:, 1, :, 25:]], 1).flatten(0, 2)
+            nv_c = torch.stack([c[:, 1, :, :25], c[:, 0, :, 25:]], 1).flatten(0, 2)
+        else:
+            cano_c, nv_c = pair(c.flatten(0, 2))
+
+        ret_dict = {}
+        for k, v in (('img_to_encoder', img_to_encoder), ('img', img), ('depth_mask', alpha), ('depth', depth_reso),
+                     ('bbox', to_dev('bbox').float())):
+            ret_dict[k], ret_dict[f'nv_{k}'] = pair(v)
+        ret_dict.update(c=cano_c.contiguous(), nv_c=nv_c.contiguous(), caption=batch['caption'], ins=batch['ins'])
+        return ret_dict
+
     def rand_sample_idx(self):
         return random.randint(0, self.instance_data_length - 1)
 
@@ -748,6 +823,12 @@ def load_data_3D_VAR(
         eval=False,
         load_whole=True,
         text_conditioned=False,
+        latent_shard_dir=None,
+        chunk_format='png',
+        shard_size=0,
+        start_ep=0,
+        start_it=0,
+        seed=0,
         **kwargs):
     """
     Load 3D data with various dataset formats and configurations.
@@ -768,6 +849,13 @@ def load_data_3D_VAR(
         infi_sampler: Whether to use infinite sampler
         eval: Whether in evaluation mode
         load_whole: Whether to load whole dataset
+        latent_shard_dir: Read the training latents from shards packed by datasets/latent_shards.py
+            instead of the per-instance .npy files (training with load_whole=False only)
+        chunk_format: On-disk chunk layout, 'png' (PNG/JPEG tiles) or 'lz4' (blobs written by datasets/chunk_format.py)
+        shard_size: >0: locality-aware DistShardedInfiniteBatchSampler over shards of this many neighbouring
+            instances instead of DistributedSampler (training only, yields batches forever)
+        start_ep, start_it: Resume position for the sharded sampler
+        seed: Seed of the sharded sampler's shard / in-shard permutations
     """
 
     collate_fn = None
@@ -785,22 +873,44 @@ def load_data_3D_VAR(
             collate_fn = chunk_collate_fn
 
     # Initialize dataset
-    dataset = dataset_cls(
-        file_path,
-        reso,
-        reso_encoder,
-        test=False,
-        preprocess=preprocess,
-        load_depth=load_depth,
-        imgnet_normalize=imgnet_normalize,
-        dataset_size=dataset_size,
-        load_whole=load_whole,
-        text_conditioned=text_conditioned,
-        **kwargs
-    )
+    if latent_shard_dir is not None:
+        assert not eval and not load_whole, 'latent shards only hold the AR training latents'
+        dataset = LatentShardDataset(latent_shard_dir, text_conditioned=text_conditioned, dataset_size=dataset_size)
+    else:
+        dataset = dataset_cls(
+            file_path,
+            reso,
+            reso_encoder,
+            test=False,
+            preprocess=preprocess,
+            load_depth=load_depth,
+            imgnet_normalize=imgnet_normalize,
+            dataset_size=dataset_size,
+            load_whole=load_whole,
+            text_conditioned=text_conditioned,
+            chunk_format=chunk_format,
+            **kwargs
+        )
 
     print(f'Dataset class: {trainer_name}, size: {len(dataset)}')
 
+    # Locality-aware sharded sampler: shuffles within neighbouring instances, resumes from start_it
+    if infi_sampler and shard_size > 0 and not eval:
+        world_size, rank = (torch.distributed.get_world_size(), torch.distributed.get_rank()) if torch.distributed.is_initialized() else (1, 0)
+        batch_sampler = DistShardedInfiniteBatchSampler(
+            world_size, rank, len(dataset), glb_batch_size=batch_size * world_size,
+            shard_size=shard_size, keys=getattr(dataset, 'chunk_list', None),
+            same_seed_for_all_ranks=seed, start_ep=start_ep, start_it=start_it,
+        )
+        return DataLoader(
+            dataset,
+            num_workers=num_workers,
+            pin_memory=True,
+            persistent_workers=num_workers > 0,
+            batch_sampler=batch_sampler,
+            collate_fn=collate_fn,
+        )
+
     # Create data loader with infinite sampler if requested
     if infi_sampler:
         train_sampler = DistributedSampler(
@@ -888,12 +998,16 @@ class ChunkObjaverseDataset(Dataset):
             load_pcd=False,
             load_whole=True,
             text_conditioned=False,
+            gt_BL_only=False,
+            chunk_format='png',
             **kwargs):
         super().__init__()
 
         # Basic configurations
         self.file_path = file_path
         self.chunk_size = 12
+        assert chunk_format in CHUNK_FORMATS, f'unknown {chunk_format=}'
+        self.chunk_format = chunk_format
         self.gs_cam_format = gs_cam_format
         self.frame_0_as_canonical = frame_0_as_canonical
         self.four_view_for_latent = four_view_for_latent
@@ -907,6 +1021,8 @@ class ChunkObjaverseDataset(Dataset):
         self.plucker_embedding = plucker_embedding
         self.load_whole = load_whole
         self.text_conditioned = text_conditioned
+        # Ship only the token indices, the trainer rebuilds x_BLCv_wo_first_l on the GPU
+        self.gt_BL_only = gt_BL_only
         # Get camera intrinsics
         self.intrinsics = get_intri(h=self.reso, w=self.reso, normalize=True).reshape(9)
         assert not self.classes, "Class conditioning not supported yet."
@@ -918,26 +1034,8 @@ class ChunkObjaverseDataset(Dataset):
         self.chunk_list = []
         self.img_ext = 'png'
 
-        # Load dataset json
-        dataset_json = []
-        categories = [
-                    'Furnitures',
-                    'daily-used',
-                    'Animals',
-                    'Food',
-                    'Plants',
-                    'Electronics',
-                    'BuildingsOutdoor',
-                    'Transportations_tar',
-                    'Human-Shape',]
-        for category in categories:
-            with open(f'{self.file_path}/dataset.json', 'r') as f:
-                category_data = json.load(f)[category][:-100]
-                dataset_json.extend(category_data)
-
-        # Build chunk list
-        for item in dataset_json:
-            self.chunk_list.append(item)
+        # Build chunk list from the cached dataset.json index
+        self.chunk_list = DatasetIndex.load(self.file_path).chunk_list('train')
 
         # Initialize post-processing
         self.post_process = PostProcess(
@@ -967,6 +1065,9 @@ class ChunkObjaverseDataset(Dataset):
         Returns:
             Tuple containing processed images, depth maps, camera params, etc.
         """
+        if self.chunk_format == 'lz4':
+            return read_chunk_lz4(chunk_path)
+
         # Load and reshape raw image
         raw_img = imageio.imread(os.path.join(chunk_path, f'raw_img.{self.img_ext}'))
         h, bw, c = raw_img.shape
@@ -1007,15 +1108,18 @@ class ChunkObjaverseDataset(Dataset):
             Updated sample dict with latent codes
         """
         # Load latent codes and embeddings
-        gt_BL = torch.from_numpy(np.load(os.path.join(latent_path, "gt_BL_dim_8_l2norm_lrm_256.npy")))
-        x_BLCv_wo_first_l = torch.from_numpy(np.load(os.path.join(latent_path, "x_BLCv_wo_first_l_dim_8_l2_norm_lrm_256.npy")))
+        gt_BL = np.load(os.path.join(latent_path, "gt_BL_dim_8_l2norm_lrm_256.npy"))
+        if self.gt_BL_only:
+            # uint16 bits carried in an int16 tensor (torch has no uint16), decoded by VARTrainer.get_teacher_forcing_input
+            sample['gt_BL'] = torch.from_numpy(gt_BL.astype(np.uint16).view(np.int16))
+        else:
+            sample['gt_BL'] = torch.from_numpy(gt_BL)
+            sample['x_BLCv_wo_first_l'] = torch.from_numpy(np.load(os.path.join(latent_path, "x_BLCv_wo_first_l_dim_8_l2_norm_lrm_256.npy")))
         if self.text_conditioned:
             text_embedding = torch.from_numpy(np.load(os.path.join(latent_path, "text_embedding_lrm_3dtopia.npy")))
             text_pooler_ouput = torch.from_numpy(np.load(os.path.join(latent_path, "text_pooler_output_lrm_3dtopia.npy")))
 
             sample.update({
-                'gt_BL': gt_BL,
-                'x_BLCv_wo_first_l': x_BLCv_wo_first_l,
                 'text_embedding': text_embedding,
                 'text_pooler_output': text_pooler_ouput})
         else:
@@ -1027,8 +1131,6 @@ class ChunkObjaverseDataset(Dataset):
 
             # Update sample dict
             sample.update({
-                'gt_BL': gt_BL,
-                'x_BLCv_wo_first_l': x_BLCv_wo_first_l,
                 'image_dino_pooler_output': image_dino_pooler_output,
                 'image_dino_embedding': image_dino_embedding,
             })
@@ -1092,6 +1194,7 @@ class ChunkObjaverseDataset_eval(Dataset):
             load_pcd=False,
             load_whole=True,
             text_conditioned=False,
+            chunk_format='png',
             **kwargs):
 
         super().__init__()
@@ -1099,6 +1202,8 @@ class ChunkObjaverseDataset_eval(Dataset):
         # Basic configurations
         self.file_path = file_path
         self.chunk_size = 12
+        assert chunk_format in CHUNK_FORMATS, f'unknown {chunk_format=}'
+        self.chunk_format = chunk_format
         self.gs_cam_format = gs_cam_format
         self.frame_0_as_canonical = frame_0_as_canonical
         self.four_view_for_latent = four_view_for_latent
@@ -1124,25 +1229,8 @@ class ChunkObjaverseDataset_eval(Dataset):
         self.chunk_list = []
         self.img_ext = 'png'
 
-        # Load dataset json
-        dataset_json = []
-        for cl in [
-                    'Furnitures',
-                    'daily-used',
-                    'Animals',
-                    'Food',
-                    'Plants',
-                    'Electronics',
-                    'BuildingsOutdoor',
-                    'Transportations_tar',
-                    'Human-Shape',]:
-            with open(f'{self.file_path}/dataset.json', 'r') as f:
-                cl_dataset_json = json.load(f)[cl][-100:]
-            dataset_json.extend(cl_dataset_json)
-
-        # Build chunk list
-        for v in dataset_json:
-            self.chunk_list.append(v)
+        # Build chunk list from the cached dataset.json index
+        self.chunk_list = DatasetIndex.load(self.file_path).chunk_list('eval')
 
         # Initialize post processor
         self.post_process = PostProcess(
@@ -1173,6 +1261,9 @@ class ChunkObjaverseDataset_eval(Dataset):
         return []
 
     def read_chunk(self, chunk_path):
+        if self.chunk_format == 'lz4':
+            return read_chunk_lz4(chunk_path)
+
         # Load raw image and reshape
         raw_img = imageio.imread(os.path.join(chunk_path, f'raw_img.{self.img_ext}'))
         h, bw, c = raw_img.shape
@@ -1267,10 +1358,16 @@ def load_data(
     trainer_name='input_rec',
     infi_sampler=True,
     eval=False,
+    gpu_post_process=False,
+    chunk_format='png',
     **kwargs
 ):
+    # gpu_post_process: workers return raw uint8 chunks, resizing, normalization, depth un-projection and
+    # Plucker rays run batched on the current GPU (training set only, the yielded dicts are unchanged)
+    # chunk_format: 'png' (PNG/JPEG tiles) or 'lz4' (blobs written by datasets/chunk_format.py)
+    gpu_post_process = gpu_post_process and not eval
     dataset_cls = ChunkObjaverseDataset_eval_VAE if eval else ChunkObjaverseDataset_VAE
-    collate_fn = chunk_collate_fn
+    collate_fn = torch.utils.data.default_collate if gpu_post_process else chunk_collate_fn
 
     dataset = dataset_cls(
         file_path,
@@ -1281,6 +1378,8 @@ def load_data(
         load_depth=load_depth,
         imgnet_normalize=imgnet_normalize,
         dataset_size=dataset_size,
+        gpu_post_process=gpu_post_process,
+        chunk_format=chunk_format,
         **kwargs
     )
 
@@ -1298,8 +1397,14 @@ def load_data(
             sampler=train_sampler,
             collate_fn=collate_fn,
         )
-        while True:
-            yield from loader
+        if gpu_post_process:
+            device = torch.device('cuda', torch.cuda.current_device())
+            while True:
+                for batch in loader:
+                    yield dataset.post_process.post_process_batch_gpu(batch, device)
+        else:
+            while True:
+                yield from loader
 
 class ChunkObjaverseDataset_VAE(Dataset):
     def __init__(
@@ -1330,13 +1435,23 @@ class ChunkObjaverseDataset_VAE(Dataset):
             append_depth=True,
             pcd_path=None,
             load_pcd=False,
+            gpu_post_process=False,
+            decode_cache_dir=None,
+            decode_cache_gb=32,
+            chunk_format='png',
             **kwargs):
 
         super().__init__()
         
         self.read_normal = True
+        # Return raw uint8 chunks, post-processed per batch on the GPU by load_data
+        self.gpu_post_process = gpu_post_process
+        # Decoded images shared by all workers of the node, see datasets/chunk_cache.py
+        self.decode_cache = ChunkDecodeCache(decode_cache_dir, decode_cache_gb) if decode_cache_dir else None
         self.file_path = file_path
         self.chunk_size = 12
+        assert chunk_format in CHUNK_FORMATS, f'unknown {chunk_format=}'
+        self.chunk_format = chunk_format
         self.gs_cam_format = gs_cam_format
 
         self.frame_0_as_canonical = frame_0_as_canonical
@@ -1362,27 +1477,10 @@ class ChunkObjaverseDataset_VAE(Dataset):
 
         # ! load all chunk paths
         self.chunk_list = []
-        # ! direclty load from json
-        dataset_json = []
-        for cl in [  # ! around 17W instances in total. 
-                    'Furnitures',
-                    'daily-used',
-                    'Animals',
-                    'Food',
-                    'Plants',
-                    'Electronics',
-                    'BuildingsOutdoor',
-                    'Transportations_tar',
-                    'Human-Shape',
-            ]:
-            with open(f'{self.file_path}/dataset.json', 'r') as f:
-                cl_dataset_json = json.load(f)[cl]
-            dataset_json = dataset_json + cl_dataset_json
-
+        # ! load from the cached dataset.json index
         if self.chunk_size == 12:
             self.img_ext = 'png' # ln3diff
-            for v in dataset_json:
-                self.chunk_list.append(v)
+            self.chunk_list = DatasetIndex.load(self.file_path).chunk_list('all')
 
 
         self.post_process = PostProcess(
@@ -1416,13 +1514,21 @@ class ChunkObjaverseDataset_VAE(Dataset):
         # e.g., remove bottom view
         pass
 
+    def imread(self, path):
+        if self.decode_cache is not None:
+            return self.decode_cache.imread(path)
+        return imageio.imread(path)
+
     def read_chunk(self, chunk_path):
-        raw_img = imageio.imread(os.path.join(chunk_path, f'raw_img.{self.img_ext}'))
+        if self.chunk_format == 'lz4':
+            return read_chunk_lz4(chunk_path, read_normal=self.read_normal)
+
+        raw_img = self.imread(os.path.join(chunk_path, f'raw_img.{self.img_ext}'))
         h, bw, c = raw_img.shape
         raw_img = raw_img.reshape(h, self.chunk_size, -1, c).transpose(
             (1, 0, 2, 3))
 
-        depth_alpha = imageio.imread(
+        depth_alpha = self.imread(
             os.path.join(chunk_path, 'depth_alpha.jpg'))  # 2h 10w
         depth_alpha = depth_alpha.reshape(h * 2, self.chunk_size,
                                           -1).transpose((1, 0, 2))
@@ -1447,7 +1553,7 @@ class ChunkObjaverseDataset_VAE(Dataset):
             ins = f.read()
 
         if self.read_normal:
-            normal = imageio.imread(os.path.join(
+            normal = self.imread(os.path.join(
                 chunk_path, 'normal.png')).astype(np.float32) / 255.0
 
             normal = (normal * 2 - 1).reshape(h, self.chunk_size, -1,
@@ -1457,10 +1563,48 @@ class ChunkObjaverseDataset_VAE(Dataset):
 
         return raw_img, depth, c, alpha, bbox, caption, ins
 
+    def read_chunk_raw(self, chunk_path):
+        """
+        read_chunk without the depth un-projection, depth stays uint8 next to its near/far planes (normals are not read).
+        Converted chunks carry un-projected float16 depth, d_near_far is None for them.
+        """
+        if self.chunk_format == 'lz4':
+            arrays, header = read_chunk_blob(os.path.join(chunk_path, CHUNK_BLOB))
+            return arrays['raw_img'], arrays['depth'], arrays['c'], arrays['alpha'], arrays['bbox'], None, header['caption'], header['ins']
+
+        raw_img = self.imread(os.path.join(chunk_path, f'raw_img.{self.img_ext}'))
+        h, bw, c = raw_img.shape
+        raw_img = raw_img.reshape(h, self.chunk_size, -1, c).transpose(
+            (1, 0, 2, 3))
+
+        depth_alpha = self.imread(
+            os.path.join(chunk_path, 'depth_alpha.jpg'))  # 2h 10w
+        depth_alpha = depth_alpha.reshape(h * 2, self.chunk_size,
+                                          -1).transpose((1, 0, 2))
+
+        depth, alpha = np.split(depth_alpha, 2, axis=1)
+
+        c = np.load(os.path.join(chunk_path, 'c.npy'))
+
+        d_near_far = np.load(os.path.join(chunk_path, 'd_near_far.npy'))
+        bbox = np.load(os.path.join(chunk_path, 'bbox.npy'))
+
+        with open(os.path.join(chunk_path, 'caption_3dtopia.txt'), 'r', encoding="utf-8") as f:
+            caption = f.read()
+
+        with open(os.path.join(chunk_path, 'ins.txt'), 'r', encoding="utf-8") as f:
+            ins = f.read()
+
+        return raw_img, depth, c, alpha, bbox, d_near_far, caption, ins
+
     def __len__(self):
         return len(self.chunk_list)
 
     def __getitem__(self, index) -> Any:
+        if self.gpu_post_process:
+            sample = self.read_chunk_raw(os.path.join(self.file_path, self.chunk_list[index]))
+            return self.post_process.paired_post_process_chunk_raw(sample)
+
         sample = self.read_chunk(os.path.join(self.file_path, self.chunk_list[index]))
         sample = self.post_process.paired_post_process_chunk(sample)
         sample = self.post_process.create_dict_nobatch(sample)
@@ -1499,12 +1643,15 @@ class ChunkObjaverseDataset_eval_VAE(Dataset):
             append_depth=True,
             pcd_path=None,
             load_pcd=False,
+            chunk_format='png',
             **kwargs):
 
         super().__init__()
         # st()
         self.file_path = file_path
         self.chunk_size = 12
+        assert chunk_format in CHUNK_FORMATS, f'unknown {chunk_format=}'
+        self.chunk_format = chunk_format
         self.gs_cam_format = gs_cam_format
         self.frame_0_as_canonical = frame_0_as_canonical
         self.four_view_for_latent = four_view_for_latent 
@@ -1530,27 +1677,9 @@ class ChunkObjaverseDataset_eval_VAE(Dataset):
         # ! load all chunk paths
         self.chunk_list = []
 
-        dataset_json = []
-        for cl in [  # ! around 17W instances in total. 
-                    'Furnitures',
-                    'daily-used',
-                    'Animals',
-                    'Food',
-                    'Plants',
-                    'Electronics',
-                    'BuildingsOutdoor',
-                    'Transportations_tar',
-                    'Human-Shape',
-            ]:
-            with open(f'{self.file_path}/dataset.json', 'r') as f:
-                cl_dataset_json = json.load(f)[cl][0:10]
-            dataset_json = dataset_json + cl_dataset_json
-
-    
         if self.chunk_size == 12:
             self.img_ext = 'png' # ln3diff
-            for v in dataset_json:
-                self.chunk_list.append(v)
+            self.chunk_list = DatasetIndex.load(self.file_path).chunk_list('debug')
 
 
         self.post_process = PostProcess(
@@ -1584,6 +1713,9 @@ class ChunkObjaverseDataset_eval_VAE(Dataset):
 
 
     def read_chunk(self, chunk_path):
+        if self.chunk_format == 'lz4':
+            return read_chunk_lz4(chunk_path)
+
         raw_img = imageio.imread(os.path.join(chunk_path, f'raw_img.{self.img_ext}'))
         h, bw, c = raw_img.shape
         raw_img = raw_img.reshape(h, self.chunk_size, -1, c).transpose(
@@ -1629,4 +1761,23 @@ def unity2blender_fix(normal): # up blue, left green, front (towards inside) red
     normal_clone[..., 1] = -normal[..., 2]
     normal_clone[..., 2] = normal[..., 1]
 
-    return normal_clone
\ No newline at end of file
+    return normal_clone
+
+
+def read_chunk_lz4(chunk_path, read_normal=False):
+    """read_chunk for chunks converted by datasets/chunk_format.py, returns the same tuple as the PNG/JPEG readers"""
+    arrays, header = read_chunk_blob(os.path.join(chunk_path, CHUNK_BLOB))
+    depth = arrays['depth'].astype(np.float32)
+    if read_normal:
+        if 'normal' in arrays:
+            normal = arrays['normal']
+        else:
+            # the converter skips normal.png when it is missing, chunks that got one later keep it next to the blob
+            normal_path = os.path.join(chunk_path, 'normal.png')
+            if not os.path.exists(normal_path):
+                raise FileNotFoundError(f'{chunk_path} has no normals: neither {CHUNK_BLOB} nor normal.png hold them')
+            N, h = arrays['raw_img'].shape[:2]
+            normal = imageio.imread(normal_path).reshape(h, N, -1, 3).transpose((1, 0, 2, 3))
+        normal = normal.astype(np.float32) / 255.0
+        depth = (depth, unity2blender_fix(normal * 2 - 1))
+    return arrays['raw_img'], depth, arrays['c'], arrays['alpha'], arrays['bbox'], header['caption'], header['ins']
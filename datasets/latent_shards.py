@@ -0,0 +1,142 @@
+"""
+Packed, memory-mapped latent shards for AR training.
+
+ChunkObjaverseDataset with load_whole=False opens 3-4 small .npy files per sample (token maps,
+teacher-forcing input and DINO/CLIP embeddings). pack_latent_shards writes all of them into a few large
+shard files of fixed-size records plus an index.json, and LatentShardDataset serves zero-copy
+np.memmap views of those records, so a sample costs page-cache reads instead of file opens.
+
+Layout of <out_dir>:
+    index.json          version, text_conditioned, record fields (dtype, shape), shards, per-sample keys
+    shard_00000.bin     records back to back, one aligned numpy structured record per sample
+
+Pack once per dataset:
+    python -m datasets.latent_shards --data_dir <dataset> --out_dir <shards> [--text_conditioned] [--gt_BL_only]
+"""
+
+import argparse
+import json
+import os
+from typing import Dict, List
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+
+INDEX_FILE = 'index.json'
+VERSION = 1
+
+
+def _record_dtype(fields: Dict[str, List]) -> np.dtype:
+    return np.dtype([(name, np.dtype(dt), tuple(shape)) for name, (dt, shape) in fields.items()], align=True)
+
+
+def pack_latent_shards(data_dir: str, out_dir: str, text_conditioned: bool = False, gt_BL_only: bool = False, samples_per_shard: int = 8192):
+    """
+    Pack the latents of every instance listed for ChunkObjaverseDataset into memory-mappable shards.
+
+    Args:
+        data_dir: Dataset root (the file_path of ChunkObjaverseDataset)
+        out_dir: Output directory for the shards and index.json
+        text_conditioned: Pack CLIP text embeddings instead of DINO image embeddings
+        gt_BL_only: Pack the uint16 token maps without x_BLCv_wo_first_l (rebuilt on the GPU by VARTrainer)
+        samples_per_shard: Records per shard file
+    """
+    from datasets.g_buffer_objaverse import ChunkObjaverseDataset
+
+    # Reuse the dataset's instance list and latent loading, so shards hold exactly what load_latent returns
+    dataset = ChunkObjaverseDataset(data_dir, reso=256, reso_encoder=224, load_whole=False, text_conditioned=text_conditioned, gt_BL_only=gt_BL_only)
+    keys = [os.path.join(data_dir, p) for p in dataset.chunk_list]
+    assert len(keys) > 0, f'no instances found under {data_dir}'
+    os.makedirs(out_dir, exist_ok=True)
+
+    fields, rec_dtype, shards = None, None, []
+    buf, f = None, None
+    for i, key in enumerate(tqdm(keys, desc='packing latents')):
+        sample = {k: v.numpy() for k, v in dataset.load_latent({}, key).items()}
+        if fields is None:
+            fields = {k: [v.dtype.str, list(v.shape)] for k, v in sample.items()}
+            rec_dtype = _record_dtype(fields)
+            buf = np.zeros((1,), dtype=rec_dtype)
+        for k, v in sample.items():
+            assert [v.dtype.str, list(v.shape)] == fields[k], f'{key}: {k} is {v.dtype.str}{list(v.shape)}, expected {fields[k]}'
+            buf[k][0] = v
+
+        if i % samples_per_shard == 0:
+            if f is not None:
+                f.close()
+            shards.append({'file': f'shard_{len(shards):05d}.bin', 'count': 0})
+            f = open(os.path.join(out_dir, shards[-1]['file']), 'wb')
+        f.write(buf.tobytes())
+        shards[-1]['count'] += 1
+    f.close()
+
+    # Write the index last, so a partially packed directory is never picked up
+    index = dict(version=VERSION, text_conditioned=text_conditioned, fields=fields, shards=shards, keys=keys)
+    tmp_path = os.path.join(out_dir, f'{INDEX_FILE}.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as fp:
+        json.dump(index, fp)
+    os.replace(tmp_path, os.path.join(out_dir, INDEX_FILE))
+    print(f'packed {len(keys)} samples into {len(shards)} shards ({rec_dtype.itemsize} bytes/sample) at {out_dir}')
+
+
+class LatentShardDataset(Dataset):
+    """
+    Serves the latents written by pack_latent_shards, with the same keys as
+    ChunkObjaverseDataset.load_latent (plus sample_path).
+
+    Args:
+        shard_dir: Directory with index.json and the shard files
+        text_conditioned: Must match how the shards were packed
+        dataset_size: Limit the number of samples (-1 for all)
+    """
+    def __init__(self, shard_dir: str, text_conditioned: bool = False, dataset_size: int = -1, **kwargs):
+        super().__init__()
+        with open(os.path.join(shard_dir, INDEX_FILE), 'r') as f:
+            self.index = json.load(f)
+        assert self.index['version'] <= VERSION, f'unsupported shard version {self.index["version"]}'
+        assert self.index['text_conditioned'] == text_conditioned, f'shards at {shard_dir} were packed with text_conditioned={self.index["text_conditioned"]}'
+        self.shard_dir = shard_dir
+        self.text_conditioned = text_conditioned
+        self.rec_dtype = _record_dtype(self.index['fields'])
+        self.keys = self.index['keys']
+
+        # Global sample index -> (shard, row)
+        self.shard_starts = np.cumsum([0] + [s['count'] for s in self.index['shards']])
+        self.size = int(self.shard_starts[-1]) if dataset_size < 0 else min(dataset_size, int(self.shard_starts[-1]))
+
+        # Opened lazily in every dataloader worker (memmaps do not survive pickling as views)
+        self.shards = None
+
+    def _open_shards(self):
+        # mode 'c' (copy-on-write) keeps the views writable for torch.from_numpy without touching the files
+        self.shards = [
+            np.memmap(os.path.join(self.shard_dir, s['file']), dtype=self.rec_dtype, mode='c', shape=(s['count'],))
+            for s in self.index['shards']
+        ]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if self.shards is None:
+            self._open_shards()
+        si = int(np.searchsorted(self.shard_starts, index, side='right')) - 1
+        shard, row = self.shards[si], index - int(self.shard_starts[si])
+
+        sample = {k: torch.from_numpy(np.asarray(shard[k][row])) for k in self.index['fields']}
+        sample['sample_path'] = self.keys[index]
+        return sample
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack per-instance AR latents into memory-mapped shards')
+    parser.add_argument('--data_dir', type=str, required=True)
+    parser.add_argument('--out_dir', type=str, required=True)
+    parser.add_argument('--text_conditioned', action='store_true')
+    parser.add_argument('--gt_BL_only', action='store_true')
+    parser.add_argument('--samples_per_shard', type=int, default=8192)
+    opts = parser.parse_args()
+    pack_latent_shards(opts.data_dir, opts.out_dir, text_conditioned=opts.text_conditioned, gt_BL_only=opts.gt_BL_only, samples_per_shard=opts.samples_per_shard)
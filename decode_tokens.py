@@ -0,0 +1,66 @@
+"""
+Re-decode stored token maps (.gbl files written by test.py with --save_BL, see utils/token_store.py)
+to triplanes, meshes and videos. Only the VQVAE decoder and the renderer run, the AR model is not sampled,
+so re-rendering a generation costs decoding only.
+
+Usage (model args as for test.py):
+    torchrun --nproc_per_node=1 decode_tokens.py --depth=24 --fp16=2 \
+        --vqvae_pretrained_path ./checkpoint/vqvae-ckpt.pt --ar_ckpt_path ./checkpoint/image-condition-ckpt.pth \
+        --token_path ./eval --save_path ./eval_decoded --decode_to render
+"""
+
+import os
+import sys
+
+import torch
+
+import utils.dist as dist
+from utils import arg_util, misc
+from utils.token_store import TOKEN_EXT, decode_tokens, load_tokens
+from test import build_everything, render_results
+
+
+def find_token_files(token_path: str):
+    """token_path itself if it is a file, otherwise every token file below it"""
+    if os.path.isfile(token_path):
+        return [token_path]
+    return sorted(
+        os.path.join(root, f)
+        for root, _, files in os.walk(token_path)
+        for f in files if f.endswith(TOKEN_EXT)
+    )
+
+
+def main_decode():
+    args = arg_util.init_dist_and_get_args()
+    assert args.token_path is not None, 'please specify --token_path'
+    assert args.decode_to in ('triplane', 'render'), f'unknown {args.decode_to=}'
+    args.save_BL = False    # tokens are already stored
+
+    token_files = find_token_files(args.token_path)
+    print(f"Found {len(token_files)} token files to decode")
+    sar3d = build_everything(args)
+
+    for token_file in token_files:
+        g_BL, header = load_tokens(token_file)
+        name = header['meta'].get('name', os.path.splitext(os.path.basename(token_file))[0])
+        save_dir = os.path.join(args.save_path, name)
+        os.makedirs(save_dir, exist_ok=True)
+
+        with torch.inference_mode():
+            triplane = decode_tokens(sar3d.var_wo_ddp, g_BL, header)
+            torch.save(triplane.float().cpu(), os.path.join(save_dir, 'triplane.pt'))
+            if args.decode_to == 'render':
+                print(f"mesh dumping and rendering {name}...")
+                render_results(args, sar3d, triplane, None, name, save_dir)
+        print(f"decoded {token_file} to {save_dir}")
+
+
+if __name__ == '__main__':
+    try:
+        main_decode()
+    finally:
+        dist.finalize()
+        if isinstance(sys.stdout, misc.SyncPrint) and isinstance(sys.stderr, misc.SyncPrint):
+            sys.stdout.close()
+            sys.stderr.close()
@@ -0,0 +1,174 @@
+"""
+Offline extraction of the AR training latents: encode every chunk with the VQVAE and write the files
+ChunkObjaverseDataset.load_latent reads, next to the chunk (or below --extract_out):
+
+    gt_BL_dim_8_l2norm_lrm_256.npy                  (3L,) multi-scale token indices
+    x_BLCv_wo_first_l_dim_8_l2_norm_lrm_256.npy     teacher-forcing input of VAR
+    image_dino_embedding_lrm.npy                    (257, 1024) DINOv2 pooled output, then the patch embeddings
+    text_embedding_lrm_3dtopia.npy                  (77, 768) CLIP embeddings of caption_3dtopia.txt
+    text_pooler_output_lrm_3dtopia.npy              (768,) CLIP pooled output
+
+Every rank takes a strided share of the instances and skips those whose files all exist, so an
+interrupted run resumes where it stopped. Files are written to a temporary name and renamed, the
+token map last, so a killed process never leaves a half-written instance behind.
+
+Usage (VQVAE args as for train.py):
+    torchrun --nproc_per_node=8 extract_latents.py --data_dir ./dataset \
+        --vqvae_pretrained_path ./checkpoint/vqvae-ckpt.pt --extract_bs 16 --num_workers 8
+"""
+
+import os
+import sys
+import time
+
+import imageio.v2 as imageio
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+import utils.dist as dist
+from datasets.chunk_format import CHUNK_BLOB, read_chunk_blob
+from datasets.dataset_index import DatasetIndex
+from datasets.g_buffer_objaverse import ChunkObjaverseDataset_VAE, chunk_collate_fn
+from models import build_vae_3D
+from nsr.script_util import dataset_defaults
+from utils import arg_util, misc
+from utils.cond_encoder import ConditionEncoder
+
+
+GT_BL_FILE = 'gt_BL_dim_8_l2norm_lrm_256.npy'
+X_BLCV_FILE = 'x_BLCv_wo_first_l_dim_8_l2_norm_lrm_256.npy'
+DINO_FILE = 'image_dino_embedding_lrm.npy'
+TEXT_FILE = 'text_embedding_lrm_3dtopia.npy'
+TEXT_POOLER_FILE = 'text_pooler_output_lrm_3dtopia.npy'
+
+
+def output_files(extract_cond: str):
+    """Files written per instance, the token map last (its presence marks a finished instance)"""
+    files = [X_BLCV_FILE]
+    if 'dino' in extract_cond:
+        files.append(DINO_FILE)
+    if 'clip' in extract_cond:
+        files += [TEXT_FILE, TEXT_POOLER_FILE]
+    return files + [GT_BL_FILE]
+
+
+def save_npy_atomic(path: str, arr: np.ndarray):
+    tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+    np.save(tmp_path, arr)
+    os.replace(tmp_path, path)
+
+
+def read_cond_image(chunk_path: str, view: int, chunk_format: str = 'png', chunk_size: int = 12) -> Image.Image:
+    """One rendered view of a chunk as RGB image, the DINO condition"""
+    if chunk_format == 'lz4':
+        raw_img = read_chunk_blob(os.path.join(chunk_path, CHUNK_BLOB))[0]['raw_img'][view]
+    else:
+        raw_img = imageio.imread(os.path.join(chunk_path, 'raw_img.png'))
+        raw_img = np.split(raw_img, chunk_size, axis=1)[view]
+    return Image.fromarray(np.ascontiguousarray(raw_img[..., :3]))
+
+
+def dataset_kwargs(cfg) -> dict:
+    """Dataset options set in the LN3DiffConfig the VQVAE was trained with, the others keep the dataset defaults"""
+    keys = set(dataset_defaults()) | {'frame_0_as_canonical', 'imgnet_normalize', 'dataset_size'}
+    return {k: getattr(cfg, k) for k in sorted(keys) if hasattr(cfg, k)}
+
+
+@torch.inference_mode()
+def encode_batch(vae, batch, B: int, V: int):
+    """
+    Multi-scale tokens of B instances, encoded from the first V (encoder) views of every instance.
+
+    Returns:
+        gt_BL: (B, 3L) token indices, planes of a scale after each other
+        x_BLCv_wo_first_l: (B, 3(L-1), Cvae) teacher-forcing input
+    """
+    # The canonical input views of every instance, as in the VQVAE eval loop
+    img = batch['img_to_encoder']
+    img = img.view(B, -1, *img.shape[1:])[:, :V].flatten(0, 1).to(dist.get_device(), non_blocking=True)
+    ms_idx = vae.img_to_idxBl(img)      # per scale (B*3, pn*pn)
+    gt_BL = torch.cat([idx.view(B, -1) for idx in ms_idx], dim=1)
+    x_BLCv_wo_first_l = vae.quantize.idxBl_to_var_input_triplane(gt_BL)
+    return gt_BL, x_BLCv_wo_first_l
+
+
+def main_extract():
+    args = arg_util.init_dist_and_get_args()
+    assert args.vqvae_pretrained_path is not None, 'please specify --vqvae_pretrained_path'
+    out_root = args.extract_out or args.data_dir
+    files = output_files(args.extract_cond)
+
+    # Strided share of this rank, minus the instances finished by an earlier run
+    chunk_list = DatasetIndex.load(args.data_dir).chunk_list('all')[dist.get_rank()::dist.get_world_size()]
+    pending = [p for p in chunk_list if not all(os.path.exists(os.path.join(out_root, p, f)) for f in files)]
+    print(f'[rank{dist.get_rank()}] {len(pending)} / {len(chunk_list)} instances to extract, writing {files} to {out_root}')
+
+    vae = build_vae_3D(dist.get_device(), args)
+    vae.load_state_dict(torch.load(args.vqvae_pretrained_path, map_location='cpu'), strict=True)
+    vae.eval()
+    cond_encoder = ConditionEncoder(device=dist.get_device()) if args.extract_cond else None
+
+    # Same dataset options as in VQVAE training, so the encoder sees the same views and camera conventions
+    cfg = args.LN3DiffConfig
+    dataset = ChunkObjaverseDataset_VAE(
+        args.data_dir, cfg.image_size, cfg.image_size_encoder,
+        load_depth=True, chunk_format=args.chunk_format, **dataset_kwargs(cfg),
+    )
+    dataset.chunk_list = pending
+    V = dataset.post_process.V      # encoder views per instance
+    # No shuffling, so batch i holds pending[i*bs:(i+1)*bs]
+    loader = DataLoader(
+        dataset, batch_size=args.extract_bs, shuffle=False, drop_last=False,
+        num_workers=max(args.num_workers, 0), pin_memory=True, collate_fn=chunk_collate_fn,
+    )
+
+    done, start = 0, time.time()
+    for bi, batch in enumerate(tqdm(loader, desc='extracting latents', disable=not dist.is_local_master())):
+        paths = pending[bi * args.extract_bs:(bi + 1) * args.extract_bs]
+        B = len(paths)
+        gt_BL, x_BLCv_wo_first_l = encode_batch(vae, batch, B, V)
+        gt_BL, x_BLCv_wo_first_l = gt_BL.cpu().numpy(), x_BLCv_wo_first_l.float().cpu().numpy()
+
+        dino_feats = text_feats = None
+        if 'dino' in args.extract_cond:
+            imgs = [read_cond_image(os.path.join(args.data_dir, p), args.extract_cond_view, args.chunk_format) for p in paths]
+            dino_feats = cond_encoder.encode_images(imgs, to_device=False)
+        if 'clip' in args.extract_cond:
+            text_feats = cond_encoder.encode_texts(list(batch['caption']), to_device=False)
+
+        for i, p in enumerate(paths):
+            out_dir = os.path.join(out_root, p)
+            os.makedirs(out_dir, exist_ok=True)
+            save_npy_atomic(os.path.join(out_dir, X_BLCV_FILE), x_BLCv_wo_first_l[i])
+            if dino_feats is not None:
+                f = dino_feats[i]
+                save_npy_atomic(os.path.join(out_dir, DINO_FILE), torch.cat([f['pooled'], f['embeddings'][0]], dim=0).float().numpy())
+            if text_feats is not None:
+                f = text_feats[i]
+                save_npy_atomic(os.path.join(out_dir, TEXT_FILE), f['embeddings'][0].float().numpy())
+                save_npy_atomic(os.path.join(out_dir, TEXT_POOLER_FILE), f['pooled'][0].float().numpy())
+            save_npy_atomic(os.path.join(out_dir, GT_BL_FILE), gt_BL[i])
+
+        done += B
+        if (bi + 1) % 50 == 0:
+            print(f'[rank{dist.get_rank()}] {done} / {len(pending)} instances, {done / (time.time() - start):.2f} inst/s')
+
+    elapsed = time.time() - start
+    print(f'[rank{dist.get_rank()}] extracted {done} instances in {elapsed:.1f}s ({done / max(elapsed, 1e-6):.2f} inst/s)')
+    total = torch.tensor([done], device=dist.get_device())
+    dist.allreduce(total)
+    if dist.is_master():
+        print(f'extracted {int(total.item())} instances on {dist.get_world_size()} ranks ({total.item() / max(elapsed, 1e-6):.2f} inst/s overall)')
+
+
+if __name__ == '__main__':
+    try:
+        main_extract()
+    finally:
+        dist.finalize()
+        if isinstance(sys.stdout, misc.SyncPrint) and isinstance(sys.stderr, misc.SyncPrint):
+            sys.stdout.close()
+            sys.stderr.close()
@@ -11,6 +11,7 @@ import sys
 # Import model components
 from vit.quant import VectorQuantizer2 
 from .var import VAR, VAR_text
+from .infer_engine import VARInferenceEngine, check_engine
 from .vqvae import VQVAE
 from .model_config import encoder_and_nsr_defaults
 
@@ -34,7 +35,8 @@ def build_vae_var_3D_VAR(
     init_adaln_gamma=1e-5,      # AdaLN gamma init
     init_head=0.02,             # Head layer init
     init_std=-1,                # Weight init std (-1 for auto)
-    args=None                   # Additional config args
+    args=None,                  # Additional config args
+    empty_cond_dir=None,        # Directory of the empty CFG embeddings (default: args.empty_cond_dir or <repo>/files)
 ) -> Tuple[VQVAE, VAR]:
     """
     Build VAE and VAR models for 3D generation.
@@ -48,6 +50,7 @@ def build_vae_var_3D_VAR(
         flash_if_available, fused_if_available: Optimization flags
         init_*: Initialization parameters
         args: Additional configuration arguments
+        empty_cond_dir: Directory holding the empty-condition embeddings for classifier-free guidance
         
     Returns:
         vae_local: VQVAE model
@@ -64,15 +67,7 @@ def build_vae_var_3D_VAR(
         setattr(clz, 'reset_parameters', lambda self: None)
 
     # Build VQVAE model
-    args.LN3DiffConfig.img_size = [args.LN3DiffConfig.image_size_encoder]
-    
-    if not args.flexicubes:
-        vae_local = create_3DAE_model(**args_to_dict(args.LN3DiffConfig,
-                       encoder_and_nsr_defaults().keys())).to(device)
-    else:
-        vae_local = create_3DAE_model_mesh(**args_to_dict(args.LN3DiffConfig,
-                       encoder_and_nsr_defaults().keys())).to(device)
-        vae_local.decoder.triplane_decoder.init_flexicubes_geometry(device=device, fovy=43)
+    vae_local = build_vae_3D(device, args)
 
     # Build VAR model
     if args.text_conditioned:
@@ -116,10 +111,38 @@ def build_vae_var_3D_VAR(
                            init_adaln_gamma=init_adaln_gamma,
                            init_head=init_head,
                            init_std=init_std)
+    
+    # Load empty-condition embeddings for classifier-free guidance once, independent of the working directory
+    if empty_cond_dir is None:
+        empty_cond_dir = getattr(args, 'empty_cond_dir', None) or os.path.join(parent_dir, 'files')
+    var_wo_ddp.load_empty_cond(empty_cond_dir)
 
     return vae_local, var_wo_ddp
 
 
+def build_vae_3D(device, args):
+    """
+    Build the 3D VQVAE alone (e.g. for token extraction), configured by args.LN3DiffConfig.
+
+    Args:
+        device: Device to place the model on
+        args: Configuration arguments (LN3DiffConfig, flexicubes)
+
+    Returns:
+        vae_local: VQVAE model
+    """
+    args.LN3DiffConfig.img_size = [args.LN3DiffConfig.image_size_encoder]
+
+    if not args.flexicubes:
+        vae_local = create_3DAE_model(**args_to_dict(args.LN3DiffConfig,
+                       encoder_and_nsr_defaults().keys())).to(device)
+    else:
+        vae_local = create_3DAE_model_mesh(**args_to_dict(args.LN3DiffConfig,
+                       encoder_and_nsr_defaults().keys())).to(device)
+        vae_local.decoder.triplane_decoder.init_flexicubes_geometry(device=device, fovy=43)
+    return vae_local
+
+
 def args_to_dict(args, keys):
     """Convert args to dictionary with specified keys"""
     for k in keys:
@@ -114,13 +114,71 @@ class SelfAttention(nn.Module):
         self.caching = False
         self.cached_k = None 
         self.cached_v = None
+        
+        # Static KV cache: static_kv_len > 0 preallocates that many slots and writes each scale in place
+        self.static_kv_len = 0
+        self.register_buffer('static_k', None, persistent=False)
+        self.register_buffer('static_v', None, persistent=False)
+        self.cache_len = 0
     
     def kv_caching(self, enable: bool):
         self.caching = enable
         self.cached_k = None
         self.cached_v = None
+        self.cache_len = 0
+    
+    def set_static_kv_cache(self, max_len: int, batch_size: int = 0):
+        """
+        max_len > 0 enables the static cache, 0 restores torch.cat growth.
+        With batch_size > 0 the buffers are allocated right away (in the dtype of the qkv weights, the layout
+        of the inference attention path), otherwise on the next cached forward.
+        """
+        self.static_kv_len = max_len
+        self.static_k = None
+        self.static_v = None
+        self.cache_len = 0
+        if max_len > 0 and batch_size > 0:
+            w = self.mat_qkv.weight
+            if (self.using_flash and w.dtype != torch.float32) or self.using_xform:
+                shape = (batch_size, max_len, self.num_heads, self.head_dim)   # BLHc
+            else:
+                shape = (batch_size, self.num_heads, max_len, self.head_dim)   # BHLc
+            self.static_k = w.new_empty(shape)
+            self.static_v = w.new_empty(shape)
+    
+    def _write_static_kv(self, k, v, dim_cat, kv_pos=None):
+        L = k.shape[dim_cat]
+        if kv_pos is not None:
+            # kv_pos: (ed,) slots of every token up to this scale, the last L receive k / v; no Python-side
+            # state changes, so compiled / CUDA-graph replays see the position through the tensor
+            ed = kv_pos.shape[0]
+            assert self.static_k is not None and self.static_k.shape[0] == k.shape[0], 'preallocate the static kv cache (set_static_kv_cache with batch_size) before passing kv_pos'
+            self.static_k.index_copy_(dim_cat, kv_pos[ed - L:], k.to(self.static_k.dtype))
+            self.static_v.index_copy_(dim_cat, kv_pos[ed - L:], v.to(self.static_v.dtype))
+            return self.static_k.narrow(dim_cat, 0, ed), self.static_v.narrow(dim_cat, 0, ed)
+        
+        shape = list(k.shape)
+        shape[dim_cat] = self.static_kv_len
+        # the buffers are reused across samples as long as batch size, layout and dtype do not change
+        if self.static_k is None or list(self.static_k.shape) != shape or self.static_k.dtype != k.dtype or self.static_k.device != k.device:
+            self.static_k = k.new_empty(shape)
+            self.static_v = v.new_empty(shape)
+        
+        ed = self.cache_len + L
+        assert ed <= self.static_kv_len, f'static kv cache overflow: {ed} > {self.static_kv_len}'
+        self.static_k.narrow(dim_cat, self.cache_len, L).copy_(k)
+        self.static_v.narrow(dim_cat, self.cache_len, L).copy_(v)
+        self.cache_len = ed
+        return self.static_k.narrow(dim_cat, 0, ed), self.static_v.narrow(dim_cat, 0, ed)
     
-    def forward(self, x, attn_bias):
+    def reorder_kv_cache(self, idx_B: torch.LongTensor):
+        """Gather the cached K/V along the batch dim, e.g. to fork or prune sampling branches"""
+        if self.static_k is not None:
+            self.static_k, self.static_v = self.static_k.index_select(0, idx_B), self.static_v.index_select(0, idx_B)
+        if self.cached_k is not None:
+            self.cached_k, self.cached_v = self.cached_k.index_select(0, idx_B), self.cached_v.index_select(0, idx_B)
+    
+    def forward(self, x, attn_bias, kv_pos=None):
         B, L, C = x.shape
         
         # Project input to Q, K, V
@@ -147,7 +205,9 @@ class SelfAttention(nn.Module):
             k = F.normalize(k, dim=-1)
         
         # Handle KV caching during inference
-        if self.caching:
+        if self.caching and self.static_kv_len > 0:
+            k, v = self._write_static_kv(k, v, dim_cat, kv_pos)
+        elif self.caching:
             if self.cached_k is None:
                 self.cached_k = k
                 self.cached_v = v
@@ -178,7 +238,7 @@ class SelfAttention(nn.Module):
         return self.proj_drop(self.proj(oup))
     
     def extra_repr(self) -> str:
-        return f'using_flash={self.using_flash}, using_xform={self.using_xform}, attn_l2_norm={self.attn_l2_norm}'
+        return f'using_flash={self.using_flash}, using_xform={self.using_xform}, attn_l2_norm={self.attn_l2_norm}, static_kv_len={self.static_kv_len}'
 
 class CrossAttention(nn.Module):
     def __init__(
@@ -212,45 +272,56 @@ class CrossAttention(nn.Module):
         self.using_flash = flash_if_available and flash_attn_func is not None
         self.using_xform = flash_if_available and memory_efficient_attention is not None
         
-        # only used during inference
+        # only used during inference: the conditioning K/V is projected once per sample and reused at every scale
         self.caching, self.cached_k, self.cached_v = False, None, None
     
     def kv_caching(self, enable: bool): 
         self.caching, self.cached_k, self.cached_v = enable, None, None
     
-    def forward(self, x_q, x_kv, attn_bias=None):
+    def reorder_kv_cache(self, idx_B: torch.LongTensor):
+        if self.cached_k is not None:
+            self.cached_k, self.cached_v = self.cached_k.index_select(0, idx_B), self.cached_v.index_select(0, idx_B)
+    
+    def project_kv(self, x_kv):
+        """K/V of the condition x_kv (B, L_kv, C_kv), in the layout forward attends with (BLHc for flash / xformers, else BHLc)"""
+        B, L_kv, C_kv = x_kv.shape
+        kv = F.linear(input=x_kv, weight=self.mat_kv.weight, bias=torch.cat((self.zero_k_bias, self.v_bias))).view(B, L_kv, 2, self.num_heads, self.query_head_dim)
+        if (self.using_flash and kv.dtype != torch.float32) or self.using_xform:
+            k, v = kv.unbind(dim=2)
+        else:
+            k, v = kv.permute(2, 0, 3, 1, 4).unbind(dim=0)
+        if self.attn_l2_norm:
+            k = F.normalize(k, dim=-1)
+        return k, v
+    
+    def forward(self, x_q, x_kv, attn_bias=None, kv=None):
+        """kv: (k, v) of x_kv from project_kv to attend to, e.g. computed outside a compiled graph; None projects x_kv
+        (or reuses the cached K/V when caching)"""
         B, L_q, C_q = x_q.shape  # x_q: (Batch, Query Length, Query Dim)
-        B, L_kv, C_kv = x_kv.shape  # x_kv: (Batch, Key/Value Length, Key/Value Dim)
         
-        # Compute Q, K, V
+        # K, V: given, cached, or projected from x_kv (and cached when caching)
+        if kv is not None:
+            k, v = kv
+        elif self.caching and self.cached_k is not None:
+            k, v = self.cached_k, self.cached_v
+        else:
+            k, v = self.project_kv(x_kv)
+            if self.caching:
+                self.cached_k, self.cached_v = k, v
+        
         q = F.linear(input=x_q, weight=self.mat_q.weight, bias=self.q_bias).view(B, L_q, self.num_heads, self.query_head_dim)
-        kv = F.linear(input=x_kv, weight=self.mat_kv.weight, bias=torch.cat((self.zero_k_bias, self.v_bias))).view(B, L_kv, 2, self.num_heads, self.query_head_dim)
-        assert q.dtype == kv.dtype
+        assert q.dtype == k.dtype
         main_type = q.dtype
 
-        using_flash = self.using_flash and attn_bias is None and q.dtype != torch.float32 and kv.dtype != torch.float32
-        if using_flash or self.using_xform:
-            k, v = kv.unbind(dim=2)
-            dim_cat = 1
-        else:
-            k, v = kv.permute(2, 0, 3, 1, 4).unbind(dim=0)
+        using_flash = self.using_flash and attn_bias is None and q.dtype != torch.float32
+        if not (using_flash or self.using_xform):
             q = q.permute(0, 2, 1, 3)
-            dim_cat = 2
 
         if self.attn_l2_norm:
             scale_mul = self.scale_mul_1H11.clamp_max(self.max_scale_mul).exp()
             if self.using_flash or self.using_xform:
                 scale_mul = scale_mul.transpose(1, 2)
             q = F.normalize(q, dim=-1).mul(scale_mul)
-            k = F.normalize(k, dim=-1)
-        
-        if self.caching:
-            if self.cached_k is None: 
-                self.cached_k = k
-                self.cached_v = v
-            else: 
-                k = self.cached_k = torch.cat((self.cached_k, k), dim=dim_cat)
-                v = self.cached_v = torch.cat((self.cached_v, v), dim=dim_cat)
 
         dropout_p = self.attn_drop if self.training else 0.0
         
@@ -290,12 +361,12 @@ class AdaLNSelfAttn(nn.Module):
         self.fused_add_norm_fn = None
     
     # NOTE: attn_bias is None during inference because kv cache is enabled
-    def forward(self, x, cond_BD, attn_bias):   # C: embed_dim, D: cond_dim
+    def forward(self, x, cond_BD, attn_bias, kv_pos=None):   # C: embed_dim, D: cond_dim
         if self.shared_aln:
             gamma1, gamma2, scale1, scale2, shift1, shift2 = (self.ada_gss + cond_BD).unbind(2) # 116C + B16C =unbind(2)=> 6 B1C
         else:
             gamma1, gamma2, scale1, scale2, shift1, shift2 = self.ada_lin(cond_BD).view(-1, 1, 6, self.C).unbind(2)
-        x = x + self.drop_path(self.attn( self.ln_wo_grad(x).mul(scale1.add(1)).add_(shift1), attn_bias=attn_bias ).mul_(gamma1))
+        x = x + self.drop_path(self.attn( self.ln_wo_grad(x).mul(scale1.add(1)).add_(shift1), attn_bias=attn_bias, kv_pos=kv_pos ).mul_(gamma1))
         x = x + self.drop_path(self.ffn( self.ln_wo_grad(x).mul(scale2.add(1)).add_(shift2) ).mul(gamma2)) # this mul(gamma2) cannot be in-placed when FusedMLP is used
         return x
     
@@ -358,7 +429,7 @@ class AdaLNCrossSelfAttn_Image_new(nn.Module):
         
         self.fused_add_norm_fn = None
 
-    def forward(self, x, cond_BD, dino_condition, attn_bias):
+    def forward(self, x, cond_BD, dino_condition, attn_bias, kv_pos=None, cross_kv=None):
         """
         Forward pass through the module.
         
@@ -367,6 +438,8 @@ class AdaLNCrossSelfAttn_Image_new(nn.Module):
             cond_BD: Conditioning tensor
             dino_condition: DINO feature tensor
             attn_bias: Attention bias tensor
+            kv_pos: Static KV-cache slots up to this scale (see SelfAttention._write_static_kv), None otherwise
+            cross_kv: (k, v) of dino_condition from cross_attn.project_kv, None to project it here
             
         Returns:
             Processed tensor after cross attention, self attention and FFN
@@ -378,13 +451,13 @@ class AdaLNCrossSelfAttn_Image_new(nn.Module):
             gamma1, gamma2, scale1, scale2, shift1, shift2 = self.ada_lin(cond_BD).view(-1, 1, 6, self.C).unbind(2)
 
         # Cross attention with DINO features
-        x = x + self.drop_path(self.cross_attn(self.prenorm_ca_dino(x), dino_condition))
+        x = x + self.drop_path(self.cross_attn(self.prenorm_ca_dino(x), dino_condition, kv=cross_kv))
         
         # Self attention with adaptive layer norm
         x = x + self.drop_path(
             self.attn(
                 self.ln_wo_grad(x).mul(scale1.add(1)).add_(shift1),
-                attn_bias=attn_bias
+                attn_bias=attn_bias, kv_pos=kv_pos
             ).mul_(gamma1)
         )
         
@@ -467,7 +540,7 @@ class AdaLNCrossSelfAttn_text(nn.Module):
         
         self.fused_add_norm_fn = None
 
-    def forward(self, x, cond_BD, dino_condition, attn_bias):
+    def forward(self, x, cond_BD, dino_condition, attn_bias, kv_pos=None, cross_kv=None):
         """
         Forward pass through the module.
         
@@ -476,6 +549,8 @@ class AdaLNCrossSelfAttn_text(nn.Module):
             cond_BD: Conditioning tensor
             dino_condition: DINO feature tensor
             attn_bias: Attention bias tensor
+            kv_pos: Static KV-cache slots up to this scale (see SelfAttention._write_static_kv), None otherwise
+            cross_kv: (k, v) of dino_condition from cross_attn.project_kv, None to project it here
             
         Returns:
             Processed tensor after attention and FFN layers
@@ -490,12 +565,12 @@ class AdaLNCrossSelfAttn_text(nn.Module):
         x = x + self.drop_path(
             self.attn(
                 self.ln_wo_grad(x).mul(scale1.add(1)).add_(shift1),
-                attn_bias=attn_bias
+                attn_bias=attn_bias, kv_pos=kv_pos
             ).mul_(gamma1)
         )
         
         # Cross attention with DINO features
-        x = x + self.drop_path(self.cross_attn(self.prenorm_ca_dino(x), dino_condition))
+        x = x + self.drop_path(self.cross_attn(self.prenorm_ca_dino(x), dino_condition, kv=cross_kv))
         
         # Feed forward with adaptive layer norm
         x = x + self.drop_path(
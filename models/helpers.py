@@ -1,3 +1,5 @@
+from typing import Optional, Sequence
+
 import torch
 from torch import nn as nn
 from torch.nn import functional as F
@@ -19,6 +21,16 @@ def sample_with_top_k_top_p_(logits_BlV: torch.Tensor, top_k: int = 0, top_p: fl
     return torch.multinomial(logits_BlV.softmax(dim=-1).view(-1, V), num_samples=num_samples, replacement=replacement, generator=rng).view(B, l, num_samples)
 
 
+def sample_with_top_k_top_p_per_item_(logits_BlV: torch.Tensor, top_k: Sequence[int], top_p: Sequence[float], rngs: Sequence[Optional[torch.Generator]], num_samples=1) -> torch.Tensor:  # return idx, shaped (B, l, num_samples)
+    # each item keeps its own filtering thresholds and generator, so results match a B=1 call with the same seed
+    B = logits_BlV.shape[0]
+    assert len(top_k) == len(top_p) == len(rngs) == B, f'{len(top_k)=}, {len(top_p)=}, {len(rngs)=} != {B=}'
+    return torch.cat([
+        sample_with_top_k_top_p_(logits_BlV[b:b+1], top_k=top_k[b], top_p=top_p[b], rng=rngs[b], num_samples=num_samples)
+        for b in range(B)
+    ], dim=0)
+
+
 def gumbel_softmax_with_rng(logits: torch.Tensor, tau: float = 1, hard: bool = False, eps: float = 1e-10, dim: int = -1, rng: torch.Generator = None) -> torch.Tensor:
     if rng is None:
         return F.gumbel_softmax(logits=logits, tau=tau, hard=hard, eps=eps, dim=dim)
@@ -0,0 +1,194 @@
+"""
+Fixed-shape autoregressive sampler for VAR / VAR_text, friendly to torch.compile and CUDA graphs.
+
+The transformer pass and the tri-plane residual update of every scale run in their own step
+function with static shapes, so each entry in patch_nums gets exactly one compiled graph.
+The engine is warmed up once and then replayed for every batch.
+
+The steps are the ones VAR's own sampling loop runs (cfg_inputs, scale_logits, next_scale_input,
+decode_triplane), so both loops sample the same way; check_engine asserts that they pick the same
+tokens. The engine's static self-attention KV cache is allocated before anything is compiled and
+installed in the model only for the duration of generate. Every step gets its cache slots (kv_pos)
+and the cross-attention K/V of the condition (projected eagerly, outside the graphs) as tensor
+arguments, so a replayed graph never depends on Python-side cache state.
+"""
+
+from functools import partial
+from typing import List, Optional, Sequence, Tuple, Union
+
+import torch
+from torch.nn import functional as F
+
+from models.helpers import sample_with_top_k_top_p_, sample_with_top_k_top_p_per_item_
+from models.var import expand_per_item, is_per_item, make_item_rngs
+
+
+class VARInferenceEngine:
+    """
+    Reusable sampler that decodes a fixed batch of `batch_size` conditions per call.
+
+    Args:
+        var: VAR or VAR_text model (a torch.compile wrapper is unwrapped)
+        batch_size: Number of conditions per call, smaller batches are padded
+        compile_mode: torch.compile mode for the per-scale steps ('reduce-overhead' enables CUDA graphs),
+            None to run them eagerly
+    """
+    def __init__(self, var, batch_size: int, compile_mode: Optional[str] = 'reduce-overhead'):
+        self.var = getattr(var, '_orig_mod', var)
+        self.B = batch_size
+        self.compile_mode = compile_mode
+        self.patch_nums = self.var.patch_nums
+        self.SN = len(self.patch_nums)
+
+        # Static self-attention KV cache for the CFG-doubled batch, allocated now so no compiled step allocates it;
+        # the model keeps its own cache mode outside generate
+        previous = self._static_kv_state()
+        self.var.use_static_kv_cache(True, batch_size=2 * batch_size)
+        self.static_kv = self._static_kv_state()
+        self._set_static_kv_state(previous)
+
+        # KV-cache slots of all tokens up to every scale in the 3-plane sequence
+        device, cur = self.var.pos_start.device, 0
+        self.kv_pos = []
+        for pn in self.patch_nums:
+            cur += 3 * pn * pn
+            self.kv_pos.append(torch.arange(cur, device=device))
+
+        self.decode_steps = [self._compile(partial(self._decode_step, si)) for si in range(self.SN)]
+        self.update_steps = [self._compile(partial(self._update_step, si)) for si in range(self.SN)]
+        self.warmed_up = False
+
+    def _static_kv_state(self):
+        return [(b.attn.static_kv_len, b.attn.static_k, b.attn.static_v) for b in self.var.blocks]
+
+    def _set_static_kv_state(self, state):
+        for b, (max_len, k, v) in zip(self.var.blocks, state):
+            b.attn.static_kv_len, b.attn.static_k, b.attn.static_v, b.attn.cache_len = max_len, k, v, 0
+
+    def _compile(self, fn):
+        if self.compile_mode is None or not hasattr(torch, 'compile'):
+            return fn
+        return torch.compile(fn, mode=self.compile_mode, dynamic=False)
+
+    # ===================== per-scale steps (static shapes) =====================
+    def _decode_step(self, si: int, next_token_map: torch.Tensor, cond_BD: torch.Tensor, cond_emb: torch.Tensor, cfg_B11: torch.Tensor,
+                     kv_pos: torch.LongTensor, cross_kv: List[Tuple[torch.Tensor, torch.Tensor]]) -> torch.Tensor:
+        """Transformer pass over the tokens of scale si, returns guided logits (B, 3*pn*pn, V)"""
+        return self.var.scale_logits(si, next_token_map, cond_BD, cond_emb, cfg_B11, kv_pos=kv_pos, cross_kv=cross_kv)
+
+    def _update_step(self, si: int, f_hat: torch.Tensor, idx_Bl: torch.LongTensor, embedding: torch.Tensor, lvl_pos: torch.Tensor):
+        """Add the sampled tokens of scale si to f_hat (B*3, Cvae, H, W) and build the transformer input of scale si+1"""
+        return self.var.next_scale_input(si, f_hat, embedding[idx_Bl], lvl_pos)
+
+    # ===================== sampling =====================
+    def warmup(self):
+        """Compile and run every per-scale step once, using the empty condition as a dummy input"""
+        var = self.var
+        assert var.empty_pooler_output is not None, 'empty-condition embeddings are not loaded, call load_empty_cond first'
+        self.generate(
+            cond_emb=var.empty_embedding.expand(self.B, -1, -1),
+            pooler_output=var.empty_pooler_output.expand(self.B, -1),
+        )
+        self.warmed_up = True
+
+    def _pad(self, x: torch.Tensor) -> torch.Tensor:
+        n = x.shape[0]
+        return x if n == self.B else torch.cat((x, x[-1:].expand(self.B - n, *x.shape[1:])), dim=0)
+
+    @torch.no_grad()
+    def generate(
+        self, cond_emb: torch.Tensor, pooler_output: torch.Tensor,
+        cfg: Union[float, Sequence[float]] = 1.5,
+        top_k: Union[int, Sequence[int]] = 0,
+        top_p: Union[float, Sequence[float]] = 0.0,
+        g_seed: Optional[Union[int, Sequence[Optional[int]]]] = None,
+    ):
+        """
+        Same sampling as autoregressive_infer_cfg_3D_VAR_*_l2norm (without more_smooth and reranking).
+
+        Args:
+            cond_emb: DINO / CLIP token embeddings of at most batch_size conditions
+            pooler_output: Pooled DINO / CLIP features
+            cfg, top_k, top_p, g_seed: Scalars or one value per condition
+
+        Returns:
+            Tuple of:
+            - Generated triplane latents
+            - Generated token indices
+        """
+        var, B = self.var, self.B
+        n = cond_emb.shape[0]
+        assert n <= B, f'{n} conditions do not fit the engine batch size {B}'
+
+        # Pad to the fixed batch size (padding rows repeat the last condition and are dropped at the end)
+        per_item = is_per_item(cfg, top_k, top_p, g_seed)
+        if per_item:
+            cfg, top_k, top_p, g_seed = (expand_per_item(v, n, name) for v, name in ((cfg, 'cfg'), (top_k, 'top_k'), (top_p, 'top_p'), (g_seed, 'g_seed')))
+            cfg, top_k, top_p, g_seed = (v + v[-1:] * (B - n) for v in (cfg, top_k, top_p, g_seed))
+            rngs = make_item_rngs(var.rng, g_seed, B)
+        else:
+            cfg = [cfg] * B
+            if g_seed is not None:
+                var.rng.manual_seed(g_seed)
+            rng = var.rng
+        cfg_B11 = torch.tensor(cfg, dtype=torch.float32, device=pooler_output.device).view(B, 1, 1)
+        cond_BD, cond_emb, lvl_pos, next_token_map, f_hat_all = var.cfg_inputs(self._pad(pooler_output), self._pad(cond_emb))
+        cross_kv = var.cross_kv(cond_emb)
+        embedding = F.normalize(var.vae_quant_proxy[0].embedding.weight, p=2, dim=-1)
+
+        # Install the engine's static cache, and restore the model's own cache mode however sampling ends
+        previous = self._static_kv_state()
+        self._set_static_kv_state(self.static_kv)
+        for b in var.blocks:
+            b.attn.kv_caching(True)
+        try:
+            idx_Bl_list = []
+            for si in range(self.SN):
+                logits_BlV = self.decode_steps[si](next_token_map, cond_BD, cond_emb, cfg_B11, self.kv_pos[si], cross_kv)
+                if per_item:
+                    idx_Bl = sample_with_top_k_top_p_per_item_(logits_BlV, top_k=top_k, top_p=top_p, rngs=rngs, num_samples=1)[:, :, 0]
+                else:
+                    idx_Bl = sample_with_top_k_top_p_(logits_BlV, rng=rng, top_k=top_k, top_p=top_p, num_samples=1)[:, :, 0]
+                idx_Bl_list.append(idx_Bl)
+                f_hat_all, next_token_map = self.update_steps[si](f_hat_all, idx_Bl, embedding, lvl_pos)
+        finally:
+            for b in var.blocks:
+                b.attn.kv_caching(False)
+            self._set_static_kv_state(previous)
+
+        g_BL = torch.cat(idx_Bl_list, dim=1)
+        return var.decode_triplane(f_hat_all)[:n], g_BL[:n]
+
+    def __repr__(self):
+        return f'{type(self).__name__}(batch_size={self.B}, compile_mode={self.compile_mode}, scales={self.SN}, warmed_up={self.warmed_up})'
+
+
+@torch.no_grad()
+def check_engine(var, cond_emb: torch.Tensor, pooler_output: torch.Tensor, compile_modes: Sequence[Optional[str]] = (None, 'reduce-overhead'),
+                 g_seed: int = 0, calls: int = 3, **sample_kwargs):
+    """
+    Sample the conditions with g_seed through VAR's own loop (autoregressive_infer_cfg_3D_VAR_*_l2norm) and through
+    a VARInferenceEngine per compile mode (None: eager), and assert that every engine picks the same tokens g_BL.
+    Each engine is called `calls` times, so that compiled CUDA graphs are also checked when they are replayed.
+    The reference loop runs again at the end, to check that the engines left the model's cache mode alone.
+
+    Args:
+        var: VAR or VAR_text model with the empty condition loaded
+        cond_emb, pooler_output: Conditions, as for VARInferenceEngine.generate
+        sample_kwargs: cfg, top_k and top_p, as for VARInferenceEngine.generate
+    """
+    var = getattr(var, '_orig_mod', var)
+    infer = getattr(var, 'autoregressive_infer_cfg_3D_VAR_image_l2norm', None) or var.autoregressive_infer_cfg_3D_VAR_text_l2norm
+    n = cond_emb.shape[0]
+
+    def reference():
+        return infer(B=n, dino_image_embeddings=cond_emb, pooler_output=pooler_output, g_seed=g_seed, more_smooth=False, **sample_kwargs)[1]
+
+    g_ref = reference()
+    for mode in compile_modes:
+        engine = VARInferenceEngine(var, batch_size=n, compile_mode=mode)
+        for call in range(calls):
+            _, g_BL = engine.generate(cond_emb, pooler_output, g_seed=g_seed, **sample_kwargs)
+            assert torch.equal(g_BL, g_ref), f'{mode or "eager"} engine, call {call}: {(g_BL != g_ref).sum().item()} / {g_ref.numel()} tokens differ from the sampling loop'
+    g_after = reference()
+    assert torch.equal(g_after, g_ref), f'the sampling loop changed after running the engines: {(g_after != g_ref).sum().item()} / {g_ref.numel()} tokens differ'
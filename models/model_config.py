@@ -54,6 +54,7 @@ def model_encoder_defaults():
         return_all_dit_layers=False,
         lrm_decoder=False,
         gs_rendering=False,
+        vq_fused=False,  # train the multi-scale quantizer with VectorQuantizer2.forward_fused
     )
 
 
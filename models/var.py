@@ -1,6 +1,7 @@
 import math
+import os
 from functools import partial
-from typing import Optional, Tuple, Union
+from typing import List, Optional, Sequence, Tuple, Union
 
 import torch
 import torch.nn as nn
@@ -8,7 +9,7 @@ from huggingface_hub import PyTorchModelHubMixin
 
 import utils.dist as dist
 from models.basic_var import AdaLNBeforeHead, AdaLNSelfAttn, AdaLNCrossSelfAttn_Image_new, AdaLNCrossSelfAttn_text
-from models.helpers import gumbel_softmax_with_rng, sample_with_top_k_top_p_
+from models.helpers import gumbel_softmax_with_rng, sample_with_top_k_top_p_, sample_with_top_k_top_p_per_item_
 from models.vqvae import VQVAE, VectorQuantizer2
 
 from ipdb import set_trace as st
@@ -24,6 +25,56 @@ class SharedAdaLin(nn.Linear):
         return super().forward(cond_BD).view(-1, 1, 6, C)   # B16C
 
 
+def is_per_item(*sampling_args) -> bool:
+    """Whether any sampling argument was given per batch item (as a list/tuple)"""
+    return any(isinstance(a, (list, tuple)) for a in sampling_args)
+
+
+def expand_per_item(v, B: int, name: str) -> list:
+    """Broadcast a scalar sampling argument to B items, or check a per-item one"""
+    if isinstance(v, (list, tuple)):
+        assert len(v) == B, f'{name} has {len(v)} entries but B={B}'
+        return list(v)
+    return [v] * B
+
+
+def make_item_rngs(shared_rng: torch.Generator, g_seed, B: int) -> list:
+    """One generator per item; items without a seed share the model generator"""
+    rngs = []
+    for seed in expand_per_item(g_seed, B, 'g_seed'):
+        if seed is None:
+            rngs.append(shared_rng)
+        else:
+            rng = torch.Generator(device=shared_rng.device)
+            rng.manual_seed(seed)
+            rngs.append(rng)
+    return rngs
+
+
+def rerank_candidates(logits_BlV: torch.Tensor, idx_BlK: torch.LongTensor, scores_B: Optional[torch.Tensor], num_items: int, num_keep: int):
+    """
+    Score the K token maps sampled for every branch by their log-likelihood under the (filtered, guided)
+    logits they were drawn from, and keep the num_keep best branches of each item.
+    The branches of one item are contiguous in the batch.
+
+    Returns:
+        Tuple of:
+        - parent: (B',) branch each kept token map was sampled from, None when K == 1 (nothing is forked)
+        - idx_Bl: (B', l) kept token maps
+        - scores: (B',) cumulative log-likelihood of the kept branches, best first within each item
+    """
+    B, l, K = idx_BlK.shape
+    logp_BK = logits_BlV.float().log_softmax(dim=-1).gather(-1, idx_BlK).sum(dim=1)
+    scores_BK = logp_BK if scores_B is None else scores_B.unsqueeze(1) + logp_BK
+    if K == 1:
+        return None, idx_BlK[:, :, 0], scores_BK[:, 0]
+    
+    cand = scores_BK.view(num_items, -1)
+    scores, flat = cand.topk(min(num_keep, cand.shape[1]), dim=1, largest=True, sorted=True)
+    parent = (torch.arange(num_items, device=flat.device).unsqueeze(1) * (B // num_items) + flat // K).view(-1)
+    return parent, idx_BlK[parent, :, (flat % K).view(-1)], scores.view(-1)
+
+
 class VAR(nn.Module):
     """
     Scale Autoregressive model for 3D generation.
@@ -46,6 +97,8 @@ class VAR(nn.Module):
         flash_if_available: Whether to use flash attention
         fused_if_available: Whether to use fused operations
     """
+    EMPTY_COND_FILES = ('empty_dino_pooler_output.npy', 'empty_dino_embedding.npy')   # the embedding keeps DINO's CLS token, dropped on load
+    
     def __init__(
         self, vae_local: VQVAE,
         num_classes=1000, depth=16, embed_dim=1024, num_heads=16, mlp_ratio=4., 
@@ -163,6 +216,10 @@ class VAR(nn.Module):
         # Output head
         self.head_nm = AdaLNBeforeHead(self.C, self.D, norm_layer=norm_layer)
         self.head = nn.Linear(self.C, self.V)
+        
+        # Empty-condition embeddings for classifier-free guidance, set by load_empty_cond (not saved in checkpoints)
+        self.register_buffer('empty_pooler_output', None, persistent=False)
+        self.register_buffer('empty_embedding', None, persistent=False)
     
     def get_logits(self, h_or_h_and_residual: Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]], cond_BD: Optional[torch.Tensor]):
         if not isinstance(h_or_h_and_residual, torch.Tensor):
@@ -174,82 +231,205 @@ class VAR(nn.Module):
     
 
  
+    def load_empty_cond(self, files_dir: str):
+        """
+        Load the empty-condition embeddings for classifier-free guidance from files_dir
+        into non-persistent buffers on the model's device, once at build time.
+        """
+        pooler_file, embedding_file = self.EMPTY_COND_FILES
+        device = self.pos_start.device
+        self.empty_pooler_output = torch.from_numpy(np.load(os.path.join(files_dir, pooler_file))).to(device).unsqueeze(0)
+        self.empty_embedding = torch.from_numpy(np.load(os.path.join(files_dir, embedding_file)))[1:, :].to(device).unsqueeze(0)
+    
+    def use_static_kv_cache(self, enable: bool, batch_size: int = 0):
+        """
+        Preallocate the self-attention KV cache for all 3*L tokens (sized from patch_nums) and
+        write each scale in place, instead of growing it with torch.cat at every scale.
+        batch_size > 0 (the CFG-doubled batch) allocates the buffers now instead of on the first scale.
+        """
+        for b in self.blocks:
+            b.attn.set_static_kv_cache(3 * self.L if enable else 0, batch_size=batch_size)
+    
+    def reorder_kv_caches(self, idx_2B: torch.LongTensor):
+        """Gather the self/cross-attention caches of all blocks along the (CFG-doubled) batch dim"""
+        for b in self.blocks:
+            b.attn.reorder_kv_cache(idx_2B)
+            b.cross_attn.reorder_kv_cache(idx_2B)
+
+    def cfg_inputs(self, pooler_output: torch.Tensor, cond_emb: torch.Tensor):
+        """
+        Inputs of the first scale, with the empty condition appended to the batch for classifier-free guidance.
+
+        Returns:
+            cond_BD: (2B, D) pooled condition embedding
+            cond_emb: (2B, N, Ck) token condition for the cross attention
+            lvl_pos: (1, 3L, C) level, position and plane embeddings
+            next_token_map: (2B, 3*first_l, C) transformer input of scale 0
+            f_hat_all: (3B, Cvae, H, W) zero feature maps of the three planes
+        """
+        B = pooler_output.shape[0]
+        assert self.empty_pooler_output is not None, 'empty-condition embeddings are not loaded, call load_empty_cond first'
+        pooler_output = torch.cat((pooler_output, self.empty_pooler_output.expand(pooler_output.shape)), dim=0)
+        cond_emb = torch.cat((cond_emb, self.empty_embedding.expand(cond_emb.shape)), dim=0)
+
+        sos = cond_BD = self.pooler_emb(pooler_output)
+        sos = sos.unsqueeze(1).expand(2 * B, self.first_l, -1) + self.pos_start.expand(2 * B, self.first_l, -1)
+        sos = sos.repeat(1, 3, 1)
+        lvl_pos = self.lvl_embed(self.lvl_1L) + self.pos_1LC + self.plane_embed(self.plane_1L)
+        next_token_map = sos.expand(2 * B, 3, -1) + lvl_pos[:, :3]
+        f_hat_all = sos.new_zeros(3 * B, self.Cvae, self.patch_nums[-1], self.patch_nums[-1])
+        return cond_BD, cond_emb, lvl_pos, next_token_map, f_hat_all
+
+    def cross_kv(self, cond_emb: torch.Tensor) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """Cross-attention (k, v) of the CFG-doubled cond_emb for every block, to pass to scale_logits as cross_kv"""
+        return [b.cross_attn.project_kv(cond_emb) for b in self.blocks]
+
+    def scale_logits(self, si: int, next_token_map: torch.Tensor, cond_BD: torch.Tensor, cond_emb: torch.Tensor,
+                     cfg: Union[float, torch.Tensor], kv_pos: Optional[torch.LongTensor] = None,
+                     cross_kv: Optional[List[Tuple[torch.Tensor, torch.Tensor]]] = None) -> torch.Tensor:
+        """
+        Transformer pass over the tokens of scale si (KV caching enabled), with classifier-free guidance.
+
+        Args:
+            next_token_map: (2B, l, C) inputs of scale si, conditional rows first
+            cond_BD, cond_emb: CFG-doubled conditions from cfg_inputs
+            cfg: Guidance ratio, a scalar or (B, 1, 1)
+            kv_pos: Static KV-cache slots up to scale si (see SelfAttention._write_static_kv), None to let
+                the attention layers track the cache position
+            cross_kv: Cross-attention K/V of every block from cross_kv(cond_emb), None to use the
+                cross-attention caches
+
+        Returns:
+            (B, l, V) guided logits
+        """
+        cond_BD_or_gss = self.shared_ada_lin(cond_BD)
+        x = next_token_map
+        for i, b in enumerate(self.blocks):
+            x = b(x=x, cond_BD=cond_BD_or_gss, dino_condition=cond_emb, attn_bias=None, kv_pos=kv_pos,
+                  cross_kv=None if cross_kv is None else cross_kv[i])
+        logits_BlV = self.get_logits(x, cond_BD)
+        B = logits_BlV.shape[0] // 2
+        t = cfg * (si / self.num_stages_minus_1)
+        return (1+t) * logits_BlV[:B] - t * logits_BlV[B:]
+
+    def next_scale_input(self, si: int, f_hat_all: torch.Tensor, h_BChw: torch.Tensor, lvl_pos: torch.Tensor):
+        """
+        Add the embedded tokens h_BChw of scale si to the feature maps f_hat_all (3B, Cvae, H, W) of all planes.
+
+        Returns:
+            f_hat_all: Updated feature maps
+            next_token_map: (2B, l', C) CFG-doubled transformer input of scale si+1, None after the last scale
+        """
+        f_hat_all, next_token_map = self.vae_quant_proxy[0].get_next_autoregressive_input_triplane(si, len(self.patch_nums), f_hat_all, h_BChw)
+        if si == self.num_stages_minus_1:
+            return f_hat_all, None
+        bg = 3 * sum(pn * pn for pn in self.patch_nums[:si + 1])
+        next_token_map = self.word_embed(next_token_map) + lvl_pos[:, bg:bg + 3 * self.patch_nums[si+1] ** 2]
+        return f_hat_all, next_token_map.repeat(2, 1, 1)
+
+    def decode_triplane(self, f_hat_all: torch.Tensor) -> torch.Tensor:
+        """Decode the final feature maps (3B, Cvae, H, W) of all planes to the triplane latent after the VAE's ViT decoder"""
+        with torch.cuda.amp.autocast(enabled=True, dtype=torch.bfloat16, cache_enabled=True):
+            f_hat_all = self.vae_proxy[0].decoder.superresolution['post_quant_conv'](f_hat_all.to(torch.bfloat16))
+            f_hat_all = f_hat_all.reshape(f_hat_all.shape[0] // 3, -1, f_hat_all.shape[-2], f_hat_all.shape[-1])
+            f_hat_all = self.vae_proxy[0].decoder.superresolution['ldm_upsample'](f_hat_all)
+            f_hat_all = self.vae_proxy[0].decoder.forward_vit_decoder(f_hat_all, 224)
+            return self.vit_decode_postprocess(f_hat_all)
+
     @torch.no_grad()
     def autoregressive_infer_cfg_3D_VAR_image_l2norm(
         self, B: int,
         dino_image_embeddings: Optional[Union[int, torch.LongTensor]], 
         pooler_output: Optional[int] = None,
-        cfg=1.5, top_k=0, top_p=0.0,
-        g_seed: Optional[int] = None,
+        cfg: Union[float, Sequence[float]] = 1.5,
+        top_k: Union[int, Sequence[int]] = 0,
+        top_p: Union[float, Sequence[float]] = 0.0,
+        g_seed: Optional[Union[int, Sequence[Optional[int]]]] = None,
         more_smooth=False,
+        num_candidates: int = 1,
+        fork_scales: Optional[Sequence[int]] = None,
+        num_return: int = 1,
     ) -> torch.Tensor:
         """
         Autoregressive inference with classifier-free guidance for generating 3D VAR triplane.
-        
+
         Args:
             B: Batch size
             dino_image_embeddings: DINO image embeddings
             pooler_output: Pooled output features
-            cfg: Classifier-free guidance ratio
-            top_k: Top-k sampling parameter
-            top_p: Top-p sampling parameter 
-            g_seed: Random seed
+            cfg: Classifier-free guidance ratio, a scalar or one value per item
+            top_k: Top-k sampling parameter, a scalar or one value per item
+            top_p: Top-p sampling parameter, a scalar or one value per item
+            g_seed: Random seed, a scalar or one seed per item
             more_smooth: Whether to use Gumbel softmax for smoother outputs
-            
+            num_candidates: Token maps sampled per branch at each fork scale; > 1 enables reranking,
+                where branches share the KV-cache prefix and are scored by their log-likelihood
+            fork_scales: Scale indices to fork at (None for all scales)
+            num_return: Best branches kept, and returned, per item (at most num_candidates)
+
         Returns:
             Tuple of:
             - Generated image latents after VIT decoder
             - Generated token indices
+            With reranking both hold B*num_return rows, the branches of each item in a row, best first.
         """
         # Setup random number generator if seed provided
-        rng = None if g_seed is None else self.rng.manual_seed(g_seed); rng = self.rng
-
-        # Load empty embeddings for classifier-free guidance
-        empty_pooler = torch.from_numpy(np.load("./files/empty_dino_pooler_output.npy")).to(pooler_output.device).unsqueeze(0)
-        empty_dino = torch.from_numpy(np.load("./files/empty_dino_embedding.npy"))[1:, :].to(pooler_output.device).unsqueeze(0)
+        per_item = is_per_item(cfg, top_k, top_p, g_seed)
+        if per_item:
+            cfg = torch.tensor(expand_per_item(cfg, B, 'cfg'), dtype=torch.float32, device=pooler_output.device).view(B, 1, 1)
+            top_k, top_p = expand_per_item(top_k, B, 'top_k'), expand_per_item(top_p, B, 'top_p')
+            rngs = make_item_rngs(self.rng, g_seed, B)
+        else:
+            rng = None if g_seed is None else self.rng.manual_seed(g_seed); rng = self.rng
         
-        # Concatenate real and empty embeddings for CFG
-        pooler_output = torch.cat((pooler_output, empty_pooler.expand(pooler_output.shape)), dim=0)
-        dino_image_embeddings = torch.cat((dino_image_embeddings, empty_dino.expand(dino_image_embeddings.shape)), dim=0)
+        # Candidate reranking: fork num_candidates branches at the chosen scales and keep the best num_return
+        reranking = num_candidates > 1
+        if reranking:
+            assert not more_smooth, 'candidate reranking scores sampled tokens, it does not support more_smooth'
+            assert 1 <= num_return <= num_candidates, f'{num_return=} must be in [1, {num_candidates=}]'
+            fork_scales = set(range(len(self.patch_nums)) if fork_scales is None else fork_scales)
+            assert len(fork_scales), 'fork_scales is empty'
+        else:
+            assert num_return == 1, 'num_return > 1 needs num_candidates > 1'
+        num_items, scores = B, None
 
-        # Get initial tokens and positional embeddings
-        sos = cond_BD = self.pooler_emb(pooler_output)
-        sos = sos.unsqueeze(1).expand(2 * B, self.first_l, -1) + self.pos_start.expand(2 * B, self.first_l, -1)
-        sos = sos.repeat(1, 3, 1)
-        
-        # Add level and plane embeddings
-        lvl_pos = self.lvl_embed(self.lvl_1L) + self.pos_1LC + self.plane_embed(self.plane_1L)
-        next_token_map = sos.expand(2 * B, 3, -1) + lvl_pos[:, :3]
-        
-        # Initialize feature maps for each plane
-        cur_L = 0
-        f_hat_list = [
-            sos.new_zeros(B, self.Cvae, self.patch_nums[-1], self.patch_nums[-1]) for _ in range(3)
-        ]
+        # CFG-doubled conditions, first-scale input and the feature maps of all planes as one (B*3, Cvae, H, W) tensor
+        cond_BD, dino_image_embeddings, lvl_pos, next_token_map, f_hat_all = self.cfg_inputs(pooler_output, dino_image_embeddings)
 
         # Enable KV caching for attention
         for b in self.blocks:
             b.attn.kv_caching(True)
+            b.cross_attn.kv_caching(True)
 
         # Main autoregressive generation loop
         for si, pn in enumerate(self.patch_nums):
             ratio = si / self.num_stages_minus_1
-            cur_L += pn * pn * 3
 
-            # Forward pass through transformer blocks
-            cond_BD_or_gss = self.shared_ada_lin(cond_BD)
-            x = next_token_map
-            
-            for b in self.blocks:
-                x = b(x=x, cond_BD=cond_BD_or_gss, dino_condition=dino_image_embeddings, attn_bias=None)
-            
-            # Get logits and apply classifier-free guidance
-            logits_BlV = self.get_logits(x, cond_BD)
-            t = cfg * ratio
-            logits_BlV = (1+t) * logits_BlV[:B] - t * logits_BlV[B:]
+            # Transformer pass and classifier-free guidance
+            logits_BlV = self.scale_logits(si, next_token_map, cond_BD, dino_image_embeddings, cfg)
 
-            # Sample tokens
-            idx_Bl = sample_with_top_k_top_p_(logits_BlV, rng=rng, top_k=top_k, top_p=top_p, num_samples=1)[:, :, 0]
+            # Sample tokens (num_candidates token maps per branch at a fork scale)
+            K = num_candidates if reranking and si in fork_scales else 1
+            if per_item:
+                idx_BlK = sample_with_top_k_top_p_per_item_(logits_BlV, top_k=top_k, top_p=top_p, rngs=rngs, num_samples=K)
+            else:
+                idx_BlK = sample_with_top_k_top_p_(logits_BlV, rng=rng, top_k=top_k, top_p=top_p, num_samples=K)
+            if not reranking:
+                idx_Bl = idx_BlK[:, :, 0]
+            else:
+                parent, idx_Bl, scores = rerank_candidates(logits_BlV, idx_BlK, scores, num_items, num_return)
+                if parent is not None:
+                    # Continue the kept branches from their parents' KV-cache prefix
+                    parent_2B = torch.cat((parent, parent + B))
+                    self.reorder_kv_caches(parent_2B)
+                    cond_BD, dino_image_embeddings = cond_BD[parent_2B], dino_image_embeddings[parent_2B]
+                    f_hat_all = f_hat_all.view(B, 3, *f_hat_all.shape[1:])[parent].flatten(0, 1)
+                    if si > 0:
+                        g_BL = g_BL[parent]
+                    if per_item:
+                        cfg, idx = cfg[parent], parent.tolist()
+                        top_k, top_p, rngs = [top_k[i] for i in idx], [top_p[i] for i in idx], [rngs[i] for i in idx]
+                    B = parent.shape[0]
             g_BL = torch.cat((g_BL, idx_Bl), dim=1) if si > 0 else idx_Bl
 
             # Get embeddings for sampled tokens
@@ -258,46 +438,23 @@ class VAR(nn.Module):
                 h_BChw_concate = embedding[idx_Bl]
             else:
                 gum_t = max(0.27 * (1 - ratio * 0.95), 0.005)
-                embedding = F.normalize(self.vae_quant_proxy[0].embedding.weight, p=2, dim=-1) 
-                h_BChw_concate = gumbel_softmax_with_rng(logits_BlV.mul(1 + ratio), tau=gum_t, hard=False, dim=-1, rng=rng) @ embedding.unsqueeze(0)
-
-            # Process each plane separately
-            h_BChw_list = h_BChw_concate.split(int(h_BChw_concate.shape[1]/3), dim=1)
-            next_token_map_list = []
-            
-            for i in range(3):
-                h_BChw = h_BChw_list[i].transpose_(1, 2).reshape(B, self.Cvae, pn, pn)
-                f_hat_list[i], next_token_map_single = self.vae_quant_proxy[0].get_next_autoregressive_input(
-                    si, len(self.patch_nums), f_hat_list[i], h_BChw
-                )
-                next_token_map_list.append(next_token_map_single.view(B, self.Cvae, -1).transpose(1, 2))
-
-            next_token_map = torch.cat(next_token_map_list, dim=1)
+                embedding = F.normalize(self.vae_quant_proxy[0].embedding.weight, p=2, dim=-1)
+                if per_item:
+                    soft_BlV = torch.cat([gumbel_softmax_with_rng(logits_BlV[b:b+1].mul(1 + ratio), tau=gum_t, hard=False, dim=-1, rng=rngs[b]) for b in range(B)], dim=0)
+                else:
+                    soft_BlV = gumbel_softmax_with_rng(logits_BlV.mul(1 + ratio), tau=gum_t, hard=False, dim=-1, rng=rng)
+                h_BChw_concate = soft_BlV @ embedding.unsqueeze(0)
 
-            # Prepare for next stage if not last
-            if si != self.num_stages_minus_1:
-                next_token_map = self.word_embed(next_token_map) + lvl_pos[:, cur_L:cur_L + 3 * self.patch_nums[si+1] ** 2]
-                next_token_map = next_token_map.repeat(2, 1, 1)
+            # Update all three planes in one batch and prepare the next stage
+            f_hat_all, next_token_map = self.next_scale_input(si, f_hat_all, h_BChw_concate, lvl_pos)
 
         # Disable KV caching
         for b in self.blocks:
             b.attn.kv_caching(False)
-
-
-        f_hat_all = torch.zeros((3 * f_hat_list[0].shape[0], f_hat_list[0].shape[1], f_hat_list[0].shape[2], f_hat_list[0].shape[3]), device=f_hat_list[0].device, dtype=f_hat_list[0].dtype)
-        f_hat_all[0::3] = f_hat_list[0]
-        f_hat_all[1::3] = f_hat_list[1] 
-        f_hat_all[2::3] = f_hat_list[2]
+            b.cross_attn.kv_caching(False)
 
         # Decode features to image
-        with torch.cuda.amp.autocast(enabled=True, dtype=torch.bfloat16, cache_enabled=True):
-            f_hat_all = self.vae_proxy[0].decoder.superresolution['post_quant_conv'](f_hat_all.to(torch.bfloat16))
-            f_hat_all = f_hat_all.reshape(f_hat_all.shape[0] // 3, -1, f_hat_all.shape[-2], f_hat_all.shape[-1])
-            f_hat_all = self.vae_proxy[0].decoder.superresolution['ldm_upsample'](f_hat_all)
-            f_hat_all = self.vae_proxy[0].decoder.forward_vit_decoder(f_hat_all, 224)
-            latent_after_vit = self.vit_decode_postprocess(f_hat_all)
-            
-            return latent_after_vit, g_BL
+        return self.decode_triplane(f_hat_all), g_BL
 
 
     @torch.no_grad()
@@ -320,11 +477,8 @@ class VAR(nn.Module):
         if g_seed is None: rng = None
         else: self.rng.manual_seed(g_seed); rng = self.rng
 
-        # Initialize feature maps for each plane
-        f_hat_list = [
-            torch.zeros(B, self.Cvae, self.patch_nums[-1], self.patch_nums[-1], device=gt_idx.device) 
-            for _ in range(3)
-        ]
+        # Initialize the feature maps of all planes as one (B*3, Cvae, H, W) tensor
+        f_hat_all = torch.zeros(3 * B, self.Cvae, self.patch_nums[-1], self.patch_nums[-1], device=gt_idx.device)
         
         # Enable KV caching for transformer blocks
         for b in self.blocks: b.attn.kv_caching(True)
@@ -346,22 +500,14 @@ class VAR(nn.Module):
                 gum_t = max(0.27 * (1 - ratio * 0.95), 0.005)
                 # Gumbel softmax path not used for evaluation
 
-            # Process each plane separately
-            h_BChw_list = h_BChw_concate.split(int(h_BChw_concate.shape[1]/3), dim=1)
-            for i in range(3):
-                h_BChw = h_BChw_list[i].transpose_(1, 2).reshape(B, self.Cvae, pn, pn)
-                f_hat_list[i], _ = self.vae_quant_proxy[0].get_next_autoregressive_input(
-                    si, len(self.patch_nums), f_hat_list[i], h_BChw
-                )
+            # Update all three planes in one batch
+            f_hat_all, _ = self.vae_quant_proxy[0].get_next_autoregressive_input_triplane(
+                si, len(self.patch_nums), f_hat_all, h_BChw_concate
+            )
 
         # Disable KV caching
         for b in self.blocks: b.attn.kv_caching(False)
 
-        f_hat_all = torch.zeros((3 * f_hat_list[0].shape[0], f_hat_list[0].shape[1], f_hat_list[0].shape[2], f_hat_list[0].shape[3]), device=f_hat_list[0].device, dtype=f_hat_list[0].dtype)
-        f_hat_all[0::3] = f_hat_list[0]
-        f_hat_all[1::3] = f_hat_list[1]
-        f_hat_all[2::3] = f_hat_list[2]
-
         # Decode features to image
         with torch.cuda.amp.autocast(enabled=True, dtype=torch.bfloat16, cache_enabled=True):
             # Post-process through decoder network
@@ -576,6 +722,8 @@ class VAR(nn.Module):
 
 
 class VAR_text(nn.Module):
+    EMPTY_COND_FILES = ('empty_text_pooler_output.npy', 'empty_text_embedding.npy')
+    
     def __init__(
         self, vae_local: VQVAE,
         num_classes=1000, depth=16, embed_dim=1024, num_heads=16, mlp_ratio=4., drop_rate=0., attn_drop_rate=0., drop_path_rate=0.,
@@ -714,6 +862,10 @@ class VAR_text(nn.Module):
         # Classifier head
         self.head_nm = AdaLNBeforeHead(self.C, self.D, norm_layer=norm_layer)
         self.head = nn.Linear(self.C, self.V)
+        
+        # Empty-condition embeddings for classifier-free guidance, set by load_empty_cond (not saved in checkpoints)
+        self.register_buffer('empty_pooler_output', None, persistent=False)
+        self.register_buffer('empty_embedding', None, persistent=False)
     
     def get_logits(self, h_or_h_and_residual: Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]], cond_BD: Optional[torch.Tensor]):
         if not isinstance(h_or_h_and_residual, torch.Tensor):
@@ -725,79 +877,205 @@ class VAR_text(nn.Module):
  
 
 
+    def load_empty_cond(self, files_dir: str):
+        """
+        Load the empty-condition embeddings for classifier-free guidance from files_dir
+        into non-persistent buffers on the model's device, once at build time.
+        """
+        pooler_file, embedding_file = self.EMPTY_COND_FILES
+        device = self.pos_start.device
+        self.empty_pooler_output = torch.from_numpy(np.load(os.path.join(files_dir, pooler_file))).to(device).unsqueeze(0)
+        self.empty_embedding = torch.from_numpy(np.load(os.path.join(files_dir, embedding_file))).to(device).unsqueeze(0)
+    
+    def use_static_kv_cache(self, enable: bool, batch_size: int = 0):
+        """
+        Preallocate the self-attention KV cache for all 3*L tokens (sized from patch_nums) and
+        write each scale in place, instead of growing it with torch.cat at every scale.
+        batch_size > 0 (the CFG-doubled batch) allocates the buffers now instead of on the first scale.
+        """
+        for b in self.blocks:
+            b.attn.set_static_kv_cache(3 * self.L if enable else 0, batch_size=batch_size)
+    
+    def reorder_kv_caches(self, idx_2B: torch.LongTensor):
+        """Gather the self/cross-attention caches of all blocks along the (CFG-doubled) batch dim"""
+        for b in self.blocks:
+            b.attn.reorder_kv_cache(idx_2B)
+            b.cross_attn.reorder_kv_cache(idx_2B)
+
+    def cfg_inputs(self, pooler_output: torch.Tensor, cond_emb: torch.Tensor):
+        """
+        Inputs of the first scale, with the empty condition appended to the batch for classifier-free guidance.
+
+        Returns:
+            cond_BD: (2B, D) pooled condition embedding
+            cond_emb: (2B, N, Ck) token condition for the cross attention
+            lvl_pos: (1, 3L, C) level, position and plane embeddings
+            next_token_map: (2B, 3*first_l, C) transformer input of scale 0
+            f_hat_all: (3B, Cvae, H, W) zero feature maps of the three planes
+        """
+        B = pooler_output.shape[0]
+        assert self.empty_pooler_output is not None, 'empty-condition embeddings are not loaded, call load_empty_cond first'
+        pooler_output = torch.cat((pooler_output, self.empty_pooler_output.expand(pooler_output.shape)), dim=0)
+        cond_emb = torch.cat((cond_emb, self.empty_embedding.expand(cond_emb.shape)), dim=0)
+
+        sos = cond_BD = self.pooler_emb(pooler_output)
+        sos = sos.unsqueeze(1).expand(2 * B, self.first_l, -1) + self.pos_start.expand(2 * B, self.first_l, -1)
+        sos = sos.repeat(1, 3, 1)
+        lvl_pos = self.lvl_embed(self.lvl_1L) + self.pos_1LC + self.plane_embed(self.plane_1L)
+        next_token_map = sos.expand(2 * B, 3, -1) + lvl_pos[:, :3]
+        f_hat_all = sos.new_zeros(3 * B, self.Cvae, self.patch_nums[-1], self.patch_nums[-1])
+        return cond_BD, cond_emb, lvl_pos, next_token_map, f_hat_all
+
+    def cross_kv(self, cond_emb: torch.Tensor) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """Cross-attention (k, v) of the CFG-doubled cond_emb for every block, to pass to scale_logits as cross_kv"""
+        return [b.cross_attn.project_kv(cond_emb) for b in self.blocks]
+
+    def scale_logits(self, si: int, next_token_map: torch.Tensor, cond_BD: torch.Tensor, cond_emb: torch.Tensor,
+                     cfg: Union[float, torch.Tensor], kv_pos: Optional[torch.LongTensor] = None,
+                     cross_kv: Optional[List[Tuple[torch.Tensor, torch.Tensor]]] = None) -> torch.Tensor:
+        """
+        Transformer pass over the tokens of scale si (KV caching enabled), with classifier-free guidance.
+
+        Args:
+            next_token_map: (2B, l, C) inputs of scale si, conditional rows first
+            cond_BD, cond_emb: CFG-doubled conditions from cfg_inputs
+            cfg: Guidance ratio, a scalar or (B, 1, 1)
+            kv_pos: Static KV-cache slots up to scale si (see SelfAttention._write_static_kv), None to let
+                the attention layers track the cache position
+            cross_kv: Cross-attention K/V of every block from cross_kv(cond_emb), None to use the
+                cross-attention caches
+
+        Returns:
+            (B, l, V) guided logits
+        """
+        cond_BD_or_gss = self.shared_ada_lin(cond_BD)
+        x = next_token_map
+        for i, b in enumerate(self.blocks):
+            x = b(x=x, cond_BD=cond_BD_or_gss, dino_condition=cond_emb, attn_bias=None, kv_pos=kv_pos,
+                  cross_kv=None if cross_kv is None else cross_kv[i])
+        logits_BlV = self.get_logits(x, cond_BD)
+        B = logits_BlV.shape[0] // 2
+        t = cfg * (si / self.num_stages_minus_1)
+        return (1+t) * logits_BlV[:B] - t * logits_BlV[B:]
+
+    def next_scale_input(self, si: int, f_hat_all: torch.Tensor, h_BChw: torch.Tensor, lvl_pos: torch.Tensor):
+        """
+        Add the embedded tokens h_BChw of scale si to the feature maps f_hat_all (3B, Cvae, H, W) of all planes.
+
+        Returns:
+            f_hat_all: Updated feature maps
+            next_token_map: (2B, l', C) CFG-doubled transformer input of scale si+1, None after the last scale
+        """
+        f_hat_all, next_token_map = self.vae_quant_proxy[0].get_next_autoregressive_input_triplane(si, len(self.patch_nums), f_hat_all, h_BChw)
+        if si == self.num_stages_minus_1:
+            return f_hat_all, None
+        bg = 3 * sum(pn * pn for pn in self.patch_nums[:si + 1])
+        next_token_map = self.word_embed(next_token_map) + lvl_pos[:, bg:bg + 3 * self.patch_nums[si+1] ** 2]
+        return f_hat_all, next_token_map.repeat(2, 1, 1)
+
+    def decode_triplane(self, f_hat_all: torch.Tensor) -> torch.Tensor:
+        """Decode the final feature maps (3B, Cvae, H, W) of all planes to the triplane latent after the VAE's ViT decoder"""
+        with torch.cuda.amp.autocast(enabled=True, dtype=torch.bfloat16, cache_enabled=True):
+            f_hat_all = self.vae_proxy[0].decoder.superresolution['post_quant_conv'](f_hat_all.to(torch.bfloat16))
+            f_hat_all = f_hat_all.reshape(f_hat_all.shape[0] // 3, -1, f_hat_all.shape[-2], f_hat_all.shape[-1])
+            f_hat_all = self.vae_proxy[0].decoder.superresolution['ldm_upsample'](f_hat_all)
+            f_hat_all = self.vae_proxy[0].decoder.forward_vit_decoder(f_hat_all, 224)
+            return self.vit_decode_postprocess(f_hat_all)
+
     @torch.no_grad()
     def autoregressive_infer_cfg_3D_VAR_text_l2norm(
         self, B: int,
         dino_image_embeddings: Optional[Union[int, torch.LongTensor]], 
         pooler_output: Optional[int] = None,
-        cfg=1.5, top_k=0, top_p=0.0,
-        g_seed: Optional[int] = None,
+        cfg: Union[float, Sequence[float]] = 1.5,
+        top_k: Union[int, Sequence[int]] = 0,
+        top_p: Union[float, Sequence[float]] = 0.0,
+        g_seed: Optional[Union[int, Sequence[Optional[int]]]] = None,
         more_smooth=False,
+        num_candidates: int = 1,
+        fork_scales: Optional[Sequence[int]] = None,
+        num_return: int = 1,
     ) -> torch.Tensor:
         """
         Autoregressive inference with classifier-free guidance for text-to-3D generation.
-        
+
         Args:
             B: Batch size
             dino_image_embeddings: Text embeddings
             pooler_output: Pooled text features
-            cfg: Classifier-free guidance ratio
-            top_k: Top-k sampling parameter
-            top_p: Top-p sampling parameter
-            g_seed: Random seed
+            cfg: Classifier-free guidance ratio, a scalar or one value per item
+            top_k: Top-k sampling parameter, a scalar or one value per item
+            top_p: Top-p sampling parameter, a scalar or one value per item
+            g_seed: Random seed, a scalar or one seed per item
             more_smooth: Whether to use Gumbel softmax for smoother outputs
-            
+            num_candidates: Token maps sampled per branch at each fork scale; > 1 enables reranking,
+                where branches share the KV-cache prefix and are scored by their log-likelihood
+            fork_scales: Scale indices to fork at (None for all scales)
+            num_return: Best branches kept, and returned, per item (at most num_candidates)
+
         Returns:
             Tuple of:
             - Generated triplane latents
             - Generated token indices
+            With reranking both hold B*num_return rows, the branches of each item in a row, best first.
         """
         # Setup RNG if seed provided
-        rng = None if g_seed is None else self.rng.manual_seed(g_seed); rng = self.rng
-
-        # Load empty embeddings for classifier-free guidance
-        empty_pooler = torch.from_numpy(np.load("./files/empty_text_pooler_output.npy")).to(pooler_output.device).unsqueeze(0)
-        empty_dino = torch.from_numpy(np.load("./files/empty_text_embedding.npy")).to(pooler_output.device).unsqueeze(0)
+        per_item = is_per_item(cfg, top_k, top_p, g_seed)
+        if per_item:
+            cfg = torch.tensor(expand_per_item(cfg, B, 'cfg'), dtype=torch.float32, device=pooler_output.device).view(B, 1, 1)
+            top_k, top_p = expand_per_item(top_k, B, 'top_k'), expand_per_item(top_p, B, 'top_p')
+            rngs = make_item_rngs(self.rng, g_seed, B)
+        else:
+            rng = None if g_seed is None else self.rng.manual_seed(g_seed); rng = self.rng
         
-        # Concatenate real and empty embeddings for CFG
-        pooler_output = torch.cat((pooler_output, empty_pooler.expand(pooler_output.shape)), dim=0)
-        dino_image_embeddings = torch.cat((dino_image_embeddings, empty_dino.expand(dino_image_embeddings.shape)), dim=0)
+        # Candidate reranking: fork num_candidates branches at the chosen scales and keep the best num_return
+        reranking = num_candidates > 1
+        if reranking:
+            assert not more_smooth, 'candidate reranking scores sampled tokens, it does not support more_smooth'
+            assert 1 <= num_return <= num_candidates, f'{num_return=} must be in [1, {num_candidates=}]'
+            fork_scales = set(range(len(self.patch_nums)) if fork_scales is None else fork_scales)
+            assert len(fork_scales), 'fork_scales is empty'
+        else:
+            assert num_return == 1, 'num_return > 1 needs num_candidates > 1'
+        num_items, scores = B, None
 
-        # Get initial tokens and positional embeddings
-        sos = cond_BD = self.pooler_emb(pooler_output)
-        sos = sos.unsqueeze(1).expand(2 * B, self.first_l, -1) + self.pos_start.expand(2 * B, self.first_l, -1)
-        sos = sos.repeat(1, 3, 1)
-        
-        # Add level and plane embeddings
-        lvl_pos = self.lvl_embed(self.lvl_1L) + self.pos_1LC + self.plane_embed(self.plane_1L)
-        next_token_map = sos.expand(2 * B, 3, -1) + lvl_pos[:, :3]
-        
-        # Initialize feature maps for each plane
-        cur_L = 0
-        f_hat_list = [sos.new_zeros(B, self.Cvae, self.patch_nums[-1], self.patch_nums[-1]) for _ in range(3)]
+        # CFG-doubled conditions, first-scale input and the feature maps of all planes as one (B*3, Cvae, H, W) tensor
+        cond_BD, dino_image_embeddings, lvl_pos, next_token_map, f_hat_all = self.cfg_inputs(pooler_output, dino_image_embeddings)
 
         # Enable KV caching for transformer blocks
         for b in self.blocks:
             b.attn.kv_caching(True)
+            b.cross_attn.kv_caching(True)
 
         # Generate tokens autoregressively
         for si, pn in enumerate(self.patch_nums):
             ratio = si / self.num_stages_minus_1
-            cur_L += pn*pn*3
 
-            # Forward pass through transformer
-            cond_BD_or_gss = self.shared_ada_lin(cond_BD)
-            x = next_token_map
-            for b in self.blocks:
-                x = b(x=x, cond_BD=cond_BD_or_gss, dino_condition=dino_image_embeddings, attn_bias=None)
-            
-            # Get logits and apply classifier-free guidance
-            logits_BlV = self.get_logits(x, cond_BD)
-            t = cfg * ratio
-            logits_BlV = (1+t) * logits_BlV[:B] - t * logits_BlV[B:]
+            # Transformer pass and classifier-free guidance
+            logits_BlV = self.scale_logits(si, next_token_map, cond_BD, dino_image_embeddings, cfg)
 
-            # Sample next tokens
-            idx_Bl = sample_with_top_k_top_p_(logits_BlV, rng=rng, top_k=top_k, top_p=top_p, num_samples=1)[:, :, 0]
+            # Sample next tokens (num_candidates token maps per branch at a fork scale)
+            K = num_candidates if reranking and si in fork_scales else 1
+            if per_item:
+                idx_BlK = sample_with_top_k_top_p_per_item_(logits_BlV, top_k=top_k, top_p=top_p, rngs=rngs, num_samples=K)
+            else:
+                idx_BlK = sample_with_top_k_top_p_(logits_BlV, rng=rng, top_k=top_k, top_p=top_p, num_samples=K)
+            if not reranking:
+                idx_Bl = idx_BlK[:, :, 0]
+            else:
+                parent, idx_Bl, scores = rerank_candidates(logits_BlV, idx_BlK, scores, num_items, num_return)
+                if parent is not None:
+                    # Continue the kept branches from their parents' KV-cache prefix
+                    parent_2B = torch.cat((parent, parent + B))
+                    self.reorder_kv_caches(parent_2B)
+                    cond_BD, dino_image_embeddings = cond_BD[parent_2B], dino_image_embeddings[parent_2B]
+                    f_hat_all = f_hat_all.view(B, 3, *f_hat_all.shape[1:])[parent].flatten(0, 1)
+                    if si > 0:
+                        g_BL = g_BL[parent]
+                    if per_item:
+                        cfg, idx = cfg[parent], parent.tolist()
+                        top_k, top_p, rngs = [top_k[i] for i in idx], [top_p[i] for i in idx], [rngs[i] for i in idx]
+                    B = parent.shape[0]
             if si == 0:
                 g_BL = idx_Bl
             else:
@@ -810,40 +1088,22 @@ class VAR_text(nn.Module):
             else:
                 gum_t = max(0.27 * (1 - ratio * 0.95), 0.005)
                 embedding = F.normalize(self.vae_quant_proxy[0].embedding.weight, p=2, dim=-1)
-                h_BChw_concate = gumbel_softmax_with_rng(logits_BlV.mul(1 + ratio), tau=gum_t, hard=False, dim=-1, rng=rng) @ embedding.unsqueeze(0)
-
-            # Process embeddings for each plane
-            h_BChw_list = h_BChw_concate.split(int(h_BChw_concate.shape[1]/3), dim=1)
-            next_token_map_list = []
-            for i in range(3):
-                h_BChw = h_BChw_list[i].transpose_(1, 2).reshape(B, self.Cvae, pn, pn)
-                f_hat_list[i], next_token_map_single_plane = self.vae_quant_proxy[0].get_next_autoregressive_input(si, len(self.patch_nums), f_hat_list[i], h_BChw)
-                next_token_map_list.append(next_token_map_single_plane.view(B, self.Cvae, -1).transpose(1, 2))
-
-            # Prepare next token map
-            if si != self.num_stages_minus_1:
-                next_token_map = torch.cat(next_token_map_list, dim=1)
-                next_token_map = self.word_embed(next_token_map) + lvl_pos[:, cur_L:cur_L + 3 * self.patch_nums[si+1] ** 2]
-                next_token_map = next_token_map.repeat(2, 1, 1)
+                if per_item:
+                    soft_BlV = torch.cat([gumbel_softmax_with_rng(logits_BlV[b:b+1].mul(1 + ratio), tau=gum_t, hard=False, dim=-1, rng=rngs[b]) for b in range(B)], dim=0)
+                else:
+                    soft_BlV = gumbel_softmax_with_rng(logits_BlV.mul(1 + ratio), tau=gum_t, hard=False, dim=-1, rng=rng)
+                h_BChw_concate = soft_BlV @ embedding.unsqueeze(0)
+
+            # Update all three planes in one batch and prepare the next token map
+            f_hat_all, next_token_map = self.next_scale_input(si, f_hat_all, h_BChw_concate, lvl_pos)
 
         # Disable KV caching
         for b in self.blocks:
             b.attn.kv_caching(False)
-
-        # Combine feature maps from all planes
-        f_hat_all = torch.zeros((3 * B, self.Cvae, self.patch_nums[-1], self.patch_nums[-1]), device=f_hat_list[0].device, dtype=f_hat_list[0].dtype)
-        f_hat_all[0::3] = f_hat_list[0]
-        f_hat_all[1::3] = f_hat_list[1]
-        f_hat_all[2::3] = f_hat_list[2]
+            b.cross_attn.kv_caching(False)
 
         # Decode feature maps to triplane representation
-        with torch.cuda.amp.autocast(enabled=True, dtype=torch.bfloat16, cache_enabled=True):
-            f_hat_all = self.vae_proxy[0].decoder.superresolution['post_quant_conv'](f_hat_all.to(torch.bfloat16))
-            f_hat_all = f_hat_all.reshape(f_hat_all.shape[0] // 3, -1, f_hat_all.shape[-2], f_hat_all.shape[-1])
-            f_hat_all = self.vae_proxy[0].decoder.superresolution['ldm_upsample'](f_hat_all)
-            f_hat_all = self.vae_proxy[0].decoder.forward_vit_decoder(f_hat_all, 224)
-            latent_after_vit = self.vit_decode_postprocess(f_hat_all)
-            return latent_after_vit, g_BL
+        return self.decode_triplane(f_hat_all), g_BL
         
     @torch.no_grad()
     def reconstruct_gt_Bl_idx(
@@ -871,15 +1131,12 @@ class VAR_text(nn.Module):
             rng = self.rng
             
         cur_L = 0
-        f_hat_list = [
-            torch.zeros(B, self.Cvae, self.patch_nums[-1], self.patch_nums[-1], device=gt_idx.device),
-            torch.zeros(B, self.Cvae, self.patch_nums[-1], self.patch_nums[-1], device=gt_idx.device),
-            torch.zeros(B, self.Cvae, self.patch_nums[-1], self.patch_nums[-1], device=gt_idx.device)
-        ]
+        f_hat_all = torch.zeros(3 * B, self.Cvae, self.patch_nums[-1], self.patch_nums[-1], device=gt_idx.device)
         
         # Enable KV caching
         for b in self.blocks:
             b.attn.kv_caching(True)
+            b.cross_attn.kv_caching(True)
             
         # Progressive reconstruction
         for si, pn in enumerate(self.patch_nums):
@@ -890,27 +1147,15 @@ class VAR_text(nn.Module):
             embedding = F.normalize(self.vae_quant_proxy[0].embedding.weight, p=2, dim=-1)
             h_BChw_concate = embedding[idx_Bl]
             
-            # Process each plane
-            h_BChw_list = h_BChw_concate.split(int(h_BChw_concate.shape[1]/3), dim=1)
-            for i in range(3):
-                h_BChw = h_BChw_list[i].transpose_(1, 2).reshape(B, self.Cvae, pn, pn)
-                f_hat_list[i], _ = self.vae_quant_proxy[0].get_next_autoregressive_input(
-                    si, len(self.patch_nums), f_hat_list[i], h_BChw)
+            # Update all three planes in one batch
+            f_hat_all, _ = self.vae_quant_proxy[0].get_next_autoregressive_input_triplane(
+                si, len(self.patch_nums), f_hat_all, h_BChw_concate)
                     
         # Disable KV caching
         for b in self.blocks:
             b.attn.kv_caching(False)
+            b.cross_attn.kv_caching(False)
             
-        # Combine feature maps
-        f_hat_all = torch.zeros(
-            (3 * B, self.Cvae, self.patch_nums[-1], self.patch_nums[-1]),
-            device=f_hat_list[0].device,
-            dtype=f_hat_list[0].dtype
-        )
-        f_hat_all[0::3] = f_hat_list[0]
-        f_hat_all[1::3] = f_hat_list[1]
-        f_hat_all[2::3] = f_hat_list[2]
-
         # Decode feature maps
         with torch.cuda.amp.autocast(enabled=True, dtype=torch.bfloat16, cache_enabled=True):
             f_hat_all = self.vae_proxy[0].decoder.superresolution['post_quant_conv'](f_hat_all.to(torch.bfloat16))
@@ -280,6 +280,7 @@ def create_3DAE_model(
         lrm_decoder=False,
         gs_rendering=False,
         return_all_dit_layers=False,
+        vq_fused=False,
         *args,
         **kwargs):
 
@@ -443,6 +444,7 @@ def create_3DAE_model(
         vae_p=vae_p,
         ldm_z_channels=ldm_z_channels,
         ldm_embed_dim=ldm_embed_dim,
+        vq_fused=vq_fused,
     )
 
     decoder = dnnlib.util.construct_class_by_name(**decoder_kwargs)
@@ -525,6 +527,7 @@ def create_3DAE_model_mesh(
         return_all_dit_layers=False,
         grid_size=128,
         grid_scale=2.005,
+        vq_fused=False,
         *args,
         **kwargs):
 
@@ -690,6 +693,7 @@ def create_3DAE_model_mesh(
         vae_p=vae_p,
         ldm_z_channels=ldm_z_channels,
         ldm_embed_dim=ldm_embed_dim,
+        vq_fused=vq_fused,
     )
 
     decoder = dnnlib.util.construct_class_by_name(**decoder_kwargs)
@@ -791,6 +795,7 @@ def model_encoder_defaults():
         return_all_dit_layers=False,
         lrm_decoder=False,
         gs_rendering=False,
+        vq_fused=False,  # train the multi-scale quantizer with VectorQuantizer2.forward_fused
     )
 
 
@@ -1250,4 +1255,8 @@ def dataset_defaults():
         append_depth=False,
         plucker_embedding=False,
         gs_cam_format=False,
+        gpu_post_process=False,  # post-process raw uint8 chunks batched on the GPU (objaverse VAE training set)
+        decode_cache_dir='',  # LRU cache of decoded chunk images shared by the loader workers, e.g. /dev/shm/sar3d_chunks
+        decode_cache_gb=32.0,
+        chunk_format='png',  # 'png': PNG/JPEG chunk tiles, 'lz4': blobs converted by datasets/chunk_format.py
     )
\ No newline at end of file
@@ -483,6 +483,7 @@ class OSGDecoder(torch.nn.Module):
     1. RGB colors through a MLP with sigmoid activation
     2. Density values through a separate MLP
     """
+    view_dependent = False  # ray_directions are ignored, the outputs can be baked (see FeatureVolumeCache)
 
     def __init__(self, n_features, options):
         super().__init__()
@@ -562,6 +563,8 @@ class OSGDecoderInstantMesh(nn.Module):
     Reference:
     EG3D: https://github.com/NVlabs/eg3d/blob/main/eg3d/training/triplane.py#L112
     """
+    view_dependent = False  # ray_directions are ignored, the outputs can be baked (see FeatureVolumeCache)
+
     def __init__(self, n_features: int,
                  hidden_dim: int = 64, num_layers: int = 4, activation: nn.Module = nn.ReLU):
         super().__init__()
@@ -614,6 +617,8 @@ class LRMOSGDecoder(nn.Module):
     Reference:
     EG3D: https://github.com/NVlabs/eg3d/blob/main/eg3d/training/triplane.py#L112
     """
+    view_dependent = False  # ray_directions are ignored, the outputs can be baked (see FeatureVolumeCache)
+
     def __init__(self, n_features: int,
                  hidden_dim: int = 64, num_layers: int = 4, activation: nn.Module = nn.ReLU):
         super().__init__()
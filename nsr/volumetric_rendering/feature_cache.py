@@ -0,0 +1,108 @@
+"""
+Asset-level render cache: the decoded rgb and raw sigma of one triplane baked on a voxel lattice.
+
+Rendering many views of the same triplane samples the three planes and runs the decoder MLP for
+every sample of every view. FeatureVolumeCache.bake decodes the asset once on a resolution^3 lattice
+spanning the plane domain (box_warp), ImportanceRenderer._run_model then answers queries with one
+trilinear grid_sample into the lattice. With an OccupancyGrid only the lattice points in occupied
+cells are decoded, the others get zero density and zero color like the samples the renderer skips.
+
+The cache holds decoder outputs, so it only stands in for decoders that ignore the ray directions
+(view_dependent = False); any other decoder keeps running exactly. It also answers only for the
+planes it was baked from (or views of them), other planes are decoded as usual.
+"""
+
+from typing import Callable, Dict
+
+import torch
+from torch.nn import functional as F
+
+from .occupancy_grid import OccupancyGrid
+
+
+class FeatureVolumeCache:
+    """
+    Decoded (raw sigma, rgb) of B assets (B = 1 is shared by every batch element) on a lattice.
+
+    Args:
+        volume: (B, 1 + C, R, R, R) raw sigma then rgb, indexed by x, y, z lattice point
+        bound: The lattice spans [-bound, bound] on every axis
+        decoder: The decoder the values were produced by, the cache answers only for it
+        planes: The planes the values were decoded from, the cache answers only for them
+    """
+    def __init__(self, volume: torch.Tensor, bound: float, decoder: torch.nn.Module, planes: torch.Tensor):
+        self.volume = volume
+        self.bound = bound
+        self.decoder = decoder
+        # Holding the planes keeps their memory from being reused by other planes, see answers
+        self.planes = planes
+        self.planes_version = planes._version
+
+    @classmethod
+    @torch.inference_mode()
+    def bake(cls, query_fn: Callable[[torch.Tensor], Dict[str, torch.Tensor]], decoder: torch.nn.Module, planes: torch.Tensor,
+             bound: float, device,
+             resolution: int = 128, occupancy_grid: OccupancyGrid = None, dtype: torch.dtype = None,
+             verbose: bool = False) -> 'FeatureVolumeCache':
+        """
+        Args:
+            query_fn: Maps world points (1, P, 3) to the decoder outputs {'rgb': (1, P, C), 'sigma': (1, P, 1)},
+                e.g. forward_points(planes, .)
+            decoder: Decoder behind query_fn
+            planes: (1, ...) planes behind query_fn
+            bound: Half extent of the lattice (box_warp / 2)
+            resolution: Lattice points per axis
+            occupancy_grid: Decode only the points in its occupied cells
+            dtype: Storage type, defaults to float16 on cuda and float32 otherwise
+            verbose: Print how many lattice points were decoded
+        """
+        if dtype is None:
+            dtype = torch.float16 if torch.device(device).type == 'cuda' else torch.float32
+        ticks = torch.linspace(-bound, bound, resolution, device=device)
+        points = torch.stack(torch.meshgrid(ticks, ticks, ticks, indexing='ij'), dim=-1).reshape(1, -1, 3)
+
+        if occupancy_grid is not None:
+            idx = occupancy_grid.sample(points)[0].nonzero(as_tuple=True)[0]
+        else:
+            idx = torch.arange(points.shape[1], device=device)
+        out = query_fn(points[:, idx])
+
+        volume = torch.zeros(points.shape[1], 1 + out['rgb'].shape[-1], device=device, dtype=dtype)
+        if occupancy_grid is not None:
+            # zero density after softplus, as _forward_pass gives out-of-box samples
+            volume[:, 0] = torch.finfo(dtype).min / 3
+        volume[idx, :1] = out['sigma'][0].to(dtype)
+        volume[idx, 1:] = out['rgb'][0].to(dtype)
+        volume = volume.T.reshape(1, -1, resolution, resolution, resolution).contiguous()
+        if verbose:
+            print(f'[FeatureVolumeCache] baked {len(idx)} / {points.shape[1]} lattice points at {resolution}^3')
+        return cls(volume, bound, decoder, planes)
+
+    def answers(self, decoder: torch.nn.Module, planes: torch.Tensor) -> bool:
+        """Whether queries of decoder on planes can be served from the cache: planes must be an unmodified view
+        of the baked planes, expanded along the batch (stride 0) if there are several"""
+        return (decoder is self.decoder and not getattr(decoder, 'view_dependent', True)
+                and planes.data_ptr() == self.planes.data_ptr()
+                and planes[0].numel() == self.planes[0].numel()
+                and (planes.shape[0] == 1 or planes.stride(0) == 0)
+                and planes._version == self.planes_version)
+
+    @torch.inference_mode()
+    def query(self, points: torch.Tensor) -> Dict[str, torch.Tensor]:
+        """
+        Args:
+            points: (B, P, 3) world points
+
+        Returns:
+            {'rgb': (B, P, C), 'sigma': (B, P, 1)}, trilinear in the lattice, clamped to its border outside
+        """
+        B = points.shape[0]
+        volume = self.volume if self.volume.shape[0] == B else self.volume.expand(B, -1, -1, -1, -1)
+        g = (points / self.bound).flip(-1)[:, :, None, None].to(volume.dtype)
+        out = F.grid_sample(volume, g, mode='bilinear', padding_mode='border', align_corners=True)
+        out = out.reshape(B, volume.shape[1], -1).permute(0, 2, 1).float()
+        return {'rgb': out[..., 1:], 'sigma': out[..., :1]}
+
+    def __repr__(self):
+        B, C, R = self.volume.shape[:3]
+        return f'{type(self).__name__}(B={B}, channels={C}, resolution={R}, {self.volume.numel() * self.volume.element_size() / 1024 ** 2:.1f}MB)'
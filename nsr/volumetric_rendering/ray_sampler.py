@@ -19,6 +19,67 @@ import random
 HUGE_NUMBER = 1e10
 TINY_NUMBER = 1e-6  # float32 only has 7 decimal digits precision
 
+# Pixel-center grids, cached per (resolution, device); shared read-only by every ray generator below
+_PIXEL_GRIDS = {}
+
+
+def pixel_grid(resolution, device='cpu'):
+    """
+    Pixel centers of a resolution x resolution image in [0, 1], as (resolution**2, 2) xy coordinates
+    (row-major, x fastest). Cached, callers must not modify the returned tensor.
+    """
+    key = (resolution, str(device))
+    if key not in _PIXEL_GRIDS:
+        # a normal tensor even if first requested under inference_mode, so later autograd code can use it
+        with torch.inference_mode(False), torch.no_grad():
+            _PIXEL_GRIDS[key] = _make_pixel_grid(resolution, device)
+    return _PIXEL_GRIDS[key]
+
+
+def _make_pixel_grid(resolution, device):
+    uv = torch.stack(
+        torch.meshgrid(torch.arange(resolution, dtype=torch.float32, device=device),
+                       torch.arange(resolution, dtype=torch.float32, device=device),
+                       indexing='ij')) * (1. / resolution) + (0.5 / resolution)
+    return uv.flip(0).reshape(2, -1).transpose(1, 0).contiguous()  # ij -> xy
+
+
+def gen_rays_batch(c2w, fx, fy, cx, cy, resolution):
+    """
+    Rays through the pixel centers of N pinhole cameras (no skew) in one batched pass.
+
+    c2w: (N, 4, 4) cam2world, OpenCV convention
+    fx, fy, cx, cy: (N,) normalized intrinsics
+    resolution: int
+
+    ray_origins: (N, resolution, resolution, 3)
+    ray_dirs: (N, resolution, resolution, 3), unit length
+    """
+    N = c2w.shape[0]
+    uv = pixel_grid(resolution, c2w.device)
+    dirs = torch.stack(((uv[None, :, 0] - cx[:, None]) / fx[:, None],
+                        (uv[None, :, 1] - cy[:, None]) / fy[:, None],
+                        torch.ones(N, uv.shape[0], dtype=uv.dtype, device=uv.device)), dim=-1)  # N M 3
+    dirs = torch.nn.functional.normalize(dirs, dim=-1)
+    dirs = torch.bmm(dirs, c2w[:, :3, :3].transpose(1, 2)).view(N, resolution, resolution, 3)
+    origins = c2w[:, None, None, :3, 3].expand_as(dirs)
+    return origins, dirs
+
+
+def plucker_rays(c, resolution):
+    """
+    Plucker coordinates (o x d, d) of N cameras in the 25-dim layout (16 cam2world + 9 intrinsics).
+
+    c: (N, 25)
+    resolution: int
+
+    rays_plucker: (N, 6, resolution, resolution)
+    """
+    intrinsics = c[:, 16:25]
+    rays_o, rays_d = gen_rays_batch(c[:, :16].reshape(-1, 4, 4), intrinsics[:, 0], intrinsics[:, 4],
+                                    intrinsics[:, 2], intrinsics[:, 5], resolution)
+    return torch.cat([torch.cross(rays_o, rays_d, dim=-1), rays_d], dim=-1).permute(0, 3, 1, 2)
+
 
 ######################################################################################
 # wrapper to simplify the use of nerfnet
@@ -178,21 +239,9 @@ class RaySampler(torch.nn.Module):
         return all_uv, ray_bboxes
 
     def create_uv(self, resolution, cam2world_matrix):
-
-        uv = torch.stack(
-            torch.meshgrid(torch.arange(resolution,
-                                        dtype=torch.float32,
-                                        device=cam2world_matrix.device),
-                           torch.arange(resolution,
-                                        dtype=torch.float32,
-                                        device=cam2world_matrix.device),
-                           indexing='ij')) * (1. / resolution) + (0.5 /
-                                                                  resolution)
-
-        uv = uv.flip(0).reshape(2, -1).transpose(1, 0)  # why
-        uv = uv.unsqueeze(0).repeat(cam2world_matrix.shape[0], 1, 1)
-
-        return uv
+        # copied from the cached grid, so callers may modify the result in place
+        uv = pixel_grid(resolution, cam2world_matrix.device)
+        return uv.unsqueeze(0).repeat(cam2world_matrix.shape[0], 1, 1)
 
     def forward(self, cam2world_matrix, intrinsics, resolution, fg_mask=None):
         """
@@ -15,12 +15,15 @@ ray, and computes pixel colors using the volume rendering equation.
 import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 
 from .ray_marcher import MipRayMarcher2
 from . import math_utils
 from pdb import set_trace as st
 from .ray_sampler import depth2pts_outside, HUGE_NUMBER, TINY_NUMBER
+from .occupancy_grid import OccupancyGrid
+from .feature_cache import FeatureVolumeCache
 
 
 def generate_planes():
@@ -129,6 +132,34 @@ class ImportanceRenderer(torch.nn.Module):
         super().__init__()
         self.ray_marcher = MipRayMarcher2()
         self.plane_axes = generate_planes()
+        # Decoder activation bytes per query point, measured once per (decoder, planes shape), see run_model_chunked
+        self._bytes_per_point = {}
+        # Empty-space skipping and early ray termination (inference only), see set_occupancy_grid
+        self.occupancy_grid = None
+        self.termination_eps = 1e-3
+        self.termination_segments = 4
+        # Baked decoder outputs of the asset being rendered (inference only), see set_feature_cache
+        self.feature_cache = None
+
+    def set_occupancy_grid(self, occupancy_grid: OccupancyGrid = None, termination_eps=1e-3, termination_segments=4):
+        """ Skip samples in empty cells of occupancy_grid (baked from the planes about to be rendered) and stop
+            decoding rays whose transmittance fell below termination_eps, checked after each of termination_segments
+            parts of the coarse samples. Only applies without grad; None turns it off.
+
+            Skipped and terminated samples get zero density and color. The result approximates the exact render:
+            skipping is bounded by the density_thres of the grid (see occupancy_grid.py), and the samples behind
+            a terminated ray carry at most termination_eps of its weight, so they change its color by at most
+            termination_eps times the largest color.
+        """
+        self.occupancy_grid = occupancy_grid
+        self.termination_eps = termination_eps
+        self.termination_segments = termination_segments
+
+    def set_feature_cache(self, feature_cache: FeatureVolumeCache = None):
+        """ Answer _run_model from feature_cache for the decoder and planes it was baked from, if that decoder is
+            not view dependent. Only applies without grad; None turns it off.
+        """
+        self.feature_cache = feature_cache
 
     def forward(self,
                 planes,
@@ -177,9 +208,15 @@ class ImportanceRenderer(torch.nn.Module):
         sample_directions = ray_directions.unsqueeze(-2).expand(
             -1, -1, samples_per_ray, -1).reshape(batch_size, -1, 3)
 
-        colors_coarse, densities_coarse = self.run_model(
-            planes, decoder, sample_coordinates, sample_directions,
-            rendering_options, batch_size, num_rays, samples_per_ray)
+        skip_empty = self.occupancy_grid is not None and not torch.is_grad_enabled()
+        if skip_empty:
+            colors_coarse, densities_coarse, term_depth = self._coarse_pass_skipping(
+                planes, decoder, sample_coordinates, sample_directions,
+                depths_coarse, rendering_options)
+        else:
+            colors_coarse, densities_coarse = self.run_model(
+                planes, decoder, sample_coordinates, sample_directions,
+                rendering_options, batch_size, num_rays, samples_per_ray)
 
         colors_coarse = colors_coarse.reshape(batch_size, num_rays,
                                               samples_per_ray,
@@ -216,9 +253,17 @@ class ImportanceRenderer(torch.nn.Module):
                 depths_fine * ray_directions.unsqueeze(-2)).reshape(
                     batch_size, -1, 3)
 
-            colors_fine, densities_fine = self.run_model(
-                planes, decoder, sample_coordinates, sample_directions,
-                rendering_options, batch_size, num_rays, N_importance)
+            if skip_empty:
+                # Skip empty cells and samples behind the termination depth of their ray
+                occupied = self.occupancy_grid.sample(sample_coordinates)
+                mask = occupied & (depths_fine[..., 0] <= term_depth.unsqueeze(-1)).reshape(batch_size, -1)
+                colors_fine, densities_fine = self._run_model_skipping(
+                    planes, decoder, sample_coordinates, sample_directions,
+                    mask, rendering_options)
+            else:
+                colors_fine, densities_fine = self.run_model(
+                    planes, decoder, sample_coordinates, sample_directions,
+                    rendering_options, batch_size, num_rays, N_importance)
             # colors_fine = out['rgb']
             # densities_fine = out['sigma']
             colors_fine = colors_fine.reshape(batch_size, num_rays,
@@ -307,21 +352,148 @@ class ImportanceRenderer(torch.nn.Module):
         # return rgb_final, depth_final, weights.sum(2)
         return ret_dict
 
+    def _run_model_skipping(self, planes, decoder, sample_coordinates,
+                            sample_directions, mask, options):
+        """ _run_model on the samples in mask (B, P) only, the others get zero density and color.
+            returns colors (B, P, C) and densities (B, P, 1)
+        """
+        B, P = mask.shape
+        # same raw sigma as _forward_pass gives out-of-box samples, zero density after softplus
+        colors = None
+        densities = sample_coordinates.new_full((B, P, 1), torch.finfo(sample_coordinates.dtype).min / 3)
+        for b in range(B):
+            idx = mask[b].nonzero(as_tuple=True)[0]
+            if len(idx) == 0:
+                continue
+            out = self.run_model_chunked(planes[b:b + 1], decoder,
+                                         sample_coordinates[b:b + 1, idx], options,
+                                         sample_directions=sample_directions[b:b + 1, idx])
+            if colors is None:
+                colors = out['rgb'].new_zeros(B, P, out['rgb'].shape[-1])
+            colors[b, idx] = out['rgb'][0]
+            densities[b, idx] = out['sigma'][0].to(densities.dtype)
+        if colors is None:
+            colors = sample_coordinates.new_zeros(B, P, decoder.decoder_output_dim_rgb)
+        return colors, densities
+
+    def _coarse_pass_skipping(self, planes, decoder, sample_coordinates,
+                              sample_directions, depths_coarse, options):
+        """ Coarse pass over the occupied samples, in segments along the rays so that rays whose
+            transmittance fell below termination_eps are not decoded further.
+            returns colors (B, R, S, C), densities (B, R, S, 1) and the termination depth (B, R) of every ray
+        """
+        batch_size, num_rays, samples_per_ray, _ = depths_coarse.shape
+        occupied = self.occupancy_grid.sample(sample_coordinates)
+
+        # Decode the neighbours of occupied samples too, so every interval touching one is exact
+        occupied = F.max_pool1d(occupied.reshape(-1, 1, samples_per_ray).float(),
+                                kernel_size=3, stride=1, padding=1) > 0
+        occupied = occupied.reshape(batch_size, num_rays, samples_per_ray)
+
+        coords = sample_coordinates.reshape(batch_size, num_rays, samples_per_ray, 3)
+        dirs = sample_directions.reshape(batch_size, num_rays, samples_per_ray, 3)
+        densities = None
+        colors = None
+        term_depth = torch.full((batch_size, num_rays), float('inf'), device=depths_coarse.device, dtype=depths_coarse.dtype)
+        alive = torch.ones(batch_size, num_rays, dtype=torch.bool, device=depths_coarse.device)
+
+        # at least 2 samples per segment, the ray marcher needs an interval
+        num_segments = max(1, min(self.termination_segments, samples_per_ray // 2))
+        bounds = np.linspace(0, samples_per_ray, num_segments + 1).astype(int)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            n = end - start
+            mask = occupied[:, :, start:end] & alive.unsqueeze(-1)
+            colors_seg, densities_seg = self._run_model_skipping(
+                planes, decoder,
+                coords[:, :, start:end].reshape(batch_size, -1, 3),
+                dirs[:, :, start:end].reshape(batch_size, -1, 3),
+                mask.reshape(batch_size, -1), options)
+            if colors is None:
+                colors = colors_seg.new_zeros(batch_size, num_rays, samples_per_ray, colors_seg.shape[-1])
+                densities = densities_seg.new_empty(batch_size, num_rays, samples_per_ray, 1)
+            colors[:, :, start:end] = colors_seg.reshape(batch_size, num_rays, n, -1)
+            densities[:, :, start:end] = densities_seg.reshape(batch_size, num_rays, n, 1)
+
+            if end < samples_per_ray:
+                # transmittance after the samples marched so far
+                _, _, visibility, _ = self.ray_marcher(colors[:, :, :end], densities[:, :, :end],
+                                                       depths_coarse[:, :, :end], options)
+                terminated = alive & (visibility.reshape(batch_size, num_rays) < self.termination_eps)
+                term_depth[terminated] = depths_coarse[:, :, end - 1, 0][terminated]
+                alive &= ~terminated
+
+        return colors, densities, term_depth
+
     # old run_model
     def _run_model(self, planes, decoder, sample_coordinates,
                    sample_directions, options):
-        sampled_features = sample_from_planes(self.plane_axes,
-                                              planes,
-                                              sample_coordinates,
-                                              padding_mode='zeros',
-                                              box_warp=options['box_warp'])
+        if self.feature_cache is not None and not torch.is_grad_enabled() and self.feature_cache.answers(decoder, planes):
+            out = self.feature_cache.query(sample_coordinates)
+        else:
+            sampled_features = sample_from_planes(self.plane_axes,
+                                                  planes,
+                                                  sample_coordinates,
+                                                  padding_mode='zeros',
+                                                  box_warp=options['box_warp'])
 
-        out = decoder(sampled_features, sample_directions)
+            out = decoder(sampled_features, sample_directions)
         if options.get('density_noise', 0) > 0:
             out['sigma'] += torch.randn_like(
                 out['sigma']) * options['density_noise']
         return out
 
+    def run_model_chunked(self, planes, decoder, sample_coordinates, options,
+                          sample_directions=None, chunk_size=None, mem_budget_gb=None, probe_size=4096):
+        """ _run_model over many query points (N, P, 3), chunk after chunk into preallocated outputs.
+
+            Without chunk_size, chunks are sized from the activation memory per point (measured on a first
+            probe chunk and cached) and mem_budget_gb, or half of the free device memory if that is None.
+            With grad enabled and no chunk_size, all points run in one pass (autograd keeps the activations
+            of every chunk anyway). sample_directions (N, P, 3) default to zeros.
+            returns the decoder outputs, each (N, P, ...)
+        """
+        N, P = sample_coordinates.shape[:2]
+        device = sample_coordinates.device
+
+        def run(start, end):
+            points = sample_coordinates[:, start:end]
+            dirs = torch.zeros_like(points) if sample_directions is None else sample_directions[:, start:end]
+            return self._run_model(planes, decoder, points, dirs, options)
+
+        if chunk_size is None and torch.is_grad_enabled():
+            return run(0, P)
+
+        key = (id(decoder), tuple(planes.shape), planes.dtype)
+        if chunk_size is None and device.type != 'cuda':
+            chunk_size = 2**16
+        elif chunk_size is None and key in self._bytes_per_point:
+            chunk_size = self._chunk_size_from_budget(key, N, device, mem_budget_gb, probe_size)
+        probe = chunk_size is None
+
+        first = min(P, probe_size if probe else chunk_size)
+        if probe:
+            torch.cuda.reset_peak_memory_stats(device)
+            base = torch.cuda.memory_allocated(device)
+        out = run(0, first)
+        if probe:
+            self._bytes_per_point[key] = (torch.cuda.max_memory_allocated(device) - base) / (N * first)
+            chunk_size = self._chunk_size_from_budget(key, N, device, mem_budget_gb, probe_size)
+        if first == P:
+            return out
+
+        outputs = {k: v.new_empty(N, P, *v.shape[2:]) for k, v in out.items()}
+        for k, v in out.items():
+            outputs[k][:, :first] = v
+        for start in range(first, P, chunk_size):
+            end = min(start + chunk_size, P)
+            for k, v in run(start, end).items():
+                outputs[k][:, start:end] = v
+        return outputs
+
+    def _chunk_size_from_budget(self, key, N, device, mem_budget_gb, min_size):
+        budget = mem_budget_gb * 1024**3 if mem_budget_gb is not None else torch.cuda.mem_get_info(device)[0] * 0.5
+        return max(min_size, int(budget / max(self._bytes_per_point[key], 1) / N))
+
     def run_model(self, planes, decoder, sample_coordinates, sample_directions,
                   rendering_options, batch_size, num_rays, samples_per_ray):
         """ a compat wrapper for Objaverse (bbox-sampling) and FFHQ/Shapenet-based rendering (ray-start/end sampling).
@@ -345,8 +517,8 @@ class ImportanceRenderer(torch.nn.Module):
                 samples_per_ray=samples_per_ray,
             )
         else:
-            out = self._run_model(planes, decoder, sample_coordinates,
-                                  sample_directions, rendering_options)
+            out = self.run_model_chunked(planes, decoder, sample_coordinates,
+                                         rendering_options, sample_directions=sample_directions)
             colors = out['rgb']
             densities = out['sigma']
 
@@ -385,8 +557,8 @@ class ImportanceRenderer(torch.nn.Module):
         mask_inbox = mask_inbox.all(-1) # np.save('box.npy', mask_inbox.detach().cpu().numpy())
 
         # forward model according to all samples
-        _out = self._run_model(planes, decoder, sample_coordinates,
-                               sample_directions, rendering_options)
+        _out = self.run_model_chunked(planes, decoder, sample_coordinates,
+                                      rendering_options, sample_directions=sample_directions)
 
         # set out-of-box samples to zeros(rgb) & -inf(sigma)
         SAFE_GUARD = 3
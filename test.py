@@ -5,7 +5,7 @@ and generates 3D models with rendered videos.
 
 Key steps:
 1. Load and preprocess input images/text prompts
-2. Extract DINO/CLIP features
+2. Extract DINO/CLIP features (encoders are loaded once, features optionally cached on disk)
 3. Generate triplane representation 
 4. Render 3D models with camera views
 """
@@ -15,12 +15,15 @@ import sys
 import time
 import torch
 from PIL import Image
-from transformers import AutoImageProcessor, Dinov2Model
 import json
+from functools import partial
 # Import custom modules
 import utils.dist as dist
 from utils import arg_util, misc
+from utils.cond_encoder import ConditionEncoder
+from utils.mesh_export import MeshExportPool
 from utils.render_utils import render_video_given_triplane, render_video_given_triplane_mesh
+from utils.token_store import TOKEN_EXT, save_tokens
 
 # Import optimized transformer components
 from xformers.triton import FusedLayerNorm as LayerNorm
@@ -94,6 +97,7 @@ def build_everything(args: arg_util.Args):
             print(f"Downloaded VAE checkpoint to {vae_ckpt}")
     
     vae_local.load_state_dict(torch.load(vae_ckpt, map_location='cpu'), strict=True)
+    var_wo_ddp.use_static_kv_cache(args.static_kv)
 
     # Compile and wrap models
     vae_local = args.compile_model(vae_local, args.vfast)
@@ -140,20 +144,18 @@ def main_test():
     # Initialize
     args = arg_util.init_dist_and_get_args()
     sar3d = build_everything(args)
+    encoder = ConditionEncoder(device=dist.get_device(), cache_dir=args.feat_cache_dir)
     
     if args.text_conditioned:
         test_promts = json.load(open(args.text_json_path))['test_promts']
-        for clip_text in test_promts:
-            clip_feats= extract_clip_features(clip_text)
-            name = clip_text.replace(" ", "_")
-            save_dir = os.path.join(args.save_path, name, str(int(time.time())))
-            print(f"sampling...")
-            with torch.inference_mode():
-                triplane, g_BL = generate_triplane_text(sar3d, clip_feats)
-                print(f"sample completed!")
-                print(f"mesh dumping and rendering...")
-                render_results(args, sar3d, triplane, g_BL, name, save_dir)
-                print(f"rendering completed!")
+
+        def text_jobs():
+            for clip_text in test_promts:
+                name = clip_text.replace(" ", "_")
+                save_dir = os.path.join(args.save_path, name, str(int(time.time())))
+                yield (name, save_dir), clip_text
+
+        jobs, encode_fn, generate_fn = text_jobs(), encoder.encode_texts, generate_triplane_text
     else:
         # Get input images
         png_files = [
@@ -163,27 +165,83 @@ def main_test():
         ]
         print(f"Found {len(png_files)} images to process")
 
-        # Process each image
-        for png_file in png_files:
-            name = os.path.splitext(os.path.basename(png_file))[0]
-            save_dir = os.path.join(args.save_path, name, str(int(time.time())))
-            os.makedirs(save_dir, exist_ok=True)
-
-            # Load and preprocess image
-            img = preprocess_image(png_file, save_dir)
-            
-            # Extract DINO features
-            dino_feats = extract_dino_features(img)
-            
-            # Generate 3D reconstruction
+        def image_jobs():
+            for png_file in png_files:
+                name = os.path.splitext(os.path.basename(png_file))[0]
+                save_dir = os.path.join(args.save_path, name, str(int(time.time())))
+                os.makedirs(save_dir, exist_ok=True)
+
+                # Load and preprocess image
+                yield (name, save_dir), preprocess_image(png_file, save_dir)
+
+        jobs, encode_fn, generate_fn = image_jobs(), encoder.encode_images, generate_triplane
+
+    # Sample args.infer_bs conditions per AR pass and render each result as soon as its batch is done
+    # With args.n_cand > 1, every item keeps its args.n_return best branches instead of being resampled from scratch
+    sampling_kwargs = dict(
+        num_candidates=args.n_cand, num_return=args.n_return,
+        fork_scales=tuple(map(int, args.fork_si.split('_'))) if args.fork_si else None,
+    )
+    if args.ar_engine:
+        # Fixed-shape engine: every scale is compiled once for batch size args.infer_bs and replayed
+        from models import VARInferenceEngine, check_engine
+        assert args.n_cand == 1, 'the inference engine does not support candidate reranking'
+        compile_mode = None if args.ar_engine == 'eager' else args.ar_engine
+        if args.ar_engine_check:
+            # Same tokens as the sampling loop, eagerly and with the compiled (replayed) steps, on the empty condition
+            var = sar3d.var_wo_ddp
             with torch.inference_mode():
-                print(f"sampling...")
-                triplane, g_BL = generate_triplane(sar3d, dino_feats)
-                print(f"sample completed!")
-                print(f"mesh dumping and rendering...")
-                render_results(args, sar3d, triplane, g_BL, name, save_dir)
+                check_engine(var, var.empty_embedding.expand(args.infer_bs, -1, -1), var.empty_pooler_output.expand(args.infer_bs, -1),
+                             compile_modes=(None, compile_mode) if compile_mode else (None,), cfg=4, top_k=10, top_p=0.5)
+            print("inference engine matches the sampling loop")
+        engine = VARInferenceEngine(sar3d.var_wo_ddp, batch_size=args.infer_bs, compile_mode=compile_mode)
+        with torch.inference_mode():
+            engine.warmup()
+        print(f"inference engine: {engine}")
+        sampling_kwargs = dict(engine=engine)
+    # Meshes are built and written by worker processes while the GPU goes on sampling and rendering
+    mesh_pool = None
+    if args.mesh_workers > 0 and not args.flexicubes:
+        mesh_pool = MeshExportPool(args.mesh_workers, max_pending=args.mesh_queue, blocks=args.mesh_blocks, decimate_faces=args.mesh_decimate)
+    print(f"sampling with batch size {args.infer_bs}...")
+    try:
+        with torch.inference_mode():
+            for (name, save_dir), triplane, g_BL in stream_triplanes(sar3d, jobs, args.infer_bs, encode_fn, generate_fn, seed=args.seed, **sampling_kwargs):
+                print(f"mesh dumping and rendering {name}...")
+                render_results(args, sar3d, triplane, g_BL, name, save_dir, mesh_pool=mesh_pool)
                 print(f"rendering completed!")
-    
+    finally:
+        if mesh_pool is not None:
+            mesh_pool.close()
+    print(f"conditioning encoder: {encoder}")
+
+
+def stream_triplanes(sar3d, jobs, batch_size, encode_fn, generate_fn, seed=None, **sampling_kwargs):
+    """
+    Batch (key, condition) jobs into groups of `batch_size`, encode and sample each group in
+    one pass and yield (key, triplane, g_BL) for every item of the group.
+
+    With `seed` set, item i is sampled with seed `seed + i`, so results do not depend on batch_size.
+    With num_return in sampling_kwargs, each item gets its num_return best triplanes (best first).
+    """
+    n_per_item = sampling_kwargs.get('num_return', 1)
+    batch, n_done = [], 0
+
+    def flush():
+        g_seed = None if seed is None else [seed + n_done + i for i in range(len(batch))]
+        feats = encode_fn([cond for _, cond in batch])
+        triplane, g_BL = generate_fn(sar3d, feats, g_seed=g_seed, **sampling_kwargs)
+        for i, (key, _) in enumerate(batch):
+            yield key, triplane[i*n_per_item:(i+1)*n_per_item], g_BL[i*n_per_item:(i+1)*n_per_item]
+
+    for job in jobs:
+        batch.append(job)
+        if len(batch) == batch_size:
+            yield from flush()
+            n_done += len(batch)
+            batch = []
+    if len(batch):
+        yield from flush()
 
 
 
@@ -214,84 +272,83 @@ def preprocess_image(png_file: str, save_dir: str) -> Image:
     return img
 
 
-def extract_dino_features(img: Image):
-    """Helper function to extract DINO features from image"""
-    model_id = "facebook/dinov2-large"
-    processor = AutoImageProcessor.from_pretrained(model_id)
-    model = Dinov2Model.from_pretrained(model_id)
-    
-    with torch.no_grad():
-        inputs = processor(images=img, return_tensors="pt")
-        outputs = model(**inputs)
-        return {
-            'embeddings': outputs.last_hidden_state[:,1:].to(dist.get_device(), non_blocking=True),
-            'pooled': outputs.pooler_output.to(dist.get_device(), non_blocking=True)
-        }
-
-def extract_clip_features(text: str):
-    """Helper function to extract CLIP features from text"""
-    from transformers import CLIPTextModel, CLIPTokenizer
-    
-    tokenizer = CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14")
-    text_encoder = CLIPTextModel.from_pretrained("openai/clip-vit-large-patch14")
-    text_input = tokenizer(text,  padding="max_length", max_length=tokenizer.model_max_length, truncation=True, return_tensors="pt")
-    text_embeddings = text_encoder(text_input.input_ids)[0].to(dist.get_device(), non_blocking=True)
-    pooler_output = text_encoder(text_input.input_ids)[1].to(dist.get_device(), non_blocking=True)
-
-    return {
-        'embeddings': text_embeddings,
-        'pooled': pooler_output
-    }
-
+def generate_triplane(sar3d, dino_feats, cfg=4, top_k=10, top_p=0.5, g_seed=None, engine=None, **rerank_kwargs):
+    """
+    Helper function to generate triplane representation.
 
-def generate_triplane(sar3d, dino_feats):
-    """Helper function to generate triplane representation"""
+    dino_feats is a single feature dict or a list of them; cfg, top_k, top_p and g_seed
+    may be scalars or per-item lists. rerank_kwargs (num_candidates, fork_scales, num_return)
+    enable candidate reranking. With a VARInferenceEngine, sampling goes through its compiled steps.
+    """
+    if isinstance(dino_feats, dict):
+        dino_feats = [dino_feats]
+    if engine is not None:
+        return engine.generate(
+            cond_emb=torch.cat([f['embeddings'] for f in dino_feats], dim=0),
+            pooler_output=torch.cat([f['pooled'] for f in dino_feats], dim=0),
+            cfg=cfg, top_k=top_k, top_p=top_p, g_seed=g_seed,
+        )
     return sar3d.var_wo_ddp.autoregressive_infer_cfg_3D_VAR_image_l2norm(
-        B=1,
-        dino_image_embeddings=dino_feats['embeddings'],
-        pooler_output=dino_feats['pooled'],
-        cfg=4,
-        top_k=10,
-        top_p=0.5,
-        more_smooth=False
+        B=len(dino_feats),
+        dino_image_embeddings=torch.cat([f['embeddings'] for f in dino_feats], dim=0),
+        pooler_output=torch.cat([f['pooled'] for f in dino_feats], dim=0),
+        cfg=cfg,
+        top_k=top_k,
+        top_p=top_p,
+        g_seed=g_seed,
+        more_smooth=False,
+        **rerank_kwargs
     )
 
-def generate_triplane_text(sar3d, clip_feats):
-    """Helper function to generate triplane representation"""
+def generate_triplane_text(sar3d, clip_feats, cfg=4, top_k=10, top_p=0.5, g_seed=None, engine=None, **rerank_kwargs):
+    """Helper function to generate triplane representation, see generate_triplane"""
+    if isinstance(clip_feats, dict):
+        clip_feats = [clip_feats]
+    if engine is not None:
+        return engine.generate(
+            cond_emb=torch.cat([f['embeddings'] for f in clip_feats], dim=0),
+            pooler_output=torch.cat([f['pooled'] for f in clip_feats], dim=0),
+            cfg=cfg, top_k=top_k, top_p=top_p, g_seed=g_seed,
+        )
     return sar3d.var_wo_ddp.autoregressive_infer_cfg_3D_VAR_text_l2norm(
-        B=1,
-        dino_image_embeddings=clip_feats['embeddings'],
-        pooler_output=clip_feats['pooled'],
-        cfg=4,
-        top_k=10,
-        top_p=0.5,
-        more_smooth=False
+        B=len(clip_feats),
+        dino_image_embeddings=torch.cat([f['embeddings'] for f in clip_feats], dim=0),
+        pooler_output=torch.cat([f['pooled'] for f in clip_feats], dim=0),
+        cfg=cfg,
+        top_k=top_k,
+        top_p=top_p,
+        g_seed=g_seed,
+        more_smooth=False,
+        **rerank_kwargs
     )
 
 
-def render_results(args, sar3d, triplane, g_BL, name, save_dir):
+def render_results(args, sar3d, triplane, g_BL, name, save_dir, mesh_pool=None):
     """Helper function to render 3D reconstruction results"""
     # Load and transform camera parameters
     camera = torch.load("./files/camera.pt").cpu()[0:24]
     rot = get_camera_rotation(args.flexicubes)
     camera = transform_camera(camera, rot)
 
-    # Render each triplane
+    # Render each triplane (the NeRF renderer batches args.render_chunk cameras per pass)
     for i, tri in enumerate(triplane):
-        render_fn = render_video_given_triplane_mesh if args.flexicubes else render_video_given_triplane
+        render_fn = render_video_given_triplane_mesh if args.flexicubes else partial(render_video_given_triplane, view_chunk=args.render_chunk, mesh_size=args.mesh_size, mesh_coarse_stride=args.mesh_coarse_stride, occupancy_grid_res=args.render_occupancy_res, feature_cache_res=args.render_cache_res, mesh_pool=mesh_pool)
+        name_prefix = name if len(triplane) == 1 else f'{name}_{i}'
         
         render_fn(
             tri.unsqueeze(0),
             sar3d.vae_local,
-            name_prefix=name,
+            name_prefix=name_prefix,
             render_reference={'c': camera},
             save_img=True,
             save_mesh=True,
             save_path=save_dir
         )
 
-        if args.save_BL:
-            torch.save(g_BL.detach().cpu(), os.path.join(save_dir, "G_BL.pt"))
+        # Store the token map, decode_tokens.py re-decodes it without rerunning the AR model
+        if args.save_BL and g_BL is not None:
+            var = sar3d.var_wo_ddp
+            save_tokens(os.path.join(save_dir, f'{name_prefix}{TOKEN_EXT}'), g_BL[i:i+1], var.patch_nums, var.V, meta={'name': name_prefix})
 
 
 def get_camera_rotation(use_flexicubes):
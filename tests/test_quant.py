@@ -0,0 +1,26 @@
+"""Equivalence of VectorQuantizer2.forward_fused and forward_reference on CPU: python -m pytest tests/test_quant.py"""
+
+import pytest
+import torch
+
+from vit.quant import VectorQuantizer2, check_forward_fused
+
+
+@pytest.mark.parametrize('share_quant_resi', [0, 1, 4])
+@pytest.mark.parametrize('B', [1, 3])
+def test_forward_fused_matches_reference(B, share_quant_resi):
+    torch.manual_seed(0)
+    vq = VectorQuantizer2(vocab_size=512, Cvae=8, using_znorm=True, v_patch_nums=(1, 2, 4, 8),
+                          quant_resi=0.5, share_quant_resi=share_quant_resi)
+    diffs = check_forward_fused(vq, torch.randn(B * 3, 8, 8, 8))
+    assert {'f_hat', 'loss', 'grad/input'} <= diffs.keys()
+
+
+def test_fused_selects_forward_path():
+    torch.manual_seed(0)
+    f = torch.randn(3, 8, 8, 8)
+    vq = VectorQuantizer2(vocab_size=512, Cvae=8, using_znorm=True, v_patch_nums=(1, 2, 4, 8), fused=True).eval()
+    f_hat_fused, _, _ = vq(f)
+    vq.fused = False
+    f_hat_ref, _, _ = vq(f)
+    assert torch.allclose(f_hat_fused, f_hat_ref, rtol=1e-4, atol=1e-5)
@@ -78,6 +78,7 @@ def build_everything(args: arg_util.Args):
             eval=True,
             load_whole=True,
             text_conditioned=args.text_conditioned,
+            chunk_format=args.chunk_format,
         )
 
         # Build training loader 
@@ -98,6 +99,13 @@ def build_everything(args: arg_util.Args):
             use_chunk=True,
             load_whole=False,
             text_conditioned=args.text_conditioned,
+            latent_shard_dir=args.latent_shard_dir,
+            gt_BL_only=args.gt_BL_only,
+            chunk_format=args.chunk_format,
+            shard_size=args.loc_shard,
+            start_ep=start_ep,
+            start_it=start_it,
+            seed=args.seed or 0,
         )
 
         [print(line) for line in auto_resume_info]
@@ -412,13 +420,13 @@ def train_one_ep(ep: int, is_first_ep: bool, start_it: int, args: arg_util.Args,
         
     g_it, max_it = ep * iters_train, args.ep * iters_train
     
-    # Load empty embeddings for classifier-free guidance
+    # Empty embeddings for classifier-free guidance (buffers loaded once by build_vae_var_3D_VAR)
     if args.text_conditioned:
-        empty_text_embedding = torch.from_numpy(np.load("./files/empty_text_embedding.npy")).to(dist.get_device()).unsqueeze(0)
-        empty_text_pooler_output = torch.from_numpy(np.load("./files/empty_text_pooler_output.npy")).to(dist.get_device()).unsqueeze(0)
+        empty_text_embedding = trainer.var_wo_ddp.empty_embedding
+        empty_text_pooler_output = trainer.var_wo_ddp.empty_pooler_output
     else:
-        empty_pooler_output = torch.from_numpy(np.load("./files/empty_dino_pooler_output.npy")).to(dist.get_device()).unsqueeze(0)
-        empty_dino_image_embedding = torch.from_numpy(np.load("./files/empty_dino_embedding.npy"))[1:, :].to(dist.get_device()).unsqueeze(0)
+        empty_pooler_output = trainer.var_wo_ddp.empty_pooler_output
+        empty_dino_image_embedding = trainer.var_wo_ddp.empty_embedding
 
     # Training loop
     for it, (data) in me.log_every(start_it, iters_train, ld_or_itrt, 30 if iters_train > 8000 else 5, header):
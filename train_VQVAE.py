@@ -137,7 +137,8 @@ def training_loop(args):
                 use_lmdb_compressed=args.use_lmdb_compressed,
                 plucker_embedding=args.plucker_embedding,
                 use_chunk=True,
-                eval=True
+                eval=True,
+                chunk_format=args.chunk_format,
             )
             data = load_data(
                 file_path=args.data_dir,
@@ -153,7 +154,11 @@ def training_loop(args):
                 use_wds=args.use_wds,
                 use_lmdb_compressed=args.use_lmdb_compressed,
                 plucker_embedding=args.plucker_embedding,
-                use_chunk=True
+                use_chunk=True,
+                gpu_post_process=args.gpu_post_process,
+                decode_cache_dir=args.decode_cache_dir or None,
+                decode_cache_gb=args.decode_cache_gb,
+                chunk_format=args.chunk_format,
             )
             if args.pose_warm_up_iter > 0:
                 overfitting_dataset = load_memory_data(
@@ -87,6 +87,28 @@ class VARTrainer(object):
         # DINO models
         self.dino_image_processor = dino_image_processor
         self.dino_image_model = dino_image_model
+
+    def get_teacher_forcing_input(self, inp_B3HW) -> Tuple[ITen, FTen]:
+        """Move the ground-truth tokens to the device and get the teacher-forcing input
+
+        Batches loaded with gt_BL_only carry no x_BLCv_wo_first_l and int16 (uint16 bits) token
+        indices; the input is then rebuilt from gt_BL on the device.
+
+        Args:
+            inp_B3HW: Batch from the dataloader
+
+        Returns:
+            Tuple of (gt_BL as int64, x_BLCv_wo_first_l)
+        """
+        gt_BL = inp_B3HW["gt_BL"].to(dist.get_device(), non_blocking=True)
+        if "x_BLCv_wo_first_l" in inp_B3HW:
+            return gt_BL, inp_B3HW["x_BLCv_wo_first_l"].to(dist.get_device(), non_blocking=True)
+
+        if gt_BL.dtype == torch.int16:
+            gt_BL = gt_BL.long().bitwise_and_(0xFFFF)
+        else:
+            gt_BL = gt_BL.long()
+        return gt_BL, self.quantize_local.idxBl_to_var_input_triplane(gt_BL)
         
     @torch.no_grad()
     def eval_ep_3D_VAR(self, ld_val: DataLoader):
@@ -210,8 +232,7 @@ class VARTrainer(object):
         self.var.require_backward_grad_sync = stepping
 
         # Get ground truth and VAR input
-        gt_BL = inp_B3HW["gt_BL"].to(dist.get_device(), non_blocking=True)
-        x_BLCv_wo_first_l = inp_B3HW["x_BLCv_wo_first_l"].to(dist.get_device(), non_blocking=True)
+        gt_BL, x_BLCv_wo_first_l = self.get_teacher_forcing_input(inp_B3HW)
 
         # Get DINO embeddings
         dino_image_pooler_output = inp_B3HW["image_dino_pooler_output"].to(dist.get_device(), non_blocking=True)
@@ -312,8 +333,7 @@ class VARTrainer(object):
         self.var.require_backward_grad_sync = stepping
 
         # Get ground truth indices and VAR input
-        gt_BL = inp_B3HW["gt_BL"].to(dist.get_device(), non_blocking=True)
-        x_BLCv_wo_first_l = inp_B3HW["x_BLCv_wo_first_l"].to(dist.get_device(), non_blocking=True)
+        gt_BL, x_BLCv_wo_first_l = self.get_teacher_forcing_input(inp_B3HW)
 
         # Get text embeddings
         text_pooler_output = inp_B3HW["text_pooler_output"].to(dist.get_device(), non_blocking=True)
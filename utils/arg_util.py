@@ -147,7 +147,35 @@ class Args(Tap):
     # use flexicubes to extract mesh and render
     flexicubes: bool = False
     save_path: str = '.sample_data'
-    save_BL: bool = False
+    save_BL: bool = False   # store the generated token maps (<name>.gbl, see utils/token_store.py) next to the renders
+    infer_bs: int = 1       # number of images/prompts sampled together in one AR pass by test.py
+    feat_cache_dir: str = None  # on-disk DINO/CLIP feature cache used by test.py, keyed by image hash / prompt text
+    static_kv: bool = False     # preallocate the AR self-attention KV cache (3*L slots) instead of growing it per scale
+    n_cand: int = 1         # >1: sample n_cand token maps per branch at each fork scale and keep the most likely ones
+    n_return: int = 1       # best branches kept and rendered per input when n_cand > 1
+    fork_si: str = ''       # scale indices to fork at, e.g. '0_1_2_3'; empty means every scale
+    ar_engine: str = ''     # sample through the fixed-shape VARInferenceEngine in test.py: torch.compile mode ('reduce-overhead', 'default', 'max-autotune') or 'eager'; empty: off
+    ar_engine_check: bool = False   # with ar_engine: first assert that the engine (eager and compiled) samples the same tokens as VAR's own loop
+    render_chunk: int = 1   # cameras rendered per forward pass by render_video_given_triplane (more is faster, needs more memory)
+    render_occupancy_res: int = 0   # > 0: bake an occupancy grid of this resolution per triplane, the video renderer skips empty space and stops opaque rays early (approximate, off by default)
+    render_cache_res: int = 0   # > 0: bake the decoded triplane on a lattice of this resolution per asset, mesh export and video frames read it instead of the decoder
+    token_path: str = None  # decode_tokens.py: a .gbl token file or a directory searched for them
+    decode_to: str = 'render'   # decode_tokens.py: 'triplane' saves the decoded triplane only, 'render' also dumps mesh and video
+    mesh_size: int = 192        # resolution of the density grid the NeRF meshes are extracted from
+    mesh_coarse_stride: int = 0 # > 0: decode the mesh density grid coarse to fine from this grid stride (power of two), refining only near the surface; 0: dense grid
+    mesh_workers: int = 0       # > 0: test.py builds and writes NeRF meshes in this many background processes while rendering goes on; 0: inline
+    mesh_queue: int = 4         # meshes handed to the mesh workers before rendering waits for one to finish (bounds the host memory of queued volumes)
+    mesh_blocks: int = 1        # slabs the marching cubes of one mesh is split into across the mesh workers
+    mesh_decimate: int = 0      # > 0: the mesh workers decimate meshes to this many faces (needs a trimesh simplification backend)
+    empty_cond_dir: str = None  # directory of the empty CFG embeddings (empty_*_pooler_output.npy, empty_*_embedding.npy); None: <repo>/files
+    latent_shard_dir: str = None    # read AR training latents from shards packed by datasets/latent_shards.py instead of per-instance .npy files
+    gt_BL_only: bool = False    # load only the uint16 token maps for training, x_BLCv_wo_first_l is rebuilt on the GPU by VARTrainer
+    chunk_format: str = 'png'   # on-disk chunk layout: 'png' (PNG/JPEG tiles) or 'lz4' (blobs converted by datasets/chunk_format.py)
+    loc_shard: int = 0          # > 0: AR training sampler shuffles within shards of this many neighbouring instances (DistShardedInfiniteBatchSampler, e.g. 1024); 0: DistributedSampler
+    extract_out: str = None     # extract_latents.py: root the per-instance latents are written below, None: next to the chunks in data_dir
+    extract_bs: int = 16        # extract_latents.py: instances per VQVAE encoder pass
+    extract_cond: str = 'dino_clip' # extract_latents.py: condition embeddings to extract besides the tokens ('dino', 'clip', 'dino_clip' or '')
+    extract_cond_view: int = 0  # extract_latents.py: rendered view of the chunk encoded by DINO as image condition
 
     # LN3Diff args (TODO: clean these args)
     LN3Diff_kwargs = {
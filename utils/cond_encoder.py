@@ -0,0 +1,133 @@
+"""
+Long-lived DINOv2 / CLIP conditioning encoders for inference.
+Each model is loaded once and reused for every image or prompt. Features can be
+kept in an on-disk content-addressed cache, so repeated assets skip encoding.
+"""
+
+import hashlib
+import os
+from typing import Dict, List, Optional, Sequence
+
+import torch
+from PIL import Image
+
+import utils.dist as dist
+
+
+DINO_MODEL_ID = "facebook/dinov2-large"
+CLIP_MODEL_ID = "openai/clip-vit-large-patch14"
+
+
+class ConditionEncoder:
+    """
+    Encodes images with DINOv2 and prompts with CLIP for SAR3D conditioning.
+
+    Args:
+        device: Device the encoders run on (defaults to the current dist device)
+        cache_dir: Directory of the on-disk feature cache, None to disable it
+    """
+    def __init__(self, device=None, cache_dir: Optional[str] = None):
+        self.device = device if device is not None else dist.get_device()
+        self.cache_dir = cache_dir
+        self.dino_processor = self.dino_model = None
+        self.clip_tokenizer = self.clip_text_encoder = None
+        self.hits, self.misses = 0, 0
+
+    # ===================== model loading (once per process) =====================
+    def _load_dino(self):
+        if self.dino_model is None:
+            from transformers import AutoImageProcessor, Dinov2Model
+            self.dino_processor = AutoImageProcessor.from_pretrained(DINO_MODEL_ID)
+            self.dino_model = Dinov2Model.from_pretrained(DINO_MODEL_ID).to(self.device).eval()
+
+    def _load_clip(self):
+        if self.clip_text_encoder is None:
+            from transformers import CLIPTextModel, CLIPTokenizer
+            self.clip_tokenizer = CLIPTokenizer.from_pretrained(CLIP_MODEL_ID)
+            self.clip_text_encoder = CLIPTextModel.from_pretrained(CLIP_MODEL_ID).to(self.device).eval()
+
+    # ===================== content-addressed feature cache =====================
+    @staticmethod
+    def image_key(img: Image.Image) -> str:
+        h = hashlib.sha1(f'{DINO_MODEL_ID}|{img.mode}|{img.size}'.encode('utf-8'))
+        h.update(img.tobytes())
+        return h.hexdigest()
+
+    @staticmethod
+    def text_key(text: str) -> str:
+        return hashlib.sha1(f'{CLIP_MODEL_ID}|{text}'.encode('utf-8')).hexdigest()
+
+    def _cache_path(self, kind: str, key: str) -> str:
+        return os.path.join(self.cache_dir, kind, key[:2], f'{key}.pt')
+
+    def _cache_get(self, kind: str, key: str) -> Optional[Dict[str, torch.Tensor]]:
+        if self.cache_dir is None:
+            return None
+        path = self._cache_path(kind, key)
+        if not os.path.exists(path):
+            return None
+        return torch.load(path, map_location='cpu')
+
+    def _cache_put(self, kind: str, key: str, feats: Dict[str, torch.Tensor]):
+        if self.cache_dir is None:
+            return
+        path = self._cache_path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        torch.save(feats, tmp_path)
+        os.replace(tmp_path, path)  # atomic, so concurrent readers never see a partial file
+
+    def _encode_cached(self, kind: str, keys: List[str], encode_fn, inputs: Sequence, to_device: bool = True) -> List[Dict[str, torch.Tensor]]:
+        """Look every key up in the cache and run encode_fn once on the misses"""
+        feats = [self._cache_get(kind, k) for k in keys]
+        miss = [i for i, f in enumerate(feats) if f is None]
+        self.hits += len(keys) - len(miss)
+        self.misses += len(miss)
+        if len(miss):
+            new_feats = encode_fn([inputs[i] for i in miss])
+            for i, f in zip(miss, new_feats):
+                self._cache_put(kind, keys[i], f)
+                feats[i] = f
+        if not to_device:
+            return feats
+        return [{k: v.to(self.device, non_blocking=True) for k, v in f.items()} for f in feats]
+
+    # ===================== encoding =====================
+    @torch.no_grad()
+    def _encode_images(self, imgs: List[Image.Image]) -> List[Dict[str, torch.Tensor]]:
+        self._load_dino()
+        inputs = self.dino_processor(images=imgs, return_tensors="pt").to(self.device)
+        outputs = self.dino_model(**inputs)
+        embeddings, pooled = outputs.last_hidden_state[:, 1:].cpu(), outputs.pooler_output.cpu()
+        return [{'embeddings': embeddings[i:i+1], 'pooled': pooled[i:i+1]} for i in range(len(imgs))]
+
+    @torch.no_grad()
+    def _encode_texts(self, texts: List[str]) -> List[Dict[str, torch.Tensor]]:
+        self._load_clip()
+        text_input = self.clip_tokenizer(texts, padding="max_length", max_length=self.clip_tokenizer.model_max_length, truncation=True, return_tensors="pt")
+        outputs = self.clip_text_encoder(text_input.input_ids.to(self.device))    # one pass gives both the sequence and the pooled output
+        embeddings, pooled = outputs[0].cpu(), outputs[1].cpu()
+        return [{'embeddings': embeddings[i:i+1], 'pooled': pooled[i:i+1]} for i in range(len(texts))]
+
+    def encode_images(self, imgs: Sequence[Image.Image], to_device: bool = True) -> List[Dict[str, torch.Tensor]]:
+        """
+        DINOv2 features ({'embeddings': (1, 256, 1024), 'pooled': (1, 1024)}) for each image, encoded in one batch.
+        to_device=False returns them on the CPU, e.g. to write them to disk.
+        """
+        return self._encode_cached('dino', [self.image_key(img) for img in imgs], self._encode_images, imgs, to_device=to_device)
+
+    def encode_texts(self, texts: Sequence[str], to_device: bool = True) -> List[Dict[str, torch.Tensor]]:
+        """
+        CLIP features ({'embeddings': (1, 77, 768), 'pooled': (1, 768)}) for each prompt, encoded in one batch.
+        to_device=False returns them on the CPU, e.g. to write them to disk.
+        """
+        return self._encode_cached('clip', [self.text_key(t) for t in texts], self._encode_texts, texts, to_device=to_device)
+
+    def encode_image(self, img: Image.Image) -> Dict[str, torch.Tensor]:
+        return self.encode_images([img])[0]
+
+    def encode_text(self, text: str) -> Dict[str, torch.Tensor]:
+        return self.encode_texts([text])[0]
+
+    def __repr__(self):
+        return f'{type(self).__name__}(device={self.device}, cache_dir={self.cache_dir}, hits={self.hits}, misses={self.misses})'
@@ -101,3 +101,66 @@ class DistInfiniteBatchSampler(InfiniteBatchSampler):
         local_indices = global_indices[seps[self.rank].item():seps[self.rank + 1].item()].tolist()
         self.max_p = len(local_indices)
         return local_indices
+
+
+class DistShardedInfiniteBatchSampler(Sampler):
+    """
+    Locality-aware infinite batch sampler: the dataset is cut into shards of `shard_size` neighbouring
+    samples (in `keys` order, e.g. chunk paths, so a shard covers a few directories), and every epoch
+    deals a seeded permutation of the shards to the ranks. Each rank reads `shards_in_flight` shards at a
+    time and shuffles only within them, so reads stay local while batches still mix several shards.
+    Epochs have dataset_len // glb_batch_size iterations, resuming starts at (start_ep, start_it) without
+    replaying the batches already seen.
+    """
+    def __init__(self, world_size, rank, dataset_len, glb_batch_size, shard_size=1024, shards_in_flight=4, keys=None, same_seed_for_all_ranks=0, start_ep=0, start_it=0):
+        assert glb_batch_size % world_size == 0
+        self.world_size, self.rank = world_size, rank
+        self.dataset_len = dataset_len
+        self.glb_batch_size = glb_batch_size
+        self.batch_size = glb_batch_size // world_size
+        self.iters_per_ep = dataset_len // glb_batch_size
+        assert self.iters_per_ep > 0, f'{dataset_len=} is smaller than one global batch ({glb_batch_size})'
+        self.shards_in_flight = shards_in_flight
+        self.same_seed_for_all_ranks = same_seed_for_all_ranks
+        self.start_ep, self.start_it = start_ep, start_it
+        self.epoch = start_ep
+
+        # Neighbouring samples (by key, e.g. the chunk path) form a shard
+        order = sorted(range(dataset_len), key=keys.__getitem__) if keys is not None else list(range(dataset_len))
+        self.shards = [order[i:i + shard_size] for i in range(0, dataset_len, shard_size)]
+        assert len(self.shards) >= world_size, f'{len(self.shards)} shards cannot feed {world_size} ranks, lower shard_size'
+
+    def gener_indices(self):
+        g = torch.Generator()
+        g.manual_seed(self.epoch + self.same_seed_for_all_ranks)
+
+        # Same shard permutation on every rank, then each rank takes every world_size-th shard
+        shard_perm = torch.randperm(len(self.shards), generator=g).tolist()
+        my_shards = [self.shards[s] for s in shard_perm[self.rank::self.world_size]]
+
+        # Shuffle within windows of shards_in_flight shards (seeded per rank, so every rank differs)
+        g.manual_seed((self.epoch + self.same_seed_for_all_ranks) * self.world_size + self.rank)
+        local_indices = []
+        for i in range(0, len(my_shards), self.shards_in_flight):
+            window = [idx for shard in my_shards[i:i + self.shards_in_flight] for idx in shard]
+            local_indices.extend(window[j] for j in torch.randperm(len(window), generator=g).tolist())
+
+        # Ranks get the same number of batches per epoch; short ranks wrap around their own shards
+        need = self.iters_per_ep * self.batch_size
+        while len(local_indices) < need:
+            local_indices.extend(local_indices[:need - len(local_indices)])
+        return local_indices[:need]
+
+    def __iter__(self):
+        self.epoch = self.start_ep
+        p = self.start_it * self.batch_size
+        while True:
+            indices = self.gener_indices()
+            while p < len(indices):
+                yield indices[p:p + self.batch_size]
+                p += self.batch_size
+            p = 0
+            self.epoch += 1
+
+    def __len__(self):
+        return self.iters_per_ep
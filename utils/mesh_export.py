@@ -0,0 +1,156 @@
+"""
+Mesh export off the main thread: marching cubes, vertex colouring and PLY export in a process pool.
+
+render_video_given_triplane decodes the sigma volume on the GPU and hands it to
+MeshExportPool.submit, which returns immediately while the mesh is built by worker processes, so
+the GPU moves on to rendering and generating the next assets. At most max_pending meshes are in
+flight: submit blocks once that many volumes are queued, which bounds the host memory they hold.
+
+Per mesh:
+    marching cubes      whole volume in one task, or `blocks` slabs along x in parallel (stitched and welded)
+    vertex colours      the decoder queried at the vertex positions (color_fn, in the parent process), as the serial path
+    post-processing     optional vertex welding and quadric decimation to `decimate_faces` faces
+"""
+
+import multiprocessing as mp
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+from guided_diffusion import logger
+
+
+def _marching_cubes_block(sigma: np.ndarray, thres: float, x_offset: int) -> Tuple[np.ndarray, np.ndarray]:
+    import mcubes
+    vtx, faces = mcubes.marching_cubes(sigma, thres)
+    vtx[:, 0] += x_offset
+    return vtx, faces
+
+
+def _finish_mesh(path: str, vtx: np.ndarray, faces: np.ndarray, vtx_colors: Optional[np.ndarray],
+                 weld: bool, decimate_faces: int) -> Tuple[str, Optional[str]]:
+    """Post-process and export a mesh in world coordinates, returns its path and why decimation was skipped (or None)"""
+    import trimesh
+
+    mesh = trimesh.Trimesh(vertices=vtx, faces=faces, vertex_colors=vtx_colors, process=False)
+    if weld:
+        mesh.merge_vertices()
+    skipped = None
+    if decimate_faces > 0 and len(mesh.faces) > decimate_faces:
+        try:
+            mesh = mesh.simplify_quadric_decimation(decimate_faces)
+        except Exception as e:     # needs an optional backend (fast_simplification / open3d)
+            skipped = str(e)
+    mesh.export(path, 'ply')
+    return path, skipped
+
+
+class MeshExportPool:
+    """
+    Process pool building and writing meshes from decoded volumes.
+
+    Args:
+        workers: Worker processes
+        max_pending: Meshes in flight before submit blocks
+        blocks: Slabs along x marching cubes is split into (1: whole volume in one task)
+        weld: Merge duplicate vertices (always done for blocks > 1, where slabs share their boundary vertices)
+        decimate_faces: Decimate meshes with more faces to this many, 0 keeps them as they are
+    """
+    def __init__(self, workers: int = 4, max_pending: int = 4, blocks: int = 1, weld: bool = True, decimate_faces: int = 0):
+        # spawn: the workers never touch the CUDA context of the parent
+        self.pool = ProcessPoolExecutor(workers, mp_context=mp.get_context('spawn'))
+        self.coordinator = ThreadPoolExecutor(max_pending)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.blocks = blocks
+        self.weld = weld
+        self.decimate_faces = decimate_faces
+        # Meshes in flight, dropped once written; the first error is kept for wait to re-raise
+        self.lock = threading.Lock()
+        self.futures = set()
+        self.error: Optional[BaseException] = None
+
+    def submit(self, path: str, sigma: np.ndarray, thres: float, bound: float,
+               color_fn: Optional[Callable[[np.ndarray], np.ndarray]] = None) -> Future:
+        """
+        Queue a mesh, returns a future of its path.
+
+        Args:
+            path: Output .ply file
+            sigma: (R, R, R) density volume on the grid of triplane_decode_grid
+            thres: Iso level (mesh_thres)
+            bound: Half extent of the grid in world units (sampler_bbox_max)
+            color_fn: Maps world vertices (N, 3) to colours (N, 3) in [0, 1], e.g. the decoder through forward_points;
+                called from a pool thread of this process, so it has to enter inference mode itself (grad mode is
+                per thread). None for an uncoloured mesh
+        """
+        self.slots.acquire()
+        future = self.coordinator.submit(self._export, path, sigma, thres, bound, color_fn)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future):
+        with self.lock:
+            self.futures.discard(future)
+            if self.error is None and future.exception() is not None:
+                self.error = future.exception()
+        self.slots.release()
+
+    def _export(self, path, sigma, thres, bound, color_fn):
+        grid_size = sigma.shape[0]
+        blocks = max(1, min(self.blocks, grid_size // 2))
+        if blocks == 1:
+            vtx, faces = self.pool.submit(_marching_cubes_block, sigma, thres, 0).result()
+        else:
+            # Slabs of cells, neighbouring slabs share one plane of samples
+            bounds = np.linspace(0, grid_size - 1, blocks + 1).astype(int)
+            parts = [self.pool.submit(_marching_cubes_block, np.ascontiguousarray(sigma[x0:x1 + 1]), thres, x0)
+                     for x0, x1 in zip(bounds[:-1], bounds[1:])]
+            vtx, faces, n = [], [], 0
+            for part in parts:
+                v, f = part.result()
+                vtx.append(v)
+                faces.append(f + n)
+                n += len(v)
+            vtx, faces = np.concatenate(vtx), np.concatenate(faces)
+
+        # Lattice to world coordinates and vertex colours, as the serial path in render_video_given_triplane
+        vtx = (vtx / (grid_size - 1) * 2 - 1) * bound
+        vtx_colors = None
+        if color_fn is not None and len(vtx):
+            vtx_colors = (np.clip(color_fn(vtx), 0, 1) * 255).astype(np.uint8)
+
+        weld = self.weld or blocks > 1
+        path, skipped = self.pool.submit(_finish_mesh, path, vtx, faces, vtx_colors, weld, self.decimate_faces).result()
+        if skipped is not None:
+            logger.log(f'[MeshExportPool] skipping decimation of {path}: {skipped}')
+        return path
+
+    def wait(self):
+        """Block until every queued mesh is written, re-raises the first worker error"""
+        with self.lock:
+            futures = list(self.futures)
+        for future in futures:
+            try:
+                future.result()
+            except BaseException:
+                pass
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.coordinator.shutdown()
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -26,6 +26,28 @@ from xformers.components.feedforward import fused_mlp
 
 # Diffusion model imports
 from guided_diffusion import dist_util
+from nsr.volumetric_rendering.occupancy_grid import OccupancyGrid
+from nsr.volumetric_rendering.feature_cache import FeatureVolumeCache
+
+
+_VIRIDIS_LUT = {}
+
+def depth_to_viridis(depth):
+    """
+    Min-max normalize every depth map of depth (N, 1, H, W) and apply the viridis colormap on its device.
+    Matches plt.cm.viridis on the CPU (256-entry LUT, same binning, NaN to black). Returns (N, 3, H, W) in [-1, 1].
+    """
+    if depth.device not in _VIRIDIS_LUT:
+        _VIRIDIS_LUT[depth.device] = torch.from_numpy(plt.cm.viridis(np.arange(256))[:, :3]).to(depth.device, torch.float32)
+    lut = _VIRIDIS_LUT[depth.device]
+
+    d_min = depth.amin(dim=(1, 2, 3), keepdim=True)
+    d_max = depth.amax(dim=(1, 2, 3), keepdim=True)
+    depth = ((depth - d_min) / (d_max - d_min))[:, 0]
+    valid = depth.isfinite()
+    idx = (depth.nan_to_num(0.) * 256).long().clamp_(0, 255)
+    colors = torch.where(valid.unsqueeze(-1), lut[idx], torch.zeros_like(lut[idx]))
+    return colors.permute(0, 3, 1, 2) * 2 - 1
 
 @torch.inference_mode()
 def render_video_given_triplane(planes,
@@ -34,7 +56,14 @@ def render_video_given_triplane(planes,
                               save_img=False,
                               render_reference=None,
                               save_mesh=False,
-                              save_path="./sample_save"):
+                              save_path="./sample_save",
+                              view_chunk=1,
+                              mesh_size=192,
+                              mesh_coarse_stride=0,
+                              occupancy_grid_res=0,
+                              feature_cache_res=0,
+                              mesh_pool=None,
+                              mesh_color_chunk=2**16):
     """
     Render video from tri-plane representation with optional mesh extraction.
     
@@ -46,6 +75,17 @@ def render_video_given_triplane(planes,
         render_reference: Reference data for rendering
         save_mesh: Whether to extract and save 3D mesh
         save_path: Output directory path
+        view_chunk: Number of cameras rendered per forward pass against the (single) triplane
+        mesh_size: Resolution of the density grid marching cubes runs on
+        mesh_coarse_stride: > 0 decodes the density grid coarse to fine from this stride, 0 decodes it densely
+        occupancy_grid_res: > 0 bakes an occupancy grid of this resolution from the triplane, and the renderer
+            skips empty space and terminates opaque rays early; approximate, within the bounds documented in
+            ImportanceRenderer.set_occupancy_grid
+        feature_cache_res: > 0 bakes the decoded triplane on a lattice of this resolution, the mesh and the views
+            are then decoded from it instead of the network (see nsr/volumetric_rendering/feature_cache.py)
+        mesh_pool: MeshExportPool (utils/mesh_export.py) building and writing the mesh in the background, None to
+            build it here
+        mesh_color_chunk: Vertices decoded per pass when the mesh_pool colours a mesh
     """
     # Initialize pooling layers for different resolutions
     pool_128 = torch.nn.AdaptiveAvgPool2d((128, 128))
@@ -54,113 +94,152 @@ def render_video_given_triplane(planes,
     # Convert planes to float32 latents
     ddpm_latent = {'latent_after_vit': planes.to(torch.float32)}
 
-    # Extract and save mesh if requested
-    if save_mesh:
-        mesh_size = 192
-        mesh_thres = 10
-        os.makedirs(save_path, exist_ok=True)
-        dump_path = f'{save_path}/mesh/'
-        os.makedirs(dump_path, exist_ok=True)
+    # Bake the occupancy grid of this triplane for empty-space skipping (or turn skipping off)
+    renderer = rec_model.decoder.triplane_decoder.renderer
+    rendering_kwargs = rec_model.decoder.rendering_kwargs
+    # The renderer is shared, reset its per-triplane state however the render ends
+    try:
+        renderer.set_feature_cache(None)
+        occupancy_grid = None
+        if occupancy_grid_res > 0:
+            occupancy_grid = OccupancyGrid.bake(
+                lambda points: rec_model.decoder.forward_points(ddpm_latent['latent_after_vit'][:1], points)['sigma'],
+                1, rendering_kwargs['sampler_bbox_min'], rendering_kwargs['sampler_bbox_max'], dist_util.dev(),
+                resolution=occupancy_grid_res)
+        renderer.set_occupancy_grid(occupancy_grid)
+
+        # Bake the decoded triplane once, the mesh, vertex colors and all views then read the cache
+        if feature_cache_res > 0:
+            feature_cache = FeatureVolumeCache.bake(
+                lambda points: rec_model.decoder.forward_points(ddpm_latent['latent_after_vit'][:1], points),
+                rec_model.decoder.triplane_decoder.decoder, ddpm_latent['latent_after_vit'][:1],
+                rendering_kwargs['box_warp'] / 2, dist_util.dev(),
+                resolution=feature_cache_res, occupancy_grid=occupancy_grid)
+            renderer.set_feature_cache(feature_cache)
+
+        # Extract and save mesh if requested
+        if save_mesh:
+            mesh_thres = 10
+            os.makedirs(save_path, exist_ok=True)
+            dump_path = f'{save_path}/mesh/'
+            os.makedirs(dump_path, exist_ok=True)
         
-        # Generate 3D grid from tri-planes
-        grid_out = rec_model(
-            latent=ddpm_latent,
-            grid_size=mesh_size,
-            behaviour='triplane_decode_grid',
-        )
+            # Generate 3D grid from tri-planes
+            grid_out = rec_model(
+                latent=ddpm_latent,
+                grid_size=mesh_size,
+                behaviour='triplane_decode_grid',
+                coarse_stride=mesh_coarse_stride,
+                iso=mesh_thres,
+            )
         
-        # Extract mesh using marching cubes
-        vtx, faces = mcubes.marching_cubes(
-            grid_out['sigma'].to(torch.float32).squeeze(0).squeeze(-1).cpu().numpy(),
-            mesh_thres)
+            grid_scale = [rec_model.decoder.rendering_kwargs['sampler_bbox_min'], 
+                         rec_model.decoder.rendering_kwargs['sampler_bbox_max']]
+            mesh_dump_path = os.path.join(dump_path, f'{name_prefix}.ply')
+
+            if mesh_pool is not None:
+                # Hand the volume to the mesh workers and go on rendering, the vertices are coloured by the decoder
+                mesh_latent = ddpm_latent['latent_after_vit']
+                # Runs on a pool thread: grad mode is per thread, and a fixed chunk_size skips the memory probe
+                # of run_model_chunked, which would race with the renders of this thread
+                @torch.inference_mode()
+                def color_fn(vtx):
+                    vtx_tensor = torch.tensor(vtx, dtype=torch.float32, device=dist_util.dev()).unsqueeze(0)
+                    rgb = rec_model.decoder.forward_points(mesh_latent, vtx_tensor, chunk_size=mesh_color_chunk)['rgb']
+                    return rgb.squeeze(0).float().cpu().numpy()
+                mesh_pool.submit(mesh_dump_path, grid_out['sigma'][0, ..., 0].float().cpu().numpy(), mesh_thres,
+                                 grid_scale[1], color_fn)
+                print(f"Mesh queued for {mesh_dump_path}")
+            else:
+                # Extract mesh using marching cubes
+                vtx, faces = mcubes.marching_cubes(
+                    grid_out['sigma'].to(torch.float32).squeeze(0).squeeze(-1).cpu().numpy(),
+                    mesh_thres)
         
-        # Scale vertices to world coordinates
-        grid_scale = [rec_model.decoder.rendering_kwargs['sampler_bbox_min'], 
-                     rec_model.decoder.rendering_kwargs['sampler_bbox_max']]
-        vtx = (vtx / (mesh_size-1) * 2 - 1 ) * grid_scale[1]
-
-        # Get vertex colors from tri-plane features
-        vtx_tensor = torch.tensor(vtx, dtype=torch.float32, device=dist_util.dev()).unsqueeze(0)
-        vtx_colors = rec_model.decoder.forward_points(ddpm_latent['latent_after_vit'], vtx_tensor)['rgb'].squeeze(0).cpu().numpy()
-        vtx_colors = (vtx_colors.clip(0,1) * 255).astype(np.uint8)
-
-        # Save colored mesh
-        mesh = trimesh.Trimesh(vertices=vtx, faces=faces, vertex_colors=vtx_colors)
-        mesh_dump_path = os.path.join(dump_path, f'{name_prefix}.ply')
-        mesh.export(mesh_dump_path, 'ply')
-        print(f"Mesh dumped to {dump_path}")
+                # Scale vertices to world coordinates
+                vtx = (vtx / (mesh_size-1) * 2 - 1 ) * grid_scale[1]
+
+                # Get vertex colors from tri-plane features
+                vtx_tensor = torch.tensor(vtx, dtype=torch.float32, device=dist_util.dev()).unsqueeze(0)
+                vtx_colors = rec_model.decoder.forward_points(ddpm_latent['latent_after_vit'], vtx_tensor)['rgb'].squeeze(0).cpu().numpy()
+                vtx_colors = (vtx_colors.clip(0,1) * 255).astype(np.uint8)
+
+                # Save colored mesh
+                mesh = trimesh.Trimesh(vertices=vtx, faces=faces, vertex_colors=vtx_colors)
+                mesh.export(mesh_dump_path, 'ply')
+                print(f"Mesh dumped to {dump_path}")
+                del mesh
+
+            del grid_out
+            torch.cuda.empty_cache()
+
+        # Initialize video writer
+        video_out = imageio.get_writer(
+            f'{save_path}/triplane_{name_prefix}.mp4',
+            mode='I',
+            fps=15,
+            codec='libx264')
+
+        # Validate and process render reference
+        if render_reference is None:
+            raise ValueError('render_reference is None')
+        else:
+            for key in ['ins', 'bbox', 'caption']:
+                if key in render_reference:
+                    render_reference.pop(key)
+
+            num_views = len(next(iter(render_reference.values())))
+            render_reference = [{k: v[idx:idx + view_chunk] for k, v in render_reference.items()} 
+                              for idx in range(0, num_views, view_chunk)]
+
+        # Render frames, view_chunk cameras per pass
+        for chunk_idx, batch in enumerate(tqdm(render_reference)):
+            # Move batch to device
+            micro = {k: v.to(dist_util.dev()) if isinstance(v, torch.Tensor) else v
+                    for k, v in batch.items()}
+            V = micro['c'].shape[0]
         
-        del grid_out, mesh
-        torch.cuda.empty_cache()
-
-    # Initialize video writer
-    video_out = imageio.get_writer(
-        f'{save_path}/triplane_{name_prefix}.mp4',
-        mode='I',
-        fps=15,
-        codec='libx264')
-
-    # Validate and process render reference
-    if render_reference is None:
-        raise ValueError('render_reference is None')
-    else:
-        for key in ['ins', 'bbox', 'caption']:
-            if key in render_reference:
-                render_reference.pop(key)
-
-        render_reference = [{k: v[idx:idx + 1] for k, v in render_reference.items()} 
-                          for idx in range(len(next(iter(render_reference.values()))))]
-
-    # Render frames
-    for i, batch in enumerate(tqdm(render_reference)):
-        # Move batch to device
-        micro = {k: v.to(dist_util.dev()) if isinstance(v, torch.Tensor) else v
-                for k, v in batch.items()}
+            # Generate frames from tri-planes (one triplane, expanded to the V cameras without copying)
+            latent = ddpm_latent['latent_after_vit'][:1]
+            pred = rec_model(
+                latent={'latent_after_vit': latent.expand(V, *latent.shape[1:])},
+                c=micro['c'],
+                behaviour='triplane_dec')
         
-        # Generate frame from tri-planes
-        pred = rec_model(
-            latent={'latent_after_vit': ddpm_latent['latent_after_vit'].repeat_interleave(6, dim=0).to(torch.float32).repeat(2,1,1,1)},
-            c=micro['c'],
-            behaviour='triplane_dec')
-        
-        # Process depth map for visualization
-        pred_depth = pred['image_depth']
-        pred_depth = (pred_depth - pred_depth.min()) / (pred_depth.max() - pred_depth.min())
-        pred_depth = pred_depth.cpu()[0].permute(1, 2, 0).numpy()
-        pred_depth = (plt.cm.viridis(pred_depth[..., 0])[..., :3]) * 2 - 1
-        pred_depth = torch.from_numpy(pred_depth).to(pred['image_raw'].device).permute(2, 0, 1).unsqueeze(0)
-
-        # Handle different output resolutions
-        if 'image_sr' in pred:
-            gen_img = pred['image_sr']
-            if pred['image_sr'].shape[-1] == 512:
-                pred_vis = torch.cat([micro['img_sr'],
-                                    pool_512(pred['image_raw']), gen_img,
-                                    pool_512(pred_depth).repeat_interleave(3, dim=1)], dim=-1)
-            elif pred['image_sr'].shape[-1] == 128:
-                pred_vis = torch.cat([micro['img_sr'],
-                                    pool_128(pred['image_raw']), pred['image_sr'],
-                                    pool_128(pred_depth).repeat_interleave(3, dim=1)], dim=-1)
-        else:
-            gen_img = pred['image_raw']
-            pred_vis = torch.cat([gen_img, pred_depth], dim=-1)
-
-        # Save individual frames if requested
-        if save_img:
-            for batch_idx in range(gen_img.shape[0]):
+            # Process depth maps for visualization (on the GPU)
+            pred_depth = depth_to_viridis(pred['image_depth']).to(pred['image_raw'].dtype)
+
+            # Handle different output resolutions
+            if 'image_sr' in pred:
+                gen_img = pred['image_sr']
+                if pred['image_sr'].shape[-1] == 512:
+                    pred_vis = torch.cat([micro['img_sr'],
+                                        pool_512(pred['image_raw']), gen_img,
+                                        pool_512(pred_depth).repeat_interleave(3, dim=1)], dim=-1)
+                elif pred['image_sr'].shape[-1] == 128:
+                    pred_vis = torch.cat([micro['img_sr'],
+                                        pool_128(pred['image_raw']), pred['image_sr'],
+                                        pool_128(pred_depth).repeat_interleave(3, dim=1)], dim=-1)
+            else:
+                gen_img = pred['image_raw']
+                pred_vis = torch.cat([gen_img, pred_depth], dim=-1)
+
+            # Save individual frames if requested
+            if save_img:
                 from PIL import Image
-                sampled_img = Image.fromarray(
-                    (gen_img[batch_idx].permute(1, 2, 0).cpu().numpy() *
-                     127.5 + 127.5).clip(0, 255).astype(np.uint8))
-                sampled_img.save(save_path + '/{}.png'.format(i))
-
-        # Write frame to video
-        vis = pred_vis.permute(0, 2, 3, 1).cpu().numpy()
-        vis = vis * 127.5 + 127.5
-        vis = vis.clip(0, 255).astype(np.uint8)
-        for j in range(vis.shape[0]):
-            video_out.append_data(vis[j])
-
+                frames = (gen_img.permute(0, 2, 3, 1) * 127.5 + 127.5).clamp(0, 255).to(torch.uint8).cpu().numpy()
+                for batch_idx in range(frames.shape[0]):
+                    Image.fromarray(frames[batch_idx]).save(save_path + '/{}.png'.format(chunk_idx * view_chunk + batch_idx))
+
+            # Write frame to video
+            vis = pred_vis.permute(0, 2, 3, 1).cpu().numpy()
+            vis = vis * 127.5 + 127.5
+            vis = vis.clip(0, 255).astype(np.uint8)
+            for j in range(vis.shape[0]):
+                video_out.append_data(vis[j])
+    finally:
+        renderer.set_occupancy_grid(None)
+        renderer.set_feature_cache(None)
     video_out.close()
     print('Logged video to: ', f'{save_path}/triplane_{name_prefix}.mp4')
 
@@ -226,11 +305,7 @@ def render_video_given_triplane_mesh(planes,
 
         # Process normal and depth maps
         pred_normal = pred['image_normal_mesh']
-        pred_depth = pred['image_depth_mesh']
-        pred_depth = (pred_depth - pred_depth.min()) / (pred_depth.max() - pred_depth.min())
-        pred_depth = pred_depth.cpu()[0].permute(1, 2, 0).numpy()
-        pred_depth = (plt.cm.viridis(pred_depth[..., 0])[..., :3]) * 2 - 1
-        pred_depth = torch.from_numpy(pred_depth).to(pred['image_raw'].device).permute(2, 0, 1).unsqueeze(0)
+        pred_depth = depth_to_viridis(pred['image_depth_mesh'][:1]).to(pred['image_raw'].dtype)
 
         # Handle different output resolutions
         if 'image_sr' in pred:
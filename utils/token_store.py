@@ -0,0 +1,102 @@
+"""
+Compact on-disk store for generated multi-scale token maps (g_BL), so a generation can be
+re-decoded to a triplane, mesh or video without rerunning the AR model.
+
+File layout (.gbl):
+    8 bytes     magic b'SAR3DGBL'
+    4 bytes     little-endian uint32, length of the JSON header
+    header      JSON: version, patch_nums, vocab_size, num_planes, B, L, offsets, meta
+    B*L*2 bytes token indices as little-endian uint16, row-major (B, L)
+
+Tokens offsets[si]:offsets[si+1] belong to scale si (num_planes planes of pn*pn tokens, plane after plane).
+"""
+
+import json
+import os
+import struct
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+
+MAGIC = b'SAR3DGBL'
+VERSION = 1
+TOKEN_EXT = '.gbl'
+
+
+def scale_offsets(patch_nums: Sequence[int], num_planes: int = 3) -> List[int]:
+    """Start of every scale in the flattened token map, plus the total length at the end"""
+    offsets = [0]
+    for pn in patch_nums:
+        offsets.append(offsets[-1] + num_planes * pn * pn)
+    return offsets
+
+
+def save_tokens(path: str, g_BL: torch.Tensor, patch_nums: Sequence[int], vocab_size: int, meta: Optional[Dict] = None):
+    """
+    Write token maps to path.
+
+    Args:
+        path: Output file, TOKEN_EXT by convention
+        g_BL: (B, L) token indices, as returned by the autoregressive_infer_* methods
+        patch_nums: Scales the tokens were generated with
+        vocab_size: Codebook size, must fit uint16
+        meta: Extra JSON-serializable info stored in the header (e.g. prompt, seed)
+    """
+    assert vocab_size <= 2 ** 16, f'{vocab_size=} does not fit uint16'
+    g_BL = g_BL.detach().cpu()
+    if g_BL.ndim == 1:
+        g_BL = g_BL.unsqueeze(0)
+    B, L = g_BL.shape
+    offsets = scale_offsets(patch_nums)
+    assert L == offsets[-1], f'token map has {L} tokens but {patch_nums=} gives {offsets[-1]}'
+
+    header = json.dumps(dict(
+        version=VERSION, patch_nums=list(patch_nums), vocab_size=vocab_size, num_planes=3,
+        B=B, L=L, offsets=offsets, meta=meta or {},
+    )).encode('utf-8')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        f.write(g_BL.numpy().astype('<u2').tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_tokens(path: str) -> Tuple[torch.LongTensor, Dict]:
+    """Read a token file, returns the (B, L) indices as int64 and the header"""
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a token file (magic={magic!r})')
+        header_len, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+        if header['version'] > VERSION:
+            raise ValueError(f'{path} has version {header["version"]}, this reader supports <= {VERSION}')
+        data = np.frombuffer(f.read(), dtype='<u2')
+    B, L = header['B'], header['L']
+    assert data.size == B * L, f'{path} is truncated: {data.size} tokens, expected {B * L}'
+    return torch.from_numpy(data.astype(np.int64).reshape(B, L)), header
+
+
+def split_scales(g_BL: torch.Tensor, header: Dict) -> List[torch.Tensor]:
+    """Token maps of every scale, each (B, num_planes*pn*pn)"""
+    offsets = header['offsets']
+    return [g_BL[:, bg:ed] for bg, ed in zip(offsets[:-1], offsets[1:])]
+
+
+@torch.no_grad()
+def decode_tokens(var, g_BL: torch.Tensor, header: Optional[Dict] = None) -> torch.Tensor:
+    """
+    Decode stored token maps to triplanes through VAR.reconstruct_gt_Bl_idx (VQVAE decoder only,
+    no transformer pass). The header, if given, is checked against the model's scales and codebook.
+    """
+    var = getattr(var, '_orig_mod', var)
+    if header is not None:
+        assert tuple(header['patch_nums']) == tuple(var.patch_nums), f'tokens use patch_nums={header["patch_nums"]}, model uses {var.patch_nums}'
+        assert header['vocab_size'] == var.V, f'tokens use vocab_size={header["vocab_size"]}, model uses {var.V}'
+    g_BL = g_BL.to(var.lvl_1L.device)
+    return var.reconstruct_gt_Bl_idx(B=g_BL.shape[0], label_B=None, gt_idx=g_BL)
@@ -26,10 +26,14 @@ class VectorQuantizer2(nn.Module):
         v_patch_nums: List of patch sizes for multi-scale quantization
         quant_resi: Residual quantization ratio
         share_quant_resi: How to share residual quantizers (0: non-shared, 1: fully shared, >1: partially shared)
+        fused: Train with forward_fused instead of forward_reference (opt-in; equal up to exact ties in the code
+            search and float rounding, see check_forward_fused and tests/test_quant.py). Set by the vq_fused option
+            of the VQVAE / triplane autoencoder configs
     """
     def __init__(
         self, vocab_size, Cvae, using_znorm, beta: float = 0.25,
         default_qresi_counts=0, v_patch_nums=None, quant_resi=0.5, share_quant_resi=4,  # share_quant_resi: args.qsr
+        fused=False,
     ):
         super().__init__()
         self.vocab_size: int = vocab_size
@@ -37,6 +41,7 @@ class VectorQuantizer2(nn.Module):
         self.using_znorm: bool = using_znorm
         self.v_patch_nums: Tuple[int] = v_patch_nums
         self.quant_resi_ratio = quant_resi
+        self.fused: bool = fused
 
         # Initialize residual quantizers based on sharing strategy
         if share_quant_resi == 0:   # Non-shared: separate quantizer for each scale
@@ -70,15 +75,22 @@ class VectorQuantizer2(nn.Module):
     
     def extra_repr(self) -> str:
         """String representation of model parameters"""
-        return f'{self.v_patch_nums}, znorm={self.using_znorm}, beta={self.beta}  |  S={len(self.v_patch_nums)}, quant_resi={self.quant_resi_ratio}'
+        return f'{self.v_patch_nums}, znorm={self.using_znorm}, beta={self.beta}  |  S={len(self.v_patch_nums)}, quant_resi={self.quant_resi_ratio}, fused={self.fused}'
     
     # ===================== `forward` is only used in VAE training =====================
     def forward(self, f_BChw: torch.Tensor, ret_usages=False) -> Tuple[torch.Tensor, List[float], torch.Tensor]:
-        """Forward pass for training.
+        """Forward pass for training, see forward_fused and forward_reference (selected by self.fused)"""
+        if self.fused:
+            return self.forward_fused(f_BChw, ret_usages=ret_usages)
+        return self.forward_reference(f_BChw, ret_usages=ret_usages)
+
+    def forward_reference(self, f_BChw: torch.Tensor, ret_usages=False, ms_idx: Optional[List[torch.LongTensor]] = None) -> Tuple[torch.Tensor, List[float], torch.Tensor]:
+        """Reference forward pass for training, kept to check forward_fused against.
         
         Args:
             f_BChw: Input features [B,C,H,W]
             ret_usages: Whether to return codebook usage statistics
+            ms_idx: If a list, the code indices idx_N of every scale are appended to it
             
         Returns:
             f_hat: Quantized features
@@ -115,6 +127,8 @@ class VectorQuantizer2(nn.Module):
                     d_no_grad = torch.sum(rest_NC.square(), dim=1, keepdim=True) + torch.sum(self.embedding.weight.data.square(), dim=1, keepdim=False)
                     d_no_grad.addmm_(rest_NC, self.embedding.weight.data.T, alpha=-2, beta=1)
                     idx_N = torch.argmin(d_no_grad, dim=1)
+                if ms_idx is not None:
+                    ms_idx.append(idx_N)
 
                 # Track codebook usage
                 hit_V = idx_N.bincount(minlength=self.vocab_size).float()
@@ -148,14 +162,95 @@ class VectorQuantizer2(nn.Module):
             mean_vq_loss *= 1. / SN
             f_hat = (f_hat.data - f_no_grad).add_(f_BChw)
 
-        # Calculate codebook usage statistics
-        margin = [f_BChw.shape[0] * pn * pn / self.vocab_size * 0.01 for si, pn in enumerate(self.v_patch_nums)]
-        if ret_usages:
-            usages = [(self.ema_vocab_hit_SV[si] > margin[si]).float().mean().item() * 100 for si, pn in enumerate(self.v_patch_nums)]
-        else:
-            usages = None
+        return f_hat, self._usages(B) if ret_usages else None, mean_vq_loss
+
+    def forward_fused(self, f_BChw: torch.Tensor, ret_usages=False, ms_idx: Optional[List[torch.LongTensor]] = None) -> Tuple[torch.Tensor, List[float], torch.Tensor]:
+        """Forward pass for training with fewer passes over the features than forward_reference.
+
+        Plain PyTorch ops, not a custom kernel: per scale, the code search runs on the unnormalized residual
+        (the argmax is invariant to the row norm) in row chunks against a codebook normalized once, the
+        residual update does not enter autograd, and the two MSE terms are computed as one. Codebook hits of
+        all scales are all-reduced once at the end. Runs on CPU as well (the all-reduce is skipped without an
+        initialized process group). check_forward_fused compares it with forward_reference.
+
+        Args:
+            f_BChw: Input features [B,C,H,W]
+            ret_usages: Whether to return codebook usage statistics
+            ms_idx: If a list, the code indices idx_N of every scale are appended to it
+
+        Returns:
+            f_hat: Quantized features
+            usages: Codebook usage statistics (if ret_usages=True)
+            mean_vq_loss: Vector quantization loss
+        """
+        assert self.using_znorm, 'Only using znorm is supported'
+        dtype = f_BChw.dtype
+        if dtype != torch.float32:
+            f_BChw = f_BChw.float()
+        B, C, H, W = f_BChw.shape
+        f_no_grad = f_BChw.detach()
+
+        f_rest = f_no_grad.clone()
+        f_hat = torch.zeros_like(f_rest)
+
+        with torch.cuda.amp.autocast(enabled=False):
+            mean_vq_loss: torch.Tensor = 0.0
+            SN = len(self.v_patch_nums)
+            embedding = F.normalize(self.embedding.weight, p=2, dim=-1)
+            codebook_CV = embedding.detach().T.contiguous()
+            hit_SV = torch.zeros(SN, self.vocab_size, dtype=torch.float, device=f_BChw.device)
+
+            # Equal to f_BChw, but gradients reach f_BChw scaled by beta: mse(f_hat, f_target) carries both the
+            # codebook term mse(f_hat, f_no_grad) and the commitment term beta * mse(f_hat.data, f_BChw)
+            f_target = f_no_grad.lerp(f_BChw, self.beta)
+
+            for si, pn in enumerate(self.v_patch_nums):
+                # Nearest code of every (pooled) residual vector
+                rest_BChw = F.interpolate(f_rest, size=(pn, pn), mode='area') if (si != SN-1) else f_rest
+                idx_N = nearest_code_idx(rest_BChw.permute(0, 2, 3, 1).reshape(-1, C), codebook_CV)
+                hit_SV[si] = idx_N.bincount(minlength=self.vocab_size)
+                if ms_idx is not None:
+                    ms_idx.append(idx_N)
+
+                # Gather, upsample and update the residual (the last scale uses the raw codebook, as forward_reference)
+                idx_Bhw = idx_N.view(B, pn, pn)
+                if si != SN-1:
+                    h_BChw = F.interpolate(F.embedding(idx_Bhw, embedding).permute(0, 3, 1, 2), size=(H, W), mode='bicubic')
+                else:
+                    h_BChw = self.embedding(idx_Bhw).permute(0, 3, 1, 2)
+                h_BChw = self.quant_resi[si/(SN-1)](h_BChw.contiguous())
+                f_hat = f_hat + h_BChw
+                f_rest.sub_(h_BChw.detach())
+
+                # (1 + beta) * mse, with the gradients of the two separate terms
+                sq_err = F.mse_loss(f_hat, f_target)
+                mean_vq_loss += sq_err + sq_err.detach() * self.beta
 
-        return f_hat, usages, mean_vq_loss
+            mean_vq_loss *= 1. / SN
+            f_hat = (f_hat.data - f_no_grad).add_(f_BChw)
+
+            if self.training:
+                self._update_vocab_hits(hit_SV)
+
+        return f_hat, self._usages(B) if ret_usages else None, mean_vq_loss
+
+    def _update_vocab_hits(self, hit_SV: torch.Tensor):
+        """EMA of the codebook hits of every scale, in the order forward_reference updates them"""
+        if tdist.is_available() and tdist.is_initialized():
+            tdist.all_reduce(hit_SV)
+        for si in range(len(self.v_patch_nums)):
+            if self.record_hit == 0:
+                self.ema_vocab_hit_SV[si].copy_(hit_SV[si])
+            elif self.record_hit < 100:
+                self.ema_vocab_hit_SV[si].mul_(0.9).add_(hit_SV[si].mul(0.1))
+            else:
+                self.ema_vocab_hit_SV[si].mul_(0.99).add_(hit_SV[si].mul(0.01))
+            self.record_hit += 1
+
+    def _usages(self, B: int) -> List[float]:
+        """Percentage of codes of every scale whose EMA hit count is above 1% of uniform usage"""
+        margin = [B * pn * pn / self.vocab_size * 0.01 for si, pn in enumerate(self.v_patch_nums)]
+        return [(self.ema_vocab_hit_SV[si] > margin[si]).float().mean().item() * 100 for si, pn in enumerate(self.v_patch_nums)]
     # ===================== `forward` is only used in VAE training =====================
     def embed_to_fhat(self, ms_h_BChw: List[torch.Tensor], all_to_max_scale=True, last_one=False) -> Union[List[torch.Tensor], torch.Tensor]:
         ls_f_hat_BChw = []
@@ -238,7 +333,31 @@ class VectorQuantizer2(nn.Module):
             pn_next = self.v_patch_nums[si+1]
             next_scales.append(F.interpolate(f_hat, size=(pn_next, pn_next), mode='area').view(B, C, -1).transpose(1, 2))
         return next_scales
-    
+
+    @torch.no_grad()
+    def idxBl_to_var_input_triplane(self, gt_BL: torch.Tensor) -> torch.Tensor:
+        """
+        Tri-plane teacher-forcing input rebuilt from the flattened token maps, the three planes of every
+        scale go through upsample, Phi and area pooling as one 3B batch (see get_next_autoregressive_input_triplane).
+        gt_BL: (B, L) token indices, every scale holds 3*pn*pn tokens plane after plane
+        Returns x_BLCv_wo_first_l (B, L - 3*pn_0*pn_0, C) in the layout the VAR forward pass takes.
+        """
+        B = gt_BL.shape[0]
+        C = self.Cvae
+        H = W = self.v_patch_nums[-1]
+        SN = len(self.v_patch_nums)
+
+        assert self.using_znorm == True, 'VAR training should always use znorm'
+        embedding = F.normalize(self.embedding.weight, p=2, dim=-1)
+        f_hat_3B = gt_BL.new_zeros(B * 3, C, H, W, dtype=torch.float32)
+        next_scales, cur_L = [], 0
+        for si, pn in enumerate(self.v_patch_nums[:-1]):
+            idx_Bl = gt_BL[:, cur_L:cur_L + 3*pn*pn]
+            cur_L += 3*pn*pn
+            f_hat_3B, next_BlC = self.get_next_autoregressive_input_triplane(si, SN, f_hat_3B, embedding[idx_Bl])
+            next_scales.append(next_BlC)
+        return torch.cat(next_scales, dim=1)
+
     # ===================== get_next_autoregressive_input: only used in VAR inference, for getting next step's input =====================
     def get_next_autoregressive_input(self, si: int, SN: int, f_hat: torch.Tensor, h_BChw: torch.Tensor) -> Tuple[Optional[torch.Tensor], torch.Tensor]: # only used in VAR inference
         HW = self.v_patch_nums[-1]
@@ -251,6 +370,83 @@ class VectorQuantizer2(nn.Module):
             f_hat.add_(h)
             return f_hat, f_hat
 
+    def get_next_autoregressive_input_triplane(self, si: int, SN: int, f_hat_3B: torch.Tensor, h_BlC: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.Tensor]]: # only used in VAR inference
+        """
+        Tri-plane version of get_next_autoregressive_input: the three planes go through upsample, Phi and
+        area pooling as one 3B batch.
+        f_hat_3B: (B*3, C, H, W), planes of one item adjacent (the layout the VAE decoder takes)
+        h_BlC: (B, 3*pn*pn, C), the token embeddings of scale si, plane after plane
+        Returns the new f_hat (not in place) and the next-scale input (B, 3*pn'*pn', C), None at the last scale.
+        """
+        HW = self.v_patch_nums[-1]
+        B, l, C = h_BlC.shape
+        pn = round((l // 3) ** 0.5)
+        h_3BChw = h_BlC.view(B, 3, pn * pn, C).transpose(2, 3).reshape(B * 3, C, pn, pn)
+        if si != SN-1:
+            h_3BChw = F.interpolate(h_3BChw, size=(HW, HW), mode='bicubic')
+        f_hat_3B = f_hat_3B + self.quant_resi[si/(SN-1)](h_3BChw)
+        if si == SN-1:
+            return f_hat_3B, None
+        pn_next = self.v_patch_nums[si+1]
+        next_3BChw = F.interpolate(f_hat_3B, size=(pn_next, pn_next), mode='area')
+        return f_hat_3B, next_3BChw.view(B, 3, C, pn_next * pn_next).transpose(2, 3).reshape(B, 3 * pn_next * pn_next, C)
+
+
+def nearest_code_idx(z_NC: torch.Tensor, codebook_CV: torch.Tensor, chunk_rows: int = 16384) -> torch.LongTensor:
+    """
+    argmax over V of z_NC @ codebook_CV, computed in row chunks into one reused score buffer,
+    so the full N x V similarity matrix is never materialized at the large scales.
+    """
+    N = z_NC.shape[0]
+    if N <= chunk_rows:
+        return torch.argmax(z_NC @ codebook_CV, dim=1)
+    idx_N = torch.empty(N, dtype=torch.long, device=z_NC.device)
+    scores = z_NC.new_empty(chunk_rows, codebook_CV.shape[1])
+    for start in range(0, N, chunk_rows):
+        end = min(start + chunk_rows, N)
+        buf = scores[:end - start]
+        torch.mm(z_NC[start:end], codebook_CV, out=buf)
+        torch.argmax(buf, dim=1, out=idx_N[start:end])
+    return idx_N
+
+
+def check_forward_fused(quantizer: VectorQuantizer2, f_BChw: torch.Tensor, rtol: float = 1e-4, atol: float = 1e-5) -> dict:
+    """
+    Run forward_fused and forward_reference of quantizer (in eval mode, no codebook statistics are updated)
+    on the same input, and assert that they pick the same codes and give the same f_hat, loss and gradients
+    w.r.t. the input and every parameter (within torch.allclose(rtol, atol), the paths round differently).
+
+    Returns:
+        Max abs difference of f_hat, loss and every gradient
+    """
+    training = quantizer.training
+    quantizer.eval()
+    g_BChw = torch.randn_like(f_BChw)     # fixed upstream gradient of f_hat
+    outs = []
+    for fn in (quantizer.forward_reference, quantizer.forward_fused):
+        quantizer.zero_grad(set_to_none=True)
+        f = f_BChw.detach().clone().requires_grad_(True)
+        ms_idx = []
+        f_hat, _, loss = fn(f, ms_idx=ms_idx)
+        (loss + (f_hat * g_BChw).sum()).backward()
+        grads = {'input': f.grad}
+        grads.update({n: p.grad.clone() for n, p in quantizer.named_parameters() if p.grad is not None})
+        outs.append((ms_idx, f_hat.detach(), loss.detach(), grads))
+    quantizer.zero_grad(set_to_none=True)
+    quantizer.train(training)
+
+    (idx_ref, f_hat_ref, loss_ref, grads_ref), (idx_fused, f_hat_fused, loss_fused, grads_fused) = outs
+    for si, (a, b) in enumerate(zip(idx_ref, idx_fused)):
+        assert torch.equal(a, b), f'scale {si}: {(a != b).sum().item()} / {a.numel()} codes differ'
+    assert grads_ref.keys() == grads_fused.keys(), f'gradients of {grads_ref.keys() ^ grads_fused.keys()} differ'
+    pairs = {'f_hat': (f_hat_ref, f_hat_fused), 'loss': (loss_ref, loss_fused)}
+    pairs.update({f'grad/{k}': (grads_ref[k], grads_fused[k]) for k in grads_ref})
+    diffs = {}
+    for k, (a, b) in pairs.items():
+        diffs[k] = (a - b).abs().max().item()
+        assert torch.allclose(b, a, rtol=rtol, atol=atol), f'{k} differs by up to {diffs[k]:.3g}'
+    return diffs
+
 
 class Phi(nn.Conv2d):
     def __init__(self, embed_dim, quant_resi):
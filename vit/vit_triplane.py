@@ -39,6 +39,7 @@ from .quant import VectorQuantizer2
 import torchvision.models as models
 from torch.profiler import profile, record_function, ProfilerActivity
 from nsr.triplane import TriplaneMesh
+from nsr.volumetric_rendering.sparse_grid import hierarchical_sigma_grid
 
 # Helper function to convert single value to n-tuple
 def _ntuple(n):
@@ -222,31 +223,20 @@ class ViTTriplaneDecomposed(nn.Module):
         self.rendering_kwargs = self.triplane_decoder.rendering_kwargs
 
     @torch.inference_mode()
-    def forward_points(self, planes, points: torch.Tensor, chunk_size: int = 2**16):
-        N, P = points.shape[:2]
+    def forward_points(self, planes, points: torch.Tensor, chunk_size: int = None, mem_budget_gb: float = None):
         if planes.ndim == 4:
             planes = planes.reshape(len(planes), 3, -1, planes.shape[-2], planes.shape[-1])
 
-        outs = []
-        for i in trange(0, points.shape[1], chunk_size):
-            chunk_points = points[:, i:i+chunk_size]
-            chunk_out = self.triplane_decoder.renderer._run_model(
-                planes=planes,
-                decoder=self.triplane_decoder.decoder,
-                sample_coordinates=chunk_points,
-                sample_directions=torch.zeros_like(chunk_points),
-                options=self.rendering_kwargs,
-            )
-            outs.append(chunk_out)
-            torch.cuda.empty_cache()
-
-        point_features = {
-            k: torch.cat([out[k] for out in outs], dim=1)
-            for k in outs[0].keys()
-        }
-        return point_features
+        return self.triplane_decoder.renderer.run_model_chunked(
+            planes=planes,
+            decoder=self.triplane_decoder.decoder,
+            sample_coordinates=points,
+            options=self.rendering_kwargs,
+            chunk_size=chunk_size,
+            mem_budget_gb=mem_budget_gb,
+        )
 
-    def triplane_decode_grid(self, vit_decode_out, grid_size, aabb: torch.Tensor = None, **kwargs):
+    def triplane_decode_grid(self, vit_decode_out, grid_size, aabb: torch.Tensor = None, coarse_stride: int = 0, iso: float = 10, **kwargs):
         assert isinstance(vit_decode_out, dict)
         planes = vit_decode_out['latent_after_vit']
 
@@ -265,6 +255,9 @@ class ViTTriplaneDecomposed(nn.Module):
         assert planes.shape[0] == aabb.shape[0]
         N = planes.shape[0]
 
+        if coarse_stride > 0:
+            return self.triplane_decode_grid_hierarchical(planes, aabb, grid_size, coarse_stride, iso)
+
         grid_points = []
         for i in range(N):
             grid_points.append(torch.stack(torch.meshgrid(
@@ -284,6 +277,20 @@ class ViTTriplaneDecomposed(nn.Module):
 
         return features
 
+    def triplane_decode_grid_hierarchical(self, planes, aabb: torch.Tensor, grid_size: int, coarse_stride: int, iso: float, verbose: bool = False):
+        """
+        Density on the grid_size^3 grid, decoded coarse to fine near the iso level (see hierarchical_sigma_grid).
+        verbose prints the number of decoded points of every instance.
+        """
+        sigmas = []
+        for i in range(planes.shape[0]):
+            query_fn = lambda points: self.forward_points(planes[i:i+1], points.unsqueeze(0))['sigma']
+            sigma, stats = hierarchical_sigma_grid(query_fn, aabb[i], grid_size, iso, coarse_stride=coarse_stride)
+            if verbose:
+                print(f"hierarchical grid {grid_size}^3: decoded {stats['decoded']} / {stats['dense']} points")
+            sigmas.append(sigma)
+        return {'sigma': torch.stack(sigmas, dim=0).unsqueeze(-1)}
+
     def create_uvit_arch(self):
         for blk in self.vit_decoder.blocks[len(self.vit_decoder.blocks) // 2:]:
             blk.skip_linear = nn.Linear(2 * self.vit_decoder.embed_dim,
@@ -427,6 +434,7 @@ class RodinSR_256_fusionv5_ConvQuant_liteSR_dinoInit3DAttn(
             ldm_z_channels=4,
             ldm_embed_dim=4,
             vae_p=2,
+            vq_fused=False,
             **kwargs) -> None:
         super().__init__(
             vit_decoder,
@@ -488,6 +496,7 @@ class RodinSR_256_fusionv5_ConvQuant_liteSR_dinoInit3DAttn(
          quantize= VectorQuantizer2(
             vocab_size=vocab_size, Cvae=Cvae, using_znorm=using_znorm, beta=beta,
             default_qresi_counts=default_qresi_counts, v_patch_nums=v_patch_nums, quant_resi=quant_resi, share_quant_resi=share_quant_resi,
+            fused=vq_fused,  # train with VectorQuantizer2.forward_fused
         )   
             ))
 
@@ -1035,8 +1044,8 @@ class RodinSR_256_fusionv6_ConvQuant_liteSR_dinoInit3DAttn_SD_B_3L_C_withrollout
     def forward_points(self,
                        planes,
                        points: torch.Tensor,
-                       chunk_size: int = 2**16):
-        N, P = points.shape[:2]
+                       chunk_size: int = None,
+                       mem_budget_gb: float = None):
         if planes.ndim == 4:
             planes = planes.reshape(
                 len(planes),
@@ -1045,31 +1054,21 @@ class RodinSR_256_fusionv6_ConvQuant_liteSR_dinoInit3DAttn_SD_B_3L_C_withrollout
                 planes.shape[-2],
                 planes.shape[-1])
 
-        outs = []
-        for i in trange(0, points.shape[1], chunk_size):
-            chunk_points = points[:, i:i + chunk_size]
-
-            chunk_out = self.triplane_decoder.renderer._run_model(
-                planes=planes,
-                decoder=self.triplane_decoder.decoder,
-                sample_coordinates=chunk_points,
-                sample_directions=torch.zeros_like(chunk_points),
-                options=self.rendering_kwargs,
-            )
-
-            outs.append(chunk_out)
-            torch.cuda.empty_cache()
-
-        point_features = {
-            k: torch.cat([out[k] for out in outs], dim=1)
-            for k in outs[0].keys()
-        }
-        return point_features
+        return self.triplane_decoder.renderer.run_model_chunked(
+            planes=planes,
+            decoder=self.triplane_decoder.decoder,
+            sample_coordinates=points,
+            options=self.rendering_kwargs,
+            chunk_size=chunk_size,
+            mem_budget_gb=mem_budget_gb,
+        )
 
     def triplane_decode_grid(self,
                              vit_decode_out,
                              grid_size,
                              aabb: torch.Tensor = None,
+                             coarse_stride: int = 0,
+                             iso: float = 10,
                              **kwargs):
         assert isinstance(vit_decode_out, dict)
         planes = vit_decode_out['latent_after_vit']
@@ -1095,6 +1094,9 @@ class RodinSR_256_fusionv6_ConvQuant_liteSR_dinoInit3DAttn_SD_B_3L_C_withrollout
         assert planes.shape[0] == aabb.shape[0]
         N = planes.shape[0]
 
+        if coarse_stride > 0:
+            return self.triplane_decode_grid_hierarchical(planes, aabb, grid_size, coarse_stride, iso)
+
         grid_points = []
         for i in range(N):
             grid_points.append(
@@ -1395,21 +1397,18 @@ class RodinSR_256_fusionv6_ConvQuant_liteSR_dinoInit3DAttn_SD_B_3L_C_withrollout
             del blk.skip_linear
 
     @torch.inference_mode()
-    def forward_points(self,
-                       planes,
-                       points: torch.Tensor,
-                       chunk_size: int = 2**16):
+    def forward_points(self, planes, points: torch.Tensor, chunk_size: int = None, mem_budget_gb: float = None):
         """Forward pass to decode triplane features at 3D point locations.
         
         Args:
             planes: Triplane features of shape (N, 3, D', H', W')
             points: Query points of shape (N, P, 3) 
-            chunk_size: Number of points to process in each chunk
+            chunk_size: Number of points to process in each chunk, None to size chunks from memory
+            mem_budget_gb: Memory budget of one chunk (None: half of the free device memory)
             
         Returns:
             Dictionary of decoded features for each point
         """
-        N, P = points.shape[:2]
         if planes.ndim == 4:
             planes = planes.reshape(
                 len(planes),
@@ -1418,30 +1417,22 @@ class RodinSR_256_fusionv6_ConvQuant_liteSR_dinoInit3DAttn_SD_B_3L_C_withrollout
                 planes.shape[-2],
                 planes.shape[-1])
 
-        # Query triplane in chunks to handle memory
-        outs = []
-        for i in trange(0, points.shape[1], chunk_size):
-            chunk_points = points[:, i:i + chunk_size]
-            chunk_out = self.triplane_decoder.renderer._run_model(
-                planes=planes,
-                decoder=self.triplane_decoder.decoder,
-                sample_coordinates=chunk_points,
-                sample_directions=torch.zeros_like(chunk_points),
-                options=self.rendering_kwargs,
-            )
-            outs.append(chunk_out)
-            torch.cuda.empty_cache()
-
-        point_features = {
-            k: torch.cat([out[k] for out in outs], dim=1)
-            for k in outs[0].keys()
-        }
-        return point_features
+        # Query triplane in chunks into preallocated outputs (see ImportanceRenderer.run_model_chunked)
+        return self.triplane_decoder.renderer.run_model_chunked(
+            planes=planes,
+            decoder=self.triplane_decoder.decoder,
+            sample_coordinates=points,
+            options=self.rendering_kwargs,
+            chunk_size=chunk_size,
+            mem_budget_gb=mem_budget_gb,
+        )
 
     def triplane_decode_grid(self,
                              vit_decode_out,
                              grid_size,
                              aabb: torch.Tensor = None,
+                             coarse_stride: int = 0,
+                             iso: float = 10,
                              **kwargs):
         """Decode triplane features into a regular 3D grid.
         
@@ -1449,9 +1440,12 @@ class RodinSR_256_fusionv6_ConvQuant_liteSR_dinoInit3DAttn_SD_B_3L_C_withrollout
             vit_decode_out: Dictionary containing latent features
             grid_size: Size of grid to sample
             aabb: Axis-aligned bounding box for sampling. Shape (N, 2, 3)
+            coarse_stride: > 0 decodes the density coarse to fine from this grid stride, refining only
+                near the iso level (see nsr/volumetric_rendering/sparse_grid.py); 0 decodes the dense grid
+            iso: Iso level of the extracted mesh, used with coarse_stride
             
         Returns:
-            Dictionary of decoded features on the 3D grid
+            Dictionary of decoded features on the 3D grid (only 'sigma' with coarse_stride > 0)
         """
         assert isinstance(vit_decode_out, dict)
         planes = vit_decode_out['latent_after_vit']
@@ -1478,6 +1472,9 @@ class RodinSR_256_fusionv6_ConvQuant_liteSR_dinoInit3DAttn_SD_B_3L_C_withrollout
         assert planes.shape[0] == aabb.shape[0]
         N = planes.shape[0]
 
+        if coarse_stride > 0:
+            return self.triplane_decode_grid_hierarchical(planes, aabb, grid_size, coarse_stride, iso)
+
         # Create grid points for sampling
         grid_points = []
         for i in range(N):